@@ -73,6 +73,10 @@ class TrainingConfiguration(object):
 
         self.test_transformations = [SmallestMaxSize(256)]
 
+        # The test images are evaluated one by one, at their exact size. Set a bucket step to evaluate them by batches,
+        # padded to the size of their bucket (see `bucket_step` in `DCTGeneratorJPEG2DCT`).
+        self.test_bucket_step = None
+
         # Keras stuff
         self.reduce_lr_on_plateau = ReduceLROnPlateau(patience=5, verbose=1)
         self.terminate_on_nan = TerminateOnNaN()
@@ -121,14 +125,15 @@ class TrainingConfiguration(object):
 
     def prepare_for_inference(self):
         K.clear_session()
-        self._network = VGG16_dct_y_conv()
+        self._network = VGG16_dct_y_conv(masked=self.test_bucket_step is not None)
 
     def prepare_evaluator(self):
         self._evaluator = Evaluator()
 
     def prepare_testing_generator(self):
+        batch_size = 1 if self.test_bucket_step is None else self.batch_size
         self._test_generator = DCTGeneratorJPEG2DCT(
-            self.test_directory, self.index_file, None, 1, shuffle=False, transforms=self.test_transformations, only_y=True)
+            self.test_directory, self.index_file, None, batch_size, shuffle=False, transforms=self.test_transformations, only_y=True, bucket_step=self.test_bucket_step)
 
     def prepare_training_generators(self):
         self._train_generator = DCTGeneratorJPEG2DCT(
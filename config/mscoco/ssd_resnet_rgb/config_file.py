@@ -128,13 +128,13 @@ class TrainingConfiguration(object):
 
     def prepare_testing_generator(self):
         self._test_generator = COCOGenerator(self.validation_image_dir, self.validation_annotation_path, batch_size=self.batch_size, shuffle=False, label_encoder=self.input_encoder,
-                                             transforms=self.test_transformations)
+                                             transforms=self.test_transformations, decode_size=(300, 300))
 
     def prepare_training_generators(self):
         self._train_generator = COCOGenerator(self.train_image_dir, self.train_annotation_path, batch_size=self.batch_size, shuffle=True, label_encoder=self.input_encoder,
                                               transforms=self.train_tranformations)
         self._validation_generator = COCOGenerator(self.validation_image_dir, self.validation_annotation_path, batch_size=self.batch_size, shuffle=True, label_encoder=self.input_encoder,
-                                                   transforms=self.validation_transformations)
+                                                   transforms=self.validation_transformations, decode_size=(300, 300))
         self.validation_steps = len(self._validation_generator)
 
     @property
@@ -6,7 +6,6 @@ import json
 from typing import List, Dict
 
 from statistics import mean, stdev
-from PIL import Image
 
 from os import makedirs
 from os.path import splitext, split, join
@@ -18,6 +17,7 @@ from pycocotools.coco import COCO
 from pycocotools.cocoeval import COCOeval
 
 from jpeg_deep.utils import iou
+from jpeg_deep.generators.helper import open_image
 
 import tensorflow as tf
 
@@ -141,10 +141,12 @@ class PascalEvaluator(object):
             predictions = model.predict(X)
             image_id = splitext(split(images_path[i])[1])[0]
 
+            # Read through the generator, the image may be packed into records or an archive
+            with open_image(self._generator.get_source(i)) as img:
+                width, height = img.size
+
             for box in predictions[0]:
                 class_id, confidence, xmin, ymin, xmax, ymax = box
-                with Image.open(images_path[i]) as img:
-                    width, height = img.size
                 xmin = xmin * width / 300
                 xmax = xmax * width / 300
                 ymin = ymin * height / 300
@@ -173,13 +175,13 @@ class PascalEvaluator(object):
                     if not self._generator.flagged_boxes[i][j]:
                         # If this box is not supposed to be evaluation-neutral,
                         # increment the counter for the respective class ID.
-                        class_id = boxes[j, 0]
+                        class_id = int(boxes[j, 0])
                         num_gt_per_class[class_id] += 1
                 else:
                     # If there is no such thing as evaluation-neutral boxes for
                     # our dataset, always increment the counter for the respective
                     # class ID.
-                    class_id = boxes[j, 0]
+                    class_id = int(boxes[j, 0])
                     num_gt_per_class[class_id] += 1
 
         # Match the prediction to the ground labels
@@ -248,10 +250,12 @@ class PascalEvaluator(object):
             predictions = model.predict(X)
             image_id = splitext(split(images_path[i])[1])[0]
 
+            # Read through the generator, the image may be packed into records or an archive
+            with open_image(self._generator.get_source(i)) as img:
+                width, height = img.size
+
             for box in predictions[0]:
                 class_id, confidence, xmin, ymin, xmax, ymax = box
-                with Image.open(images_path[i]) as img:
-                    width, height = img.size
                 xmin = xmin * width / 300
                 xmax = xmax * width / 300
                 ymin = ymin * height / 300
@@ -674,8 +678,30 @@ class CocoEvaluator(object):
         self.set = set
         self.network_name = network_name
 
-        # Getting the dictionnary matching the class/id
-        self.coco = COCO(annotation_file)
+        # The annotations are loaded lazily, and reused from the generator when possible
+        self._coco = None
+        self._matching_dictionnary = None
+
+    @property
+    def coco(self):
+        """ The COCO api of the ground truth. Shared with the generator if it already parsed the annotations, loaded from the file otherwise. """
+        if self._generator is not None and hasattr(self._generator, "coco"):
+            return self._generator.coco
+        if self._coco is None:
+            self._coco = COCO(self.annotation_file)
+        return self._coco
+
+    @property
+    def matching_dictionnary(self):
+        """ The dictionnary matching the index of the predictions to [category_id, name]. """
+        if self._matching_dictionnary is not None:
+            return self._matching_dictionnary
+
+        if self._generator is not None and hasattr(self._generator, "matching_dictionnary"):
+            # The generator dictionnary is "category_id: [name, index]"
+            self._matching_dictionnary = {index: [category_id, name] for category_id, (
+                name, index) in self._generator.matching_dictionnary.items()}
+            return self._matching_dictionnary
 
         # display COCO categories and supercategories
         cats = self.coco.loadCats(self.coco.getCatIds())
@@ -690,8 +716,9 @@ class CocoEvaluator(object):
                       for i, value in enumerate(id_classes)]
 
         # create a dictionnary with the ids as keys
-        self.matching_dictionnary = {value[2]: [
+        self._matching_dictionnary = {value[2]: [
             value[0], value[1]] for value in id_classes}
+        return self._matching_dictionnary
 
     def __call__(self, model, test_generator=None):
         if self._generator is None and test_generator is None:
@@ -720,10 +747,12 @@ class CocoEvaluator(object):
             image_id = int(image_id.split("_")[-1])
             imgIds.append(image_id)
 
+            # Read through the generator, the image may be packed into records or an archive
+            with open_image(self._generator.get_source(i)) as img:
+                width, height = img.size
+
             for box in predictions[0]:
                 class_id, confidence, xmin, ymin, xmax, ymax = box
-                with Image.open(images_path[i]) as img:
-                    width, height = img.size
                 xmin = xmin * width / 300
                 xmax = xmax * width / 300
                 ymin = ymin * height / 300
@@ -746,7 +775,7 @@ class CocoEvaluator(object):
         with open("/tmp/output.json", "w") as file:
             json.dump(results, file)
 
-        cocoGt = COCO(self.annotation_file)
+        cocoGt = self.coco
 
         cocoDt = cocoGt.loadRes("/tmp/output.json")
 
@@ -794,10 +823,12 @@ class CocoEvaluator(object):
             image_id = int(image_id.split("_")[-1])
             imgIds.append(image_id)
 
+            # Read through the generator, the image may be packed into records or an archive
+            with open_image(self._generator.get_source(i)) as img:
+                width, height = img.size
+
             for box in predictions[0]:
                 class_id, confidence, xmin, ymin, xmax, ymax = box
-                with Image.open(images_path[i]) as img:
-                    width, height = img.size
                 xmin = xmin * width / 300
                 xmax = xmax * width / 300
                 ymin = ymin * height / 300
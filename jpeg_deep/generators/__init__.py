@@ -2,7 +2,16 @@ from .imagenet_generators import DCTGeneratorJPEG2DCT
 from .imagenet_generators import RGBGenerator
 from .imagenet_generators import prepare_imagenet
 from .voc_generator import VOCGenerator
-from .helper_ssd import SSDInputEncoder
+from .helper_ssd import SSDInputEncoder, RawBoxesEncoder
 from .helper_ssd import BoxFilter, ImageValidator
 from .helper_ssd import BoundGenerator
 from .coco_generator import COCOGenerator
+from .dct_cache import DCTCache, DeterministicTransform
+from .records import RecordReader
+from .archives import TarReader, open_reader
+from .byte_cache import ByteCache
+from .ragged import RaggedArray
+from .sampler import Sampler, BucketSampler
+from .loader import SharedMemoryLoader
+from .tf_data import TFDataAdapter
+from .resume import ResumeCheckpoint, SkipBatches, load_resume_state
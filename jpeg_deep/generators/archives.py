@@ -0,0 +1,156 @@
+""" Reading the images directly from the tar archives of the datasets.
+
+The archives are scanned once to index the offset and length of each member, nested archives included (e.g: the
+ImageNet training archive contains one tar per class). The index is saved next to the archive, the images are then
+read with a single `pread` each, exactly like the packed records, without extracting the archive.
+"""
+
+import os
+import sys
+import tarfile
+
+from os.path import join, basename, dirname, isdir, isfile
+from typing import List
+
+import numpy as np
+
+from tqdm import tqdm
+
+from .records import RecordReader, StringArray, encode_strings
+
+INDEX_SUFFIX = ".index.npz"
+IMAGE_EXTENSIONS = (".jpg", ".jpeg")
+
+
+def class_of_member(path: str):
+    """ Returns the class of a member of an archive, given by its parent directory or its nested archive (e.g:
+    "n01440764.tar/n01440764_10026.JPEG" or "train/n01440764/n01440764_10026.JPEG"), an empty string if none.
+
+    # Arguments:
+        - path: The path of the member in the archive.
+
+    # Returns:
+        The name of the class.
+    """
+    parent = basename(dirname(path))
+    return parent[:-len(".tar")] if parent.endswith(".tar") else parent
+
+
+def _index_members(archive: tarfile.TarFile, prefix: str, file, offsets: List[int], lengths: List[int], paths: List[str], progress):
+    """ Adds the images of an opened archive to the index, recursing into the nested archives. """
+    for member in archive:
+        if not member.isfile():
+            continue
+        if member.name.lower().endswith(".tar"):
+            # The nested archive is opened in place, the offsets of its members are then absolute in the file
+            file.seek(member.offset_data)
+            with tarfile.open(fileobj=file, mode="r:") as nested:
+                _index_members(nested, join(prefix, member.name), file, offsets, lengths, paths, progress)
+        elif member.name.lower().endswith(IMAGE_EXTENSIONS):
+            offsets.append(member.offset_data)
+            lengths.append(member.size)
+            paths.append(join(prefix, member.name))
+            progress.update(1)
+
+
+def index_archive(archive_path: str, index_path: str=None):
+    """ Indexes the images of a tar archive (uncompressed), and writes the index.
+
+    # Arguments:
+        - archive_path: The path to the archive.
+        - index_path: The path of the index, next to the archive by default.
+    """
+    index_path = index_path if index_path is not None else archive_path + INDEX_SUFFIX
+    offsets, lengths, paths = [], [], []
+    with open(archive_path, "rb") as file, tarfile.open(fileobj=file, mode="r:") as archive, \
+            tqdm(desc="Indexing {}".format(basename(archive_path)), file=sys.stdout) as progress:
+        _index_members(archive, "", file, offsets, lengths, paths, progress)
+
+    stat = os.stat(archive_path)
+    paths_blob, paths_offsets = encode_strings(paths)
+    # Written under a temporary name, other processes may be waiting for the index
+    temporary_path = "{}.tmp{}.npz".format(index_path, os.getpid())
+    np.savez(temporary_path,
+             offsets=np.array(offsets, dtype=np.int64),
+             lengths=np.array(lengths, dtype=np.int64),
+             paths_blob=paths_blob,
+             paths_offsets=paths_offsets,
+             archive_size=np.int64(stat.st_size),
+             archive_mtime=np.int64(stat.st_mtime_ns))
+    os.replace(temporary_path, index_path)
+
+
+class TarReader(RecordReader):
+    def __init__(self, archive_path: str, index_path: str=None):
+        """ Reader of the images of a tar archive, used as the packed records (see `RecordReader`). The archive is indexed
+        at the first use (see `index_archive`), the index is rebuilt if the archive changes.
+
+        The labels are not stored in the index, the class of each image can be derived from its path (see
+        `class_of_member` and `prepare_imagenet`).
+
+        # Arguments:
+            - archive_path: The path to the archive (uncompressed).
+            - index_path: The path of the index, next to the archive by default.
+        """
+        self.archive_path = archive_path
+        self.directory = archive_path
+        self.index_path = index_path if index_path is not None else archive_path + INDEX_SUFFIX
+
+        stat = os.stat(archive_path)
+        if not isfile(self.index_path) or not self._is_valid(stat):
+            index_archive(archive_path, self.index_path)
+
+        with np.load(self.index_path) as index:
+            self.offsets = index["offsets"]
+            self.lengths = index["lengths"]
+            self.paths = StringArray(index["paths_blob"], index["paths_offsets"])
+
+        self.names = StringArray.from_list([basename(path) for path in self.paths])
+        self.labels = np.full(len(self.offsets), -1, dtype=np.int64)
+        self.classes = []
+
+        self._descriptors = {}
+        self._pid = None
+
+    def _is_valid(self, stat: os.stat_result):
+        """ Checks that the index was built from the current version of the archive. """
+        with np.load(self.index_path) as index:
+            return int(index["archive_size"]) == stat.st_size and int(index["archive_mtime"]) == stat.st_mtime_ns
+
+    def _descriptor(self, shard: int=0):
+        """ Returns the file descriptor of the archive, opening it if required. """
+        if self._pid != os.getpid():
+            self._descriptors = {}
+            self._pid = os.getpid()
+        if shard not in self._descriptors:
+            self._descriptors[shard] = os.open(self.archive_path, os.O_RDONLY)
+        return self._descriptors[shard]
+
+    def read(self, i: int):
+        """ Returns the bytes of the image i.
+
+        # Arguments:
+            - i: The index of the image in the archive.
+
+        # Returns:
+            The content of the file, as bytes.
+        """
+        return os.pread(self._descriptor(), int(self.lengths[i]), int(self.offsets[i]))
+
+    def member_classes(self):
+        """ Returns the class of each of the images, derived from their path (see `class_of_member`). """
+        return [class_of_member(path) for path in self.paths]
+
+
+def open_reader(records: str):
+    """ Opens the reader of the images of a dataset.
+
+    # Arguments:
+        - records: The directory of the packed records (see `scripts/pack_dataset.py`) or the path to a tar archive.
+
+    # Returns:
+        A `RecordReader`, or a `TarReader` for an archive.
+    """
+    if isdir(records):
+        return RecordReader(records)
+    return TarReader(records)
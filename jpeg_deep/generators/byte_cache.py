@@ -0,0 +1,186 @@
+""" In-memory cache of the bytes of the image files, shared by the processes loading the batches.
+
+The cache is made of fixed-size pages allocated in shared memory when the generator is created: the workers forked
+afterwards (Keras workers, `SharedMemoryLoader`) all see the same pages. A file occupies a chain of pages, and the
+pages are reclaimed with the CLOCK algorithm (an approximation of LRU) when the memory budget is reached. When the
+dataset fits in the budget, the files are read from the disk during the first epoch only.
+"""
+
+import multiprocessing as mp
+
+import numpy as np
+
+# Position of the shared counters in the state array
+FREE_HEAD, FREE_COUNT, HAND, HITS, MISSES, EVICTIONS = range(6)
+
+
+class ByteCache(object):
+    def __init__(self, capacity: int, number_of_items: int, page_size: int=16384):
+        """ Cache of the bytes of the files of a dataset, within a memory budget. It has to be created before the worker
+        processes are forked to be shared with them.
+
+        # Arguments:
+            - capacity: The memory budget of the cache, in bytes.
+            - number_of_items: The number of files in the dataset, the files are identified by their index.
+            - page_size: The size of the pages, in bytes. Each file wastes on average half a page.
+        """
+        self.page_size = page_size
+        self.number_of_pages = max(capacity // page_size, 1)
+        self.number_of_items = number_of_items
+
+        self._arena = mp.RawArray("B", self.number_of_pages * page_size)
+        # Chain of the pages of each file, or of the free pages
+        self._next_page = mp.RawArray("i", self.number_of_pages)
+        # The file stored in each page, -1 if free
+        self._page_owner = mp.RawArray("i", self.number_of_pages)
+        self._first_page = mp.RawArray("i", number_of_items)
+        self._lengths = mp.RawArray("q", number_of_items)
+        self._referenced = mp.RawArray("B", number_of_items)
+        self._state = mp.RawArray("q", 6)
+        self._lock = mp.Lock()
+
+        self._views()
+        self.next_page[:-1] = np.arange(1, self.number_of_pages)
+        self.next_page[-1] = -1
+        self.page_owner[:] = -1
+        self.first_page[:] = -1
+        self.state[FREE_HEAD] = 0
+        self.state[FREE_COUNT] = self.number_of_pages
+
+    def _views(self):
+        """ Creates the numpy views on the shared arrays. """
+        self.pages = np.frombuffer(self._arena, dtype=np.uint8).reshape(
+            self.number_of_pages, self.page_size)
+        self.next_page = np.frombuffer(self._next_page, dtype=np.int32)
+        self.page_owner = np.frombuffer(self._page_owner, dtype=np.int32)
+        self.first_page = np.frombuffer(self._first_page, dtype=np.int32)
+        self.lengths = np.frombuffer(self._lengths, dtype=np.int64)
+        self.referenced = np.frombuffer(self._referenced, dtype=np.uint8)
+        self.state = np.frombuffer(self._state, dtype=np.int64)
+
+    def __len__(self):
+        """ The number of files in the cache. """
+        return int(np.count_nonzero(self.first_page >= 0))
+
+    @property
+    def hits(self):
+        return int(self.state[HITS])
+
+    @property
+    def misses(self):
+        return int(self.state[MISSES])
+
+    @property
+    def evictions(self):
+        return int(self.state[EVICTIONS])
+
+    def reset_counters(self):
+        """ Resets the hit, miss and eviction counters. """
+        with self._lock:
+            self.state[[HITS, MISSES, EVICTIONS]] = 0
+
+    def _chain(self, i: int):
+        """ Returns the pages of the file i, in order. """
+        pages = []
+        page = int(self.first_page[i])
+        while page >= 0:
+            pages.append(page)
+            page = int(self.next_page[page])
+        return pages
+
+    def _free(self, i: int):
+        """ Gives the pages of the file i back to the free list. """
+        pages = self._chain(i)
+        self.page_owner[pages] = -1
+        self.next_page[pages[-1]] = self.state[FREE_HEAD]
+        self.state[FREE_HEAD] = pages[0]
+        self.state[FREE_COUNT] += len(pages)
+        self.first_page[i] = -1
+        self.state[EVICTIONS] += 1
+
+    def _reclaim(self, number_of_pages: int):
+        """ Evicts files until enough pages are free. The clock hand sweeps the pages: a recently used file gets a second
+        chance, the others are evicted. """
+        while self.state[FREE_COUNT] < number_of_pages:
+            page = int(self.state[HAND])
+            self.state[HAND] = (page + 1) % self.number_of_pages
+            owner = int(self.page_owner[page])
+            # Each file is considered once per turn, at its first page
+            if owner < 0 or self.first_page[owner] != page:
+                continue
+            if self.referenced[owner]:
+                self.referenced[owner] = 0
+            else:
+                self._free(owner)
+
+    def get(self, i: int):
+        """ Returns the bytes of the file i, None if it is not in the cache.
+
+        # Arguments:
+            - i: The index of the file.
+
+        # Returns:
+            The content of the file as bytes, or None.
+        """
+        with self._lock:
+            if self.first_page[i] < 0:
+                self.state[MISSES] += 1
+                return None
+            self.state[HITS] += 1
+            self.referenced[i] = 1
+            data = self.pages[self._chain(i)].reshape(-1)[:self.lengths[i]].tobytes()
+        return data
+
+    def put(self, i: int, data: bytes):
+        """ Adds the bytes of the file i to the cache, evicting other files if required. The files larger than the cache
+        are not added.
+
+        # Arguments:
+            - i: The index of the file.
+            - data: The content of the file.
+        """
+        number_of_pages = max(-(-len(data) // self.page_size), 1)
+        if number_of_pages > self.number_of_pages:
+            return
+
+        padded = np.zeros(number_of_pages * self.page_size, dtype=np.uint8)
+        padded[:len(data)] = np.frombuffer(data, dtype=np.uint8)
+        with self._lock:
+            if self.first_page[i] >= 0:
+                return
+            self._reclaim(number_of_pages)
+
+            pages = []
+            page = int(self.state[FREE_HEAD])
+            for _ in range(number_of_pages):
+                pages.append(page)
+                page = int(self.next_page[page])
+            self.state[FREE_HEAD] = page
+            self.state[FREE_COUNT] -= number_of_pages
+
+            self.pages[pages] = padded.reshape(number_of_pages, self.page_size)
+            self.next_page[pages[:-1]] = pages[1:]
+            self.next_page[pages[-1]] = -1
+            self.page_owner[pages] = i
+            self.first_page[i] = pages[0]
+            self.lengths[i] = len(data)
+            self.referenced[i] = 0
+
+    def read(self, i: int, load):
+        """ Returns the bytes of the file i. If it is not cached, it is loaded and added to the cache.
+
+        # Arguments:
+            - i: The index of the file.
+            - load: The function giving the source of the file i when it is not cached, its path or its content.
+
+        # Returns:
+            The content of the file, as bytes.
+        """
+        data = self.get(i)
+        if data is None:
+            data = load(i)
+            if not isinstance(data, bytes):
+                with open(data, "rb") as file:
+                    data = file.read()
+            self.put(i, data)
+        return data
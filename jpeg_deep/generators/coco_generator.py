@@ -1,31 +1,31 @@
 from os.path import basename, join
-from copy import deepcopy
 import inspect
 import sys
 
 import os
+import json
+import hashlib
 
 from typing import List
-
-from random import shuffle
+from functools import partial
 
 import numpy as np
 
-from PIL import Image
-
-from tqdm import tqdm, trange
-
-from io import BytesIO
-
-from jpeg2dct.numpy import load, loads
-
 import h5py
 
 from bs4 import BeautifulSoup
 
 from keras.applications.vgg16 import preprocess_input
+from keras.utils import Sequence
 
 from .helper_ssd import BoxFilter
+from .dct_cache import DCTCache
+from .archives import open_reader
+from .byte_cache import ByteCache
+from .sampler import Sampler
+from .ragged import RaggedArray
+from .records import StringArray, encode_strings
+from .helper import is_dct_pipeline, load_dct, encode_dct, open_image, DEFAULT_CACHE_DIRECTORY, DecodePool, open_reduced_image, select_coefficients
 
 from pycocotools.coco import COCO
 
@@ -46,7 +46,126 @@ class DatasetError(Exception):
     pass
 
 
-class COCOGenerator(object):
+def load_coco_annotations(annotation_file: str, image_directory: str, mode: str="train", cache_directory: str=DEFAULT_CACHE_DIRECTORY):
+    """ Loads the annotations of a MS-COCO annotation file. The annotations are grouped by image in a single vectorized
+    pass over the raw json, instead of querying the COCO api image by image. The result can be saved in a compact
+    cache file, keyed on the annotation file (path, size and modification time) and the mode.
+
+    # Arguments:
+        - annotation_file: File containing all the annotation for the target set.
+        - image_directory: Directory containing all the images.
+        - mode: The mode of the generator, in `train` mode the images without boxes are dropped.
+        - cache_directory: Where to persist the parsed annotations, None to always parse the annotation file.
+
+    # Returns:
+        Six values, the dictionnary "category_id: [name, index]", the path to the images, the COCO ids of the images, the
+        boxes (`RaggedArray`, [class_id, xmin, ymin, xmax, ymax]), the crowd flags (`RaggedArray`) and the raw json content
+        (None if loaded from the cache).
+    """
+    cache_file = None
+    if cache_directory is not None:
+        stat = os.stat(annotation_file)
+        digest = hashlib.sha1("{}:{}:{}:{}".format(os.path.abspath(annotation_file), stat.st_size,
+                                                   stat.st_mtime_ns, mode == "train").encode())
+        cache_file = join(os.path.expanduser(cache_directory),
+                          "coco_annotations_{}.npz".format(digest.hexdigest()))
+
+    if cache_file is not None and os.path.isfile(cache_file):
+        with np.load(cache_file) as data:
+            categories = StringArray(data["categories_blob"], data["categories_offsets"])
+            matching_dictionnary = {int(category_id): [name, i] for i, (category_id, name) in enumerate(
+                zip(data["category_ids"], categories))}
+            file_names = StringArray(data["file_names_blob"], data["file_names_offsets"])
+            images_path = [join(image_directory, file_name) for file_name in file_names]
+            image_ids = data["image_ids"]
+            labels = RaggedArray(data["boxes"], data["offsets"])
+            flagged_boxes = RaggedArray(data["flags"], data["offsets"])
+        return matching_dictionnary, images_path, image_ids, labels, flagged_boxes, None
+
+    with open(annotation_file) as f:
+        dataset = json.load(f)
+
+    # Categories sorted by id, with the background class first
+    id_classes = sorted([(value["id"], value["name"])
+                         for value in dataset["categories"]], key=lambda x: x[0])
+    id_classes.insert(0, (0, "background"))
+    matching_dictionnary = {value[0]: [value[1], i]
+                            for i, value in enumerate(id_classes)}
+
+    images = dataset["images"]
+    image_ids = np.array([image["id"] for image in images], dtype=np.int64)
+    file_names = [image["file_name"] for image in images]
+
+    annotations = dataset.get("annotations", [])
+    n_annotations = len(annotations)
+    annotation_image_ids = np.fromiter(
+        (annotation["image_id"] for annotation in annotations), dtype=np.int64, count=n_annotations)
+    annotation_categories = np.fromiter(
+        (annotation["category_id"] for annotation in annotations), dtype=np.int64, count=n_annotations)
+    annotation_crowd = np.fromiter(
+        (annotation.get("iscrowd", 0) for annotation in annotations), dtype=bool, count=n_annotations)
+    annotation_boxes = np.array([annotation["bbox"] for annotation in annotations],
+                                dtype=np.float32).reshape(-1, 4)
+
+    # Index of the image of each of the annotations
+    order = np.argsort(image_ids)
+    positions = order[np.searchsorted(
+        image_ids, annotation_image_ids, sorter=order)]
+
+    # Index of the class of each of the annotations
+    category_lookup = np.zeros(max(matching_dictionnary) + 1, dtype=np.float32)
+    for category_id, (_, index) in matching_dictionnary.items():
+        category_lookup[category_id] = index
+
+    # Conversion of the boxes to [class_id, xmin, ymin, xmax, ymax]
+    boxes = np.empty((n_annotations, 5), dtype=np.float32)
+    boxes[:, 0] = category_lookup[annotation_categories]
+    boxes[:, 1:3] = annotation_boxes[:, :2]
+    boxes[:, 3:5] = annotation_boxes[:, :2] + annotation_boxes[:, 2:]
+
+    # Group the annotations by image, the sort is stable to keep the order of the file
+    grouping = np.argsort(positions, kind="stable")
+    boxes = boxes[grouping]
+    flags = annotation_crowd[grouping]
+    counts = np.bincount(positions, minlength=len(images))
+
+    # In train mode, the images without boxes are skipped
+    if mode == "train":
+        keep = np.nonzero(counts > 0)[0]
+        counts = counts[keep]
+        image_ids = image_ids[keep]
+        file_names = [file_names[i] for i in keep]
+
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+
+    if cache_file is not None:
+        categories_blob, categories_offsets = encode_strings(
+            [name for _, name in id_classes])
+        file_names_blob, file_names_offsets = encode_strings(file_names)
+        try:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            # Written to a temporary file first in case several processes create the cache at the same time
+            temporary_file = "{}.tmp{}.npz".format(cache_file[:-4], os.getpid())
+            np.savez(temporary_file,
+                     category_ids=np.array([category_id for category_id, _ in id_classes], dtype=np.int64),
+                     categories_blob=categories_blob,
+                     categories_offsets=categories_offsets,
+                     file_names_blob=file_names_blob,
+                     file_names_offsets=file_names_offsets,
+                     image_ids=image_ids,
+                     boxes=boxes,
+                     flags=flags,
+                     offsets=offsets)
+            os.replace(temporary_file, cache_file)
+        except OSError as error:
+            print("Failed to save the annotations cache: {}".format(error))
+
+    images_path = [join(image_directory, file_name) for file_name in file_names]
+    return matching_dictionnary, images_path, image_ids, RaggedArray(boxes, offsets), RaggedArray(flags, offsets), dataset
+
+
+class COCOGenerator(Sequence):
 
     def __init__(self,
                  image_directory: str,
@@ -60,7 +179,15 @@ class COCOGenerator(object):
                  split_cbcr: bool=False,
                  only_y: bool=False,
                  labels_output_format: List[str] = (
-                     'class_id', 'xmin', 'ymin', 'xmax', 'ymax')):
+                     'class_id', 'xmin', 'ymin', 'xmax', 'ymax'),
+                 cache_directory: str=None,
+                 records: str=None,
+                 annotations_cache_directory: str=DEFAULT_CACHE_DIRECTORY,
+                 seed: int=None,
+                 decode_threads: int=None,
+                 decode_size: tuple=None,
+                 n_coefficients: int=64,
+                 byte_cache_size: int=None):
         '''
         Generator for the MS-COCO dataset
         
@@ -70,69 +197,47 @@ class COCOGenerator(object):
             - batch_size: The size of the batch to be return by the generator.
             - shuffle: If the images should be shuffle on epoch end.
             - label_encoder: Object to encode the label in the SSD format.
-            - transforms: The transformations to apply to the images.
+            - transforms: The transformations to apply to the images. If `dct` is set and there is no transformation, or if all the transformations are DCT transformations (see `jpeg_deep.transformations.dct_operations`), the coefficients are read from the original files and the images are never decoded (unless they are not 4:2:0).
             - dct: If the generator should return the DCT encoded images.
             - mode: The mode of the generator, `train` or `test`, in test mode, the generator will ignore the labels.
             - split_cbcr: If the Cb and Cr inputs should be split in two arrays.
             - only_y: If only the Y component should be returned.
             - labels_output_format: The format of the output (leave as is).
+            - cache_directory: If set (requires `dct`), the output of the deterministic transformations is cached as memory-mapped shards in this directory, the remaining transformations should be DCT transformations. Use for the validation/test pipelines, e.g: `[ConvertTo3Channels(), Resize(300, 300)]`.
+            - records: The directory of the packed records containing the images (see `scripts/pack_dataset.py`), or the path to a tar archive of the images (see `TarReader`). If set, the images are read from the records, matched on their file names.
+            - annotations_cache_directory: Where to persist the parsed annotations, None to always parse the annotation file.
+            - seed: The seed of the permutations used to shuffle the images, drawn randomly if not set (see `Sampler`).
+            - decode_threads: The number of threads used to decode and transform the images of a batch concurrently, the images are processed sequentially if None or 1.
+            - decode_size: For the pipelines resizing the images to a known size (e.g: test and validation), the (height, width) of the target. The JPEG images are then decoded at the smallest scale (1/2, 1/4 or 1/8) at or above this size, and the boxes are rescaled accordingly. Leave None for the pipelines cropping the images.
+            - n_coefficients: The number of DCT coefficients kept per block and per component, the first ones in zig-zag order (see `select_coefficients`). The network should be built with the same value.
+            - byte_cache_size: The memory budget, in bytes, of a cache of the JPEG files shared by the worker processes (see `ByteCache`). When the dataset fits in the budget, the files are only read from the disk during the first epoch.
         '''
         self.labels_output_format = labels_output_format
         self.labels_format = {'class_id': 0,
                               'xmin': 1, 'ymin': 2, 'xmax': 3, 'ymax': 4}
 
-        self.images_path = []
-        self.labels = []
-
         self.transforms = transforms
         self.label_encoder = label_encoder
         self.split_cbcr = split_cbcr
         self.only_y = only_y
+        # Only the luminance is returned, the chrominance is then never loaded
+        self.luminance_only = only_y and not split_cbcr
 
         # Getting all the images
         self.image_directory = image_directory
 
-        self.coco = COCO(annotation_file)
-
-        # display COCO categories and supercategories
-        cats = self.coco.loadCats(self.coco.getCatIds())
-        id_classes = sorted([(value["id"], value["name"])
-                             for value in cats], key=lambda x: x[0])
-
-        # add background class
-        id_classes.insert(0, (0, "background"))
-
-        # add the index for the predictions
-        id_classes = [(value[0], value[1], i)
-                      for i, value in enumerate(id_classes)]
-
-        # create a dictionnary with the ids as keys
-        self.matching_dictionnary = {value[0]: [
-            value[1], value[2]] for value in id_classes}
-
-        # Loading all the images
-        img_ids = self.coco.getImgIds()
-        images = self.coco.loadImgs(img_ids)
-        # Getting all the information for each of the images
-        for image in tqdm(images):
-            # Annotations for the image
-            file_path = join(image_directory, image["file_name"])
+        self.annotation_file = annotation_file
+        self._coco = None
 
-            annIds = self.coco.getAnnIds(imgIds=image['id'], iscrowd=None)
-            annotations = self.coco.loadAnns(annIds)
-            bounding_boxes = []
-            for annotation in annotations:
-                bbox = annotation["bbox"]
-                bbox = [bbox[0], bbox[1], bbox[0] +
-                        bbox[2], bbox[1] + bbox[3]]
-                class_id = self.matching_dictionnary[annotation["category_id"]][1]
-                bounding_boxes.append([class_id, *bbox])
+        # Loading all the images and their annotations
+        self.matching_dictionnary, self.images_path, self.image_ids, self.labels, self.flagged_boxes, dataset = load_coco_annotations(
+            annotation_file, image_directory, mode, annotations_cache_directory)
 
-            if len(bounding_boxes) == 0 and mode == "train":
-                continue
-
-            self.images_path.append(file_path)
-            self.labels.append(bounding_boxes)
+        # The COCO api is built from the already parsed annotations, to be shared with the evaluator
+        if dataset is not None:
+            self._coco = COCO()
+            self._coco.dataset = dataset
+            self._coco.createIndex()
 
         self.dataset_size = len(self.images_path)
 
@@ -141,17 +246,30 @@ class COCOGenerator(object):
         self._mode = mode
         self._number_of_data_samples = len(self.images_path)
 
-        self.batch_per_epoch = len(self.images_path) // self._batch_size
-        self.indexes = np.arange(len(self.images_path))
+        self.sampler = Sampler(len(self.images_path), shuffle, seed)
+        self.batch_per_epoch = len(self.indexes) // self._batch_size
+        self.decode_pool = DecodePool(decode_threads)
+        self.decode_size = decode_size
+        self.n_coefficients = n_coefficients
 
-        self.image_ids = None
-        self.flagged_boxes = []
         self.dct = dct
+        self.dct_domain = dct and is_dct_pipeline(transforms)
+
+        if cache_directory is not None and not dct:
+            raise ValueError("The cache can only be used when generating DCT data.")
+        self.cache_directory = cache_directory
+        self.cache = None
+
+        # Position of each of the images in the records if any
+        self.reader = open_reader(records) if records is not None else None
+        self.record_indexes = self.reader.lookup(
+            self.images_path) if self.reader is not None else None
+        self.byte_cache = ByteCache(byte_cache_size, len(self.images_path)) if byte_cache_size else None
 
         self.box_filter = BoxFilter(check_overlap=False, check_min_area=False,
                                     check_degenerate=True, labels_format=self.labels_format)
 
-        self.on_epoch_end()
+        self.prepare_cache()
 
     @property
     def batch_size(self):
@@ -160,7 +278,14 @@ class COCOGenerator(object):
     @batch_size.setter
     def batch_size(self, value):
         self._batch_size = value
-        self.batch_per_epoch = len(self.images_path) // self._batch_size
+        self.batch_per_epoch = len(self.indexes) // self._batch_size
+
+    @property
+    def coco(self):
+        """ The COCO api of the annotation file. Built from the annotations parsed by the generator, or loaded from the file if they came from the cache. """
+        if self._coco is None:
+            self._coco = COCO(self.annotation_file)
+        return self._coco
 
     @property
     def number_of_data_samples(self):
@@ -173,10 +298,43 @@ class COCOGenerator(object):
     @shuffle.setter
     def shuffle(self, value):
         self._shuffle = value
-        if self.shuffle == False:
-            self.indexes = np.arange(len(self.indexes))
-        else:
-            self.on_epoch_end()
+        self.sampler.shuffle = value
+
+    @property
+    def indexes(self):
+        """ The indexes of the images, in the order of the current epoch. """
+        return self.sampler.indexes
+
+    def set_epoch(self, epoch: int):
+        """ Sets the order of the images to the one of the given epoch. The order only depends on the seed and the epoch, so copies of the generator in other processes stay consistent.
+
+        # Arguments:
+            - epoch: The epoch number.
+        """
+        self.sampler.set_epoch(epoch)
+
+    def set_shard(self, shard_index: int, number_of_shards: int, seed: int=None):
+        """ Restricts the generator to a shard of the images, e.g: the images of one Horovod rank. The shards are disjoint slices of the same permutation of the images for each epoch, all the shards must use the same seed.
+
+        # Arguments:
+            - shard_index: The index of the shard, e.g: `hvd.rank()`.
+            - number_of_shards: The number of shards, e.g: `hvd.size()`.
+            - seed: The seed of the permutations, shared by all the shards. The current seed is kept if not set.
+        """
+        self.sampler.set_shard(shard_index, number_of_shards, seed)
+        self.batch_per_epoch = len(self.indexes) // self._batch_size
+
+    def get_state(self):
+        """ Returns the state of the sampler (see `Sampler.get_state`), used to resume a training in the middle of an epoch. """
+        return self.sampler.get_state()
+
+    def set_state(self, state: dict):
+        """ Restores the state of the sampler (see `Sampler.set_state`), the batches then follow the order of the saved epoch.
+
+        # Arguments:
+            - state: The state to restore.
+        """
+        self.sampler.set_state(state)
 
     def __len__(self):
         """ Should return the number of batch per epoch."""
@@ -199,103 +357,180 @@ class COCOGenerator(object):
 
     def on_epoch_end(self):
         """ Updates indexes after each epoch. """
-        if self.shuffle:
-            np.random.shuffle(self.indexes)
+        self.set_epoch(self.sampler.epoch + 1)
 
-    def __data_generation(self, indexes):
+    def _prepare_sample(self, transforms: List[object], i: int):
+        """ Loads the image i and its labels, and applies the transformations. Called concurrently by the threads of the decode pool.
+
+        # Arguments:
+            - transforms: The transformations to apply.
+            - i: The index of the image.
+
+        # Returns:
+            Two values, the image (None if a transformation failed to produce an output image) and the labels.
+        """
+        # Each thread applies its own copy of the transformations, they store the parameters drawn for the image
+        transforms = self.decode_pool.thread_copy(transforms)
+
+        if self.cache is not None:
+            # The deterministic transformations were already applied, read the coefficients from the cache
+            image, labels = self.cache[i]
+        else:
+            # If the transformations work on the coefficients (or if there is none), no need to decode the image
+            dct = load_dct(self.get_source(i), self.luminance_only) if self.dct_domain else None
+            labels = self.labels[i] if not self._mode == "test" else None
+            if dct is None and self.decode_size is not None and not self.dct_domain:
+                # Decoded at a reduced resolution, the boxes are rescaled to match
+                image, (scale_y, scale_x) = open_reduced_image(self.get_source(i), self.decode_size)
+                with image:
+                    image = image.convert("RGB")
+                    image = np.array(image, dtype=np.uint8)
+                if labels is not None:
+                    labels[:, [self.labels_format['xmin'], self.labels_format['xmax']]] *= scale_x
+                    labels[:, [self.labels_format['ymin'], self.labels_format['ymax']]] *= scale_y
+            elif dct is None:
+                with open_image(self.get_source(i)) as image:
+                    image = image.convert("RGB")
+                    image = np.array(image, dtype=np.uint8)
+                # The file is not 4:2:0, it is re-encoded before applying the DCT transformations
+                if self.dct_domain:
+                    dct = encode_dct(image, self.luminance_only)
+            image = dct if self.dct_domain else image
+        if not (not self._mode == "test"):
+            labels = np.array([[0, 0, 0, 0, 0]])
+
+        # Apply any image transformations we may have received.
+        if transforms:
+            for transform in transforms:
+                image, labels = transform(image, labels)
+
+                # In case the transform failed to produce an output image, which is possible for some random transforms.
+                if image is None:
+                    return None, labels
+
+        xmin = self.labels_format['xmin']
+        ymin = self.labels_format['ymin']
+        xmax = self.labels_format['xmax']
+        ymax = self.labels_format['ymax']
+
+        if (not self._mode == "test") and (np.any(labels[:, xmax] - labels[:, xmin] <= 0) or np.any(labels[:, ymax] - labels[:, ymin] <= 0)):
+            labels = self.box_filter(labels)
+
+        # The images transformed in the pixel domain are encoded
+        if self.dct and not isinstance(image, tuple):
+            image = encode_dct(image, self.luminance_only)
+        if self.dct:
+            image = select_coefficients(image, self.n_coefficients)
+
+        return image, labels
+
+    def _get_transforms(self):
+        """ Returns the transformations to apply to the loaded images. """
         # Override the labels formats of all the transformations to make sure they are set correctly.
         if not (self.labels is None):
             if self.transforms is not None:
                 for transform in self.transforms:
                     transform.labels_format = self.labels_format
 
-        batch_X, batch_y = [], []
+        # The deterministic transformations are skipped when the data comes from the cache
+        return self.cache.suffix if self.cache is not None else self.transforms
 
-        for i in indexes:
-            with Image.open(self.images_path[i]) as image:
-                image = image.convert("RGB")
-                batch_X.append(np.array(image, dtype=np.uint8))
-            if not self._mode == "test":
-                batch_y.append(deepcopy(self.labels[i]))
-            else:
-                batch_y.append([[0, 0, 0, 0, 0]])
+    def get_sample(self, i: int):
+        """ Returns the inputs and the target of the image i, used by the pipelines working sample per sample (see `TFDataAdapter`).
 
-        # In case we need to remove any images from the batch, store their indices in this list.
-        batch_items_to_remove = []
-        batch_inverse_transforms = []
-        for i in range(len(batch_X)):
+        # Arguments:
+            - i: The index of the image.
 
-            batch_y[i] = np.array(batch_y[i])
+        # Returns:
+            Two values, the tuple of the inputs of the network and the target (the encoded labels if there is a label encoder), None, None if a transformation failed to produce an output image.
+        """
+        image, labels = self._prepare_sample(self._get_transforms(), i)
+        if image is None:
+            return None, None
 
-            # Apply any image transformations we may have received.
-            if self.transforms:
-                for transform in self.transforms:
-                    batch_X[i], batch_y[i] = transform(
-                        batch_X[i], batch_y[i])
+        if self.label_encoder and (not self._mode == "test"):
+            target = self.label_encoder([labels])[0]
+        else:
+            target = labels
 
-                    # In case the transform failed to produce an output image, which is possible for some random transforms.
-                    if batch_X[i] is None:
-                        batch_items_to_remove.append(i)
-                        batch_inverse_transforms.append([])
-                        continue
+        if not self.dct:
+            return (image,), target
+        dct_y, dct_cb, dct_cr = image
+        if self.split_cbcr:
+            return (dct_y, dct_cb, dct_cr), target
+        if self.only_y:
+            return (dct_y,), target
+        return (dct_y, np.concatenate([dct_cb, dct_cr], axis=-1)), target
 
-            xmin = self.labels_format['xmin']
-            ymin = self.labels_format['ymin']
-            xmax = self.labels_format['xmax']
-            ymax = self.labels_format['ymax']
+    def __data_generation(self, indexes):
+        transforms = self._get_transforms()
+
+        # Load and transform the images of the batch concurrently
+        samples = self.decode_pool.map(
+            partial(self._prepare_sample, transforms), indexes)
 
-            if (not self._mode == "test") and (np.any(batch_y[i][:, xmax] - batch_y[i][:, xmin] <= 0) or np.any(batch_y[i][:, ymax] - batch_y[i][:, ymin] <= 0)):
-                batch_y[i] = self.box_filter(batch_y[i])
+        # The images for which a transformation failed are removed from the batch
+        batch_X = [image for image, _ in samples if image is not None]
+        batch_y = [labels for image, labels in samples if image is not None]
 
-        if self.label_encoder and not self._mode == "test":
+        if self.label_encoder and (not self._mode == "test"):
             batch_y_encoded = self.label_encoder(batch_y)
         else:
             batch_y_encoded = batch_y
 
         if not self.dct:
-            # for i in range(len(batch_X)):
-            #     batch_X[i] = preprocess_input(batch_X[i])
-
-            batch_X = np.array(batch_X)
-            if len(batch_items_to_remove) > 0:
-                print(len(batch_items_to_remove))
-            return batch_X, batch_y_encoded
+            return np.stack(batch_X), batch_y_encoded
         else:
-            X_y = []
+            # The matrices of the batch are allocated once, then filled with the coefficients of each of the images
+            dct_y, dct_cb, _ = batch_X[0]
+            X_y = np.empty((len(batch_X), *dct_y.shape), dtype=np.int16)
             if self.split_cbcr:
-                X_cb = []
-                X_cr = []
-            else:
-                X_cbcr = []
-            for i, image_to_save in enumerate(batch_X):
-                im = Image.fromarray(image_to_save)
-                fake_file = BytesIO()
-                im.save(fake_file, format="jpeg")
-
-                dct_y, dct_cb, dct_cr = loads(fake_file.getvalue())
-
-                y_x, y_y, y_c = dct_y.shape
-                cb_x, cb_y, cb_c = dct_cb.shape
-
-                temp_y = np.zeros((cb_x * 2, cb_y * 2, y_c))
-
-                temp_y[:y_x, :y_y, :] = dct_y
-
-                X_y.append(temp_y)
+                X_cb = np.empty((len(batch_X), *dct_cb.shape), dtype=np.int16)
+                X_cr = np.empty((len(batch_X), *dct_cb.shape), dtype=np.int16)
+            elif not self.only_y:
+                X_cbcr = np.empty((len(batch_X), *dct_cb.shape[:-1], 2 * dct_cb.shape[-1]), dtype=np.int16)
+            for i, (dct_y, dct_cb, dct_cr) in enumerate(batch_X):
+                X_y[i] = dct_y
 
                 if self.split_cbcr:
-                    X_cb.append(dct_cb)
-                    X_cr.append(dct_cr)
-                else:
-                    X_cbcr.append(np.concatenate([dct_cb, dct_cr], axis=-1))
+                    X_cb[i] = dct_cb
+                    X_cr[i] = dct_cr
+                elif not self.only_y:
+                    X_cbcr[i, ..., :dct_cb.shape[-1]] = dct_cb
+                    X_cbcr[i, ..., dct_cb.shape[-1]:] = dct_cr
 
             if self.split_cbcr:
-                return [np.array(X_y), np.array(X_cb), np.array(X_cr)], batch_y_encoded
+                return [X_y, X_cb, X_cr], batch_y_encoded
             else:
                 if self.only_y:
-                    return np.array(X_y), batch_y_encoded
+                    return X_y, batch_y_encoded
                 else:
-                    return [np.array(X_y), np.array(X_cbcr)], batch_y_encoded
+                    return [X_y, X_cbcr], batch_y_encoded
+
+    def prepare_cache(self):
+        """ Builds the cache of the deterministic transformations (or opens it if it already exists). Does nothing if no cache directory was specified. """
+        if self.cache_directory is None:
+            return None
+
+        if self.transforms is not None:
+            for transform in self.transforms:
+                transform.labels_format = self.labels_format
+
+        self.cache = DCTCache(self.cache_directory, self.images_path, self.transforms,
+                              reader=self.reader, record_indexes=self.record_indexes,
+                              labels=self.labels if not self._mode == "test" else None)
+
+    def get_source(self, i: int):
+        """ Returns the bytes of the image i when reading from records or through the byte cache, its path otherwise. """
+        if self.byte_cache is not None:
+            return self.byte_cache.read(i, self._get_file)
+        return self._get_file(i)
+
+    def _get_file(self, i: int):
+        """ Returns the bytes of the image i when reading from records, its path otherwise. """
+        if self.reader is not None:
+            return self.reader.read(self.record_indexes[i])
+        return self.images_path[i]
 
     def get_raw_input_label(self, index:int):
         """ Should return the raw input at a given batch index, i.e something displayable.
@@ -315,9 +550,9 @@ class COCOGenerator(object):
         batch_X, batch_y = [], []
 
         for i in indexes:
-            with Image.open(self.images_path[i]) as image:
+            with open_image(self.get_source(i)) as image:
                 batch_X.append(np.array(image, dtype=np.uint8))
-            batch_y.append(deepcopy(self.labels[i]))
+            batch_y.append(self.labels[i])
 
         # In case we need to remove any images from the batch, store their indices in this list.
         batch_items_to_remove = []
@@ -328,7 +563,8 @@ class COCOGenerator(object):
             batch_y[i] = np.array(batch_y[i])
 
             # Apply any image transformations we may have received.
-            if self.transforms:
+            # The DCT transformations cannot be applied on RGB images, the raw image is returned in this case.
+            if self.transforms and not self.dct_domain:
                 for transform in self.transforms:
 
                     batch_X[i], batch_y[i] = transform(
@@ -367,4 +603,4 @@ class COCOGenerator(object):
 
     def shuffle_batches(self):
         """ Should shuffle the batches of data."""
-        shuffle(self.indexes)
+        self.on_epoch_end()
@@ -0,0 +1,292 @@
+""" On-disk cache of the DCT coefficients produced by the deterministic part of a transformation pipeline.
+
+Validation and test pipelines (e.g: `[ConvertTo3Channels(), Resize(300, 300)]`) always produce the same
+output for a given image. The cache stores these outputs once as fixed-shape int16 `.npy` shards, which are
+then read through memory maps, with no decoding work at all.
+"""
+
+import sys
+import os
+import json
+import shutil
+import hashlib
+import inspect
+
+from os.path import join, exists
+from typing import List
+
+import numpy as np
+
+from tqdm import tqdm
+
+from .helper import is_dct_pipeline, load_dct, encode_dct, open_image
+from .records import RecordReader
+from .ragged import RaggedArray
+
+INDEX_FILE = "index.json"
+LABELS_FILE = "labels.npz"
+COMPONENTS = ("y", "cb", "cr")
+
+
+class DeterministicTransform(object):
+    """ Base class of the transformations that always give the same output for a given input, whose output can be
+    cached. The arguments of the constructor are recorded in `cache_arguments` when the transformation is created, they
+    give the key of the cache (see `describe_transform`).
+    """
+    deterministic = True
+
+    def __new__(cls, *args, **kwargs):
+        transform = super(DeterministicTransform, cls).__new__(cls)
+        try:
+            arguments = inspect.signature(cls.__init__).bind(transform, *args, **kwargs)
+        except TypeError:
+            # Created without its arguments (copy or unpickling), the recorded ones are restored with the state
+            return transform
+        arguments.apply_defaults()
+        transform.cache_arguments = dict(list(arguments.arguments.items())[1:])
+        return transform
+
+
+def split_deterministic_prefix(transforms: List[object]):
+    """ Splits a list of transformations in the longest deterministic prefix and the remaining transformations.
+
+    # Arguments:
+        - transforms: The list of transformations. Deterministic transformations have their `deterministic` attribute set to `True`.
+
+    # Returns:
+        Two lists, the deterministic prefix and the suffix.
+    """
+    transforms = list(transforms) if transforms else []
+    n_deterministic = 0
+    for transform in transforms:
+        if not getattr(transform, "deterministic", False):
+            break
+        n_deterministic += 1
+    return transforms[:n_deterministic], transforms[n_deterministic:]
+
+
+def describe_transform(value):
+    """ Returns a stable description of a transformation and its parameters, used to compute the key of the cache.
+
+    The deterministic transformations are described by the arguments of their constructor, not by their attributes which
+    may change from one call to the other (e.g: the `crop` of `DCTCenterCrop`). An argument stored in an attribute of the
+    same name is read from the attribute, to follow the later changes (e.g: the `labels_format` set by the generators).
+    The other objects (e.g: a `BoxFilter`) are described by their attributes.
+    """
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, (list, tuple)):
+        return [describe_transform(element) for element in value]
+    if isinstance(value, dict):
+        return {str(key): describe_transform(element) for key, element in sorted(value.items())}
+    if isinstance(value, DeterministicTransform):
+        parameters = {name: getattr(value, name, argument) for name, argument in value.cache_arguments.items()}
+        return {"class": type(value).__name__,
+                "parameters": describe_transform(parameters)}
+    if hasattr(value, "__dict__"):
+        return {"class": type(value).__name__,
+                "parameters": describe_transform(vars(value))}
+    return repr(value)
+
+
+def jpeg2dct_version():
+    """ Returns the version of the installed jpeg2dct package, the coefficients could change from one version to the other. """
+    try:
+        import pkg_resources
+        return pkg_resources.get_distribution("jpeg2dct").version
+    except Exception:
+        return "unknown"
+
+
+def apply_transforms(image, labels, transforms: List[object]):
+    """ Applies a list of transformations to an image, with or without labels. """
+    for transform in transforms:
+        if labels is None:
+            image = transform(image)
+        else:
+            image, labels = transform(image, labels)
+    return image, labels
+
+
+class DCTCache(object):
+    def __init__(self,
+                 cache_directory: str,
+                 images_path: List[str],
+                 transforms: List[object],
+                 labels: List[List[List[float]]]=None,
+                 shard_size: int=1024,
+                 reader: RecordReader=None,
+                 record_indexes: np.ndarray=None):
+        """ Cache of the DCT coefficients produced by the deterministic prefix of a list of transformations. The cache is
+        built when the object is created if it does not exist yet. The remaining transformations, if any, have to be DCT
+        transformations as they are applied on the cached coefficients.
+
+        The key of the cache covers the files (path, size and modification time, or the records index), the parameters of
+        the transformations and the version of jpeg2dct. Any change creates a new cache in a new sub-directory.
+
+        # Arguments:
+            - cache_directory: The directory in which the caches are stored.
+            - images_path: The path to all the images of the dataset.
+            - transforms: The full list of transformations of the generator.
+            - labels: The boxes of each of the images, None if there are no labels.
+            - shard_size: The number of images per shard.
+            - reader: If the images are packed into records or read from an archive, the reader of the records (see `open_reader`).
+            - record_indexes: The index in the records of each of the images.
+        """
+        self.prefix, self.suffix = split_deterministic_prefix(transforms)
+        if not is_dct_pipeline(self.suffix):
+            raise ValueError(
+                "The transformations following the deterministic ones should all be DCT transformations to use the cache.")
+
+        self.images_path = images_path
+        self.shard_size = shard_size
+        self.reader = reader
+        self.record_indexes = record_indexes
+        self.key = self.compute_key(images_path, labels)
+        self.directory = join(cache_directory, self.key)
+
+        if not exists(join(self.directory, INDEX_FILE)):
+            self.build(labels)
+        self.open()
+
+    def compute_key(self, images_path: List[str], labels: List[List[List[float]]]):
+        """ Computes the key of the cache from the files, the transformations and the jpeg2dct version. """
+        digest = hashlib.sha1()
+        digest.update(json.dumps({"transforms": describe_transform(self.prefix),
+                                  "jpeg2dct": jpeg2dct_version(),
+                                  "shard_size": self.shard_size,
+                                  "labels": labels is not None}).encode())
+        if self.reader is not None:
+            stat = os.stat(self.reader.index_path)
+            digest.update("{}:{}:{}\n".format(
+                self.reader.directory, stat.st_size, stat.st_mtime_ns).encode())
+            digest.update(np.asarray(self.record_indexes, dtype=np.int64).tobytes())
+        for path in images_path:
+            if self.reader is not None:
+                digest.update("{}\n".format(path).encode())
+                continue
+            stat = os.stat(path)
+            digest.update("{}:{}:{}\n".format(
+                path, stat.st_size, stat.st_mtime_ns).encode())
+        if labels is not None:
+            for boxes in labels:
+                digest.update(np.asarray(boxes, dtype=np.float32).tobytes())
+        return digest.hexdigest()
+
+    def process(self, source, labels: np.ndarray):
+        """ Applies the deterministic transformations to one image and returns its coefficients and labels. """
+        n_pixel_transforms = 0
+        for transform in self.prefix:
+            if getattr(transform, "dct_domain", False):
+                break
+            n_pixel_transforms += 1
+        pixel_transforms = self.prefix[:n_pixel_transforms]
+        dct_transforms = self.prefix[n_pixel_transforms:]
+        if not is_dct_pipeline(dct_transforms):
+            raise ValueError(
+                "The pixel transformations should be placed before the DCT transformations.")
+
+        dct = None if pixel_transforms else load_dct(source)
+        if dct is None:
+            with open_image(source) as image:
+                image = np.array(image.convert("RGB"), dtype=np.uint8)
+            image, labels = apply_transforms(image, labels, pixel_transforms)
+            dct = encode_dct(image)
+
+        return apply_transforms(dct, labels, dct_transforms)
+
+    def build(self, labels: List[List[List[float]]]=None):
+        """ Builds the cache in a temporary directory, then moves it to its final location. """
+        temporary_directory = "{}.tmp{}".format(self.directory, os.getpid())
+        if exists(temporary_directory):
+            shutil.rmtree(temporary_directory)
+        os.makedirs(temporary_directory)
+
+        n_images = len(self.images_path)
+        shapes = None
+        shards = None
+        boxes = []
+        offsets = np.zeros(n_images + 1, dtype=np.int64)
+
+        for i, path in enumerate(tqdm(self.images_path, desc="Building the DCT cache", file=sys.stdout)):
+            image_labels = None if labels is None else np.array(
+                labels[i], dtype=np.float32).reshape(-1, 5)
+            source = path if self.reader is None else self.reader.read(
+                self.record_indexes[i])
+            dct, image_labels = self.process(source, image_labels)
+
+            if shapes is None:
+                shapes = [component.shape for component in dct]
+            elif [component.shape for component in dct] != shapes:
+                raise ValueError(
+                    "The deterministic transformations should produce images of a fixed size to be cached, {} has a different size.".format(path))
+
+            shard, position = divmod(i, self.shard_size)
+            if position == 0:
+                size = min(self.shard_size, n_images - i)
+                shards = [np.lib.format.open_memmap(join(temporary_directory, "{}_{:05d}.npy".format(name, shard)),
+                                                    mode="w+", dtype=np.int16, shape=(size, *shape))
+                          for name, shape in zip(COMPONENTS, shapes)]
+            for memmap, component in zip(shards, dct):
+                memmap[position] = component
+
+            if image_labels is not None:
+                boxes.append(image_labels)
+                offsets[i + 1] = offsets[i] + len(image_labels)
+
+            # Flush the shard once it is full
+            if position == self.shard_size - 1 or i == n_images - 1:
+                for memmap in shards:
+                    memmap.flush()
+                shards = None
+
+        if labels is not None:
+            boxes = np.concatenate(boxes, axis=0) if len(
+                boxes) > 0 else np.zeros((0, 5), dtype=np.float32)
+            np.savez(join(temporary_directory, LABELS_FILE),
+                     boxes=boxes.astype(np.float32), offsets=offsets)
+
+        with open(join(temporary_directory, INDEX_FILE), "w") as index:
+            json.dump({"key": self.key,
+                       "number_of_images": n_images,
+                       "shard_size": self.shard_size,
+                       "shapes": [list(shape) for shape in shapes] if shapes else None}, index)
+
+        # Another process may have built the same cache in the meantime
+        try:
+            os.rename(temporary_directory, self.directory)
+        except OSError:
+            shutil.rmtree(temporary_directory)
+
+    def open(self):
+        """ Opens the shards of the cache as memory maps. """
+        with open(join(self.directory, INDEX_FILE)) as index:
+            self.index = json.load(index)
+
+        n_shards = (self.index["number_of_images"] +
+                    self.shard_size - 1) // self.shard_size
+        self.shards = [[np.load(join(self.directory, "{}_{:05d}.npy".format(name, shard)), mmap_mode="r")
+                        for shard in range(n_shards)]
+                       for name in COMPONENTS]
+
+        self.labels = None
+        if exists(join(self.directory, LABELS_FILE)):
+            with np.load(join(self.directory, LABELS_FILE)) as data:
+                self.labels = RaggedArray(data["boxes"], data["offsets"])
+
+    def __len__(self):
+        return self.index["number_of_images"]
+
+    def __getitem__(self, i: int):
+        """ Returns the cached coefficients and labels of the image i.
+
+        # Arguments:
+            - i: The index of the image in the dataset.
+
+        # Returns:
+            Two values, the tuple (dct_y, dct_cb, dct_cr) as read-only memory maps and the labels (None if not cached).
+        """
+        shard, position = divmod(i, self.shard_size)
+        dct = tuple(component[shard][position] for component in self.shards)
+        labels = self.labels[i] if self.labels is not None else None
+        return dct, labels
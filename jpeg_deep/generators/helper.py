@@ -8,8 +8,34 @@ import numpy as np
 from typing import List
 
 import os
+import hashlib
+import threading
 
-from bs4 import BeautifulSoup
+from io import BytesIO
+from copy import deepcopy
+from functools import partial
+from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
+from xml.etree import ElementTree
+
+from PIL import Image
+
+from jpeg2dct.numpy import load, loads
+
+from .ragged import RaggedArray
+
+# Default location of the caches of the parsed annotations.
+DEFAULT_CACHE_DIRECTORY = "~/.cache/jpeg_deep"
+
+# Index of the coefficients of a block (natural order, i.e. 8 * v + u) sorted in zig-zag order, low frequencies first.
+ZIGZAG_ORDER = np.array([0, 1, 8, 16, 9, 2, 3, 10,
+                         17, 24, 32, 25, 18, 11, 4, 5,
+                         12, 19, 26, 33, 40, 48, 41, 34,
+                         27, 20, 13, 6, 7, 14, 21, 28,
+                         35, 42, 49, 56, 57, 50, 43, 36,
+                         29, 22, 15, 23, 30, 37, 44, 51,
+                         58, 59, 52, 45, 38, 31, 39, 46,
+                         53, 60, 61, 54, 47, 55, 62, 63])
 
 
 class ConvertTo3Channels:
@@ -36,62 +62,57 @@ class ConvertTo3Channels:
             return image, labels
 
 
+VOC_CLASSES = ['background',
+               'aeroplane', 'bicycle', 'bird', 'boat',
+               'bottle', 'bus', 'car', 'cat',
+               'chair', 'cow', 'diningtable', 'dog',
+               'horse', 'motorbike', 'person', 'pottedplant',
+               'sheep', 'sofa', 'train', 'tvmonitor']
+
+
 def parse_xml_voc(data_path: str, classes: List[str] = None, exclude_difficult=False):
     '''
-    This is an XML parser for datasets in the Pascal VOC format.
+    This is an XML parser for datasets in the Pascal VOC format. The file is parsed with `ElementTree.parse` from the
+    standard library (the C implementation), much faster than BeautifulSoup.
 
     # Arguments:
-        - data_path: A list of strings, where each string is the path of a directory that
+        - data_path: The path to the XML annotation file.
         - classes (list, optional): A list containing the names of the object classes as found in the
             `name` XML tags. Must include the class `background` as the first list item. The order of this list
             defines the class IDs.
         - exclude_difficult (bool, optional): If `True`, excludes boxes that are labeled as 'difficult'.
 
     # Returns:
-
+        Two lists, the boxes ([class_id, xmin, ymin, xmax, ymax]) and a flag for each box, `True` if the box is difficult.
     '''
     if classes is None:
-        classes = ['background',
-                   'aeroplane', 'bicycle', 'bird', 'boat',
-                   'bottle', 'bus', 'car', 'cat',
-                   'chair', 'cow', 'diningtable', 'dog',
-                   'horse', 'motorbike', 'person', 'pottedplant',
-                   'sheep', 'sofa', 'train', 'tvmonitor']
+        classes = VOC_CLASSES
     boxes = []
     flagged_boxes = []
 
     try:
-        with open(data_path) as f:
-            soup = BeautifulSoup(f, 'xml')
+        root = ElementTree.parse(data_path).getroot()
     except FileNotFoundError:
         print("Assuming test mode. Returning dummy boxes for labels")
         boxes.append([0, 0, 0, 0, 0])
         flagged_boxes.append(False)
         return boxes, flagged_boxes
 
-    folder = soup.folder.text
-
-    # Get a list of all objects in this image.
-    objects = soup.find_all('object')
-
     # Parse the data for each object.
-    for obj in objects:
-        class_name = obj.find('name', recursive=False).text
+    for obj in root.iter('object'):
+        class_name = obj.findtext('name')
         class_id = classes.index(class_name)
-        truncated = int(
-            obj.find('truncated', recursive=False).text)
-        difficult = int(
-            obj.find('difficult', recursive=False).text)
+        difficult = int(obj.findtext('difficult'))
 
         if difficult == 1 and exclude_difficult:
             continue
 
         # Get the bounding box coordinates.
-        bndbox = obj.find('bndbox', recursive=False)
-        xmin = int(bndbox.xmin.text)
-        ymin = int(bndbox.ymin.text)
-        xmax = int(bndbox.xmax.text)
-        ymax = int(bndbox.ymax.text)
+        bndbox = obj.find('bndbox')
+        xmin = int(bndbox.findtext('xmin'))
+        ymin = int(bndbox.findtext('ymin'))
+        xmax = int(bndbox.findtext('xmax'))
+        ymax = int(bndbox.findtext('ymax'))
 
         boxes.append([class_id, xmin, ymin, xmax, ymax])
         if difficult == 1:
@@ -100,3 +121,311 @@ def parse_xml_voc(data_path: str, classes: List[str] = None, exclude_difficult=F
             flagged_boxes.append(False)
 
     return boxes, flagged_boxes
+
+
+def parse_voc_annotations(annotation_files: List[str],
+                          key_files: List[str] = None,
+                          exclude_difficult: bool = False,
+                          cache_directory: str = DEFAULT_CACHE_DIRECTORY,
+                          processes: int = None):
+    '''
+    Parses all the annotations of a Pascal VOC dataset, using a pool of processes, and persists the result. The cache is
+    keyed on the content of the key files (i.e: the set files) and on the modification time of the annotation files, so
+    that the next calls load all the labels at once from a single numpy file.
+
+    # Arguments:
+        - annotation_files: The paths to the XML annotation files.
+        - key_files: The files whose content should be part of the key of the cache (the set files).
+        - exclude_difficult: If `True`, excludes boxes that are labeled as 'difficult'.
+        - cache_directory: The directory where to save the cache. If None, the annotations are always parsed.
+        - processes: The number of processes used to parse the annotations, defaults to the number of CPUs.
+
+    # Returns:
+        Two `RaggedArray`, the boxes (float32, [class_id, xmin, ymin, xmax, ymax]) and the difficult flags (bool) of each image.
+    '''
+    cache_file = None
+    if cache_directory is not None:
+        digest = hashlib.sha1()
+        digest.update("exclude_difficult:{}\n".format(exclude_difficult).encode())
+        for key_file in key_files or []:
+            with open(key_file, "rb") as f:
+                digest.update(key_file.encode())
+                digest.update(f.read())
+        for annotation_file in annotation_files:
+            try:
+                mtime = os.stat(annotation_file).st_mtime_ns
+            except FileNotFoundError:
+                mtime = -1
+            digest.update("{}:{}\n".format(annotation_file, mtime).encode())
+        cache_file = os.path.join(os.path.expanduser(cache_directory),
+                                  "voc_annotations_{}.npz".format(digest.hexdigest()))
+
+        if os.path.isfile(cache_file):
+            with np.load(cache_file) as data:
+                boxes, flags, offsets = data["boxes"], data["flags"], data["offsets"]
+            return RaggedArray(boxes, offsets), RaggedArray(flags, offsets)
+
+    with Pool(processes) as pool:
+        results = pool.map(partial(parse_xml_voc, exclude_difficult=exclude_difficult),
+                           annotation_files, chunksize=64)
+    labels = RaggedArray.from_lists([boxes for boxes, _ in results])
+    flagged_boxes = RaggedArray.from_lists(
+        [flags for _, flags in results], dtype=bool, shape=())
+
+    if cache_file is not None:
+        try:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            # Written to a temporary file first in case several processes create the cache at the same time
+            temporary_file = "{}.tmp{}.npz".format(cache_file[:-4], os.getpid())
+            np.savez(temporary_file, boxes=labels.values,
+                     flags=flagged_boxes.values, offsets=labels.offsets)
+            os.replace(temporary_file, cache_file)
+        except OSError as error:
+            print("Failed to save the annotations cache: {}".format(error))
+
+    return labels, flagged_boxes
+
+
+def is_dct_pipeline(transforms: List[object]):
+    '''
+    Checks if a pipeline of transformations can be applied directly on the DCT coefficients, i.e. if all
+    the transformations are DCT transformations (`dct_domain` attribute set to `True`).
+
+    # Arguments:
+        - transforms: The list of transformations to check.
+
+    # Returns:
+        A boolean, `True` if the decode => transform => re-encode round trip can be skipped. This is also the
+        case when there is no transformation at all, the coefficients of the original file are then used as is.
+    '''
+    if not transforms:
+        return True
+    return all(getattr(transform, "dct_domain", False) for transform in transforms)
+
+
+def align_luminance(dct_y: np.ndarray, dct_cb: np.ndarray, dct_cr: np.ndarray):
+    '''
+    Pads the luminance component to twice the size of the chrominance components. For 4:2:0 images
+    with a size that is not a multiple of 16 pixels, the luminance component can be one block smaller.
+
+    # Arguments:
+        - dct_y: The luminance coefficients.
+        - dct_cb: The blue chrominance coefficients.
+        - dct_cr: The red chrominance coefficients.
+
+    # Returns:
+        The tuple (dct_y, dct_cb, dct_cr) with the luminance padded.
+    '''
+    y_x, y_y, y_c = dct_y.shape
+    cb_x, cb_y, _ = dct_cb.shape
+    if (y_x, y_y) == (cb_x * 2, cb_y * 2):
+        return dct_y, dct_cb, dct_cr
+
+    temp_y = np.zeros((cb_x * 2, cb_y * 2, y_c), dtype=dct_y.dtype)
+    temp_y[:y_x, :y_y, :] = dct_y
+
+    return temp_y, dct_cb, dct_cr
+
+
+def is_subsampled_420(dct_y: np.ndarray, dct_cb: np.ndarray):
+    '''
+    Checks if the chrominance of an image is sub-sampled by two in both directions (4:2:0), which is the
+    layout expected by the networks.
+
+    # Arguments:
+        - dct_y: The luminance coefficients.
+        - dct_cb: The blue chrominance coefficients.
+
+    # Returns:
+        A boolean, `True` if the image is 4:2:0.
+    '''
+    if dct_cb is None:
+        return False
+    return (2 * dct_cb.shape[0] - dct_y.shape[0] in (0, 1)) and (2 * dct_cb.shape[1] - dct_y.shape[1] in (0, 1))
+
+
+def open_image(source):
+    '''
+    Opens an image with PIL, either from its path or from the bytes of the file.
+
+    # Arguments:
+        - source: The path to the file or its content.
+
+    # Returns:
+        The PIL image.
+    '''
+    if isinstance(source, bytes):
+        return Image.open(BytesIO(source))
+    return Image.open(source)
+
+
+def open_reduced_image(source, size: tuple):
+    '''
+    Opens an image with PIL, the JPEG files being decoded by libjpeg at the smallest scale (1, 1/2, 1/4 or 1/8) for
+    which the image is at least as large as the target size. The other formats are opened at full resolution.
+
+    # Arguments:
+        - source: The path to the file or its content.
+        - size: The (height, width) targeted by the transformations.
+
+    # Returns:
+        Two values, the PIL image and the (vertical, horizontal) scale factors, to be applied to the labels.
+    '''
+    image = open_image(source)
+    width, height = image.size
+    image.draft("RGB", (size[1], size[0]))
+    return image, (image.size[1] / height, image.size[0] / width)
+
+
+def pad_luminance(dct_y: np.ndarray):
+    '''
+    Pads the luminance component to an even number of blocks in both directions, i.e. the size of the luminance
+    of a 4:2:0 image aligned on the chrominance grid. Used when the chrominance is not loaded.
+
+    # Arguments:
+        - dct_y: The luminance coefficients.
+
+    # Returns:
+        The padded luminance coefficients.
+    '''
+    y_x, y_y, y_c = dct_y.shape
+    if y_x % 2 == 0 and y_y % 2 == 0:
+        return dct_y
+
+    temp_y = np.zeros((y_x + y_x % 2, y_y + y_y % 2, y_c), dtype=dct_y.dtype)
+    temp_y[:y_x, :y_y, :] = dct_y
+
+    return temp_y
+
+
+def _luminance(coefficients):
+    ''' Returns the luminance from the output of jpeg2dct loaded with a single channel. '''
+    if isinstance(coefficients, (tuple, list)):
+        return coefficients[0]
+    return coefficients
+
+
+def load_dct(source, only_y: bool=False):
+    '''
+    Loads the DCT coefficients of a JPEG file without decoding it and aligns the luminance on the
+    chrominance grid.
+
+    # Arguments:
+        - source: The path to the JPEG file or its content.
+        - only_y: If only the luminance should be read, the chrominance is then never materialized.
+
+    # Returns:
+        The tuple (dct_y, dct_cb, dct_cr), or None if the file is not a 4:2:0 color JPEG (grayscale, 4:4:4, ...).
+        In this case, the image should be decoded and re-encoded. With `only_y`, the tuple (dct_y, None, None),
+        all the JPEG files have a luminance component.
+    '''
+    if only_y:
+        coefficients = loads(source, channels=1) if isinstance(source, bytes) else load(source, channels=1)
+        return pad_luminance(_luminance(coefficients)), None, None
+
+    coefficients = loads(source) if isinstance(source, bytes) else load(source)
+    if len(coefficients) != 3 or not is_subsampled_420(coefficients[0], coefficients[1]):
+        return None
+    return align_luminance(*coefficients)
+
+
+def encode_dct(image: np.ndarray, only_y: bool=False):
+    '''
+    Encodes an RGB image in JPEG (4:2:0) and returns its DCT coefficients, with the luminance aligned
+    on the chrominance grid.
+
+    # Arguments:
+        - image: The RGB image, as an uint8 array.
+        - only_y: If only the luminance is required, the image is encoded in grayscale.
+
+    # Returns:
+        The tuple (dct_y, dct_cb, dct_cr), (dct_y, None, None) with `only_y`.
+    '''
+    fake_file = BytesIO()
+    if only_y:
+        Image.fromarray(image).convert("L").save(fake_file, format="jpeg")
+        return pad_luminance(_luminance(loads(fake_file.getvalue(), channels=1))), None, None
+
+    Image.fromarray(image).save(fake_file, format="jpeg")
+
+    return align_luminance(*loads(fake_file.getvalue()))
+
+
+
+def select_coefficients(dct, n_coefficients: int=64):
+    '''
+    Keeps the first coefficients of each block in zig-zag order. Most of the high frequency coefficients are
+    zero after the quantization, the low frequencies carry most of the information.
+
+    # Arguments:
+        - dct: The tuple (dct_y, dct_cb, dct_cr), the missing components can be None.
+        - n_coefficients: The number of coefficients to keep per block. With 64, the coefficients are kept in the natural order.
+
+    # Returns:
+        The tuple (dct_y, dct_cb, dct_cr) with `n_coefficients` channels per component.
+    '''
+    if n_coefficients >= 64:
+        return dct
+    order = ZIGZAG_ORDER[:n_coefficients]
+    return tuple(component[..., order] if component is not None else None for component in dct)
+
+
+class DecodePool(object):
+    def __init__(self, threads: int=None):
+        """ Pool of threads used to decode and transform the images of a batch concurrently. The decoders (PIL, OpenCV and
+        jpeg2dct) release the GIL, so the threads run in parallel. The pool is created lazily in each process, which makes it
+        safe to share with forked workers.
+
+        The transformations store the parameters they draw on themselves (e.g: the patch of `RandomPatch`, the crop of
+        `DCTRandomCrop`), so the threads must not share them: each thread applies its own copy, see `thread_copy`.
+
+        # Arguments:
+            - threads: The number of threads, the images are processed sequentially if None or 1.
+        """
+        self.threads = threads
+        self._executor = None
+        self._pid = None
+        self._local = threading.local()
+
+    def __getstate__(self):
+        # The threads and their copies are not transferred to other processes
+        state = self.__dict__.copy()
+        state["_executor"] = None
+        state["_pid"] = None
+        del state["_local"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def thread_copy(self, value):
+        """ Returns the copy of a value owned by the calling thread, made on the first call from this thread. The main
+        thread uses the value itself. Used for the transformations, called by the threads of the pool and by any other
+        thread loading samples (e.g: the threads of the Keras enqueuer or of `TFDataAdapter`).
+
+        # Arguments:
+            - value: The value to copy, e.g: the list of transformations.
+
+        # Returns:
+            The copy of the calling thread.
+        """
+        if value is None or threading.current_thread() is threading.main_thread():
+            return value
+        copies = getattr(self._local, "copies", None)
+        if copies is None:
+            copies = self._local.copies = {}
+        original, copy = copies.get(id(value), (None, None))
+        if original is not value:
+            copy = deepcopy(value)
+            copies[id(value)] = (value, copy)
+        return copy
+
+    def map(self, function, iterable):
+        """ Applies the function to all the elements, returns the list of the results in order. """
+        if not self.threads or self.threads <= 1:
+            return [function(element) for element in iterable]
+        if self._pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=self.threads)
+            self._pid = os.getpid()
+        return list(self._executor.map(function, iterable))
@@ -21,7 +21,8 @@ import numpy as np
 from typing import List
 
 from jpeg_deep.utils import iou, convert_coordinates
-from jpeg_deep.utils import iou
+from jpeg_deep.utils import iou_batch
+from jpeg_deep.utils import SPARSE_TARGET_WIDTH, NEUTRAL_WORD_BITS, sparse_neutral_rows
 
 
 def match_bipartite_greedy(weight_matrix):
@@ -39,8 +40,15 @@ def match_bipartite_greedy(weight_matrix):
     so on. That is, the ground truth boxes will be matched in descending
     order by maximum similarity with any of the respectively remaining
     anchor boxes.
-    The runtime complexity is O(m^2 * n), where `m` is the number of
-    ground truth boxes and `n` is the number of anchor boxes.
+
+    The best anchor box of each ground truth box is computed once, and a
+    row is only reduced again when its best anchor box gets matched:
+    zeroing another column does not change the first maximum of a row
+    whose maximum is positive. The runtime complexity is O(m * n + r * n),
+    where `m` is the number of ground truth boxes, `n` the number of anchor
+    boxes and `r` the number of rows reduced again (usually about `m`),
+    instead of O(m^2 * n) when reducing the whole matrix at each step. The
+    matches, ties included, are the same.
 
     Arguments:
         weight_matrix (array): A 2D Numpy array that represents the weight matrix
@@ -55,34 +63,41 @@ def match_bipartite_greedy(weight_matrix):
         along the first axis.
     '''
 
-    weight_matrix = np.copy(weight_matrix)  # We'll modify this array.
     num_ground_truth_boxes = weight_matrix.shape[0]
-    # Only relevant for fancy-indexing below.
-    all_gt_indices = list(range(num_ground_truth_boxes))
-
     # This 1D array will contain for each ground truth box the index of
     # the matched anchor box.
     matches = np.zeros(num_ground_truth_boxes, dtype=np.int)
 
+    # The best anchor box of each ground truth box and its weight. The weight
+    # matrix is not modified: the matched rows and the matched columns are tracked
+    # instead of being set to zero.
+    best_anchors = np.argmax(weight_matrix, axis=1)
+    overlaps = weight_matrix[np.arange(num_ground_truth_boxes), best_anchors]
+    matched_rows = np.zeros(num_ground_truth_boxes, dtype=np.bool_)
+    matched_columns = np.zeros(weight_matrix.shape[1], dtype=np.bool_)
+
     # In each iteration of the loop below, exactly one ground truth box
     # will be matched to one anchor box.
     for _ in range(num_ground_truth_boxes):
 
-        # Find the maximal anchor-ground truth pair in two steps: First, reduce
-        # over the anchor boxes and then reduce over the ground truth boxes.
-        # Reduce along the anchor box axis.
-        anchor_indices = np.argmax(weight_matrix, axis=1)
-        overlaps = weight_matrix[all_gt_indices, anchor_indices]
         # Reduce along the ground truth box axis.
         ground_truth_index = np.argmax(overlaps)
-        anchor_index = anchor_indices[ground_truth_index]
+        anchor_index = best_anchors[ground_truth_index]
         matches[ground_truth_index] = anchor_index  # Set the match.
 
-        # Set the row of the matched ground truth box and the column of the matched
-        # anchor box to all zeros. This ensures that those boxes will not be matched again,
-        # because they will never be the best matches for any other boxes.
-        weight_matrix[ground_truth_index] = 0
-        weight_matrix[:, anchor_index] = 0
+        # The row of the matched ground truth box is now all zeros, its first maximum is the first anchor box.
+        matched_rows[ground_truth_index] = True
+        matched_columns[anchor_index] = True
+        best_anchors[ground_truth_index] = 0
+        overlaps[ground_truth_index] = 0
+
+        # Reduce again the rows whose best anchor box was just matched. When the maximum of a row is not positive,
+        # the zeroed column can become its first maximum, the row is reduced again too.
+        stale_rows = np.nonzero(~matched_rows & ((best_anchors == anchor_index) | (overlaps <= 0)))[0]
+        for i in stale_rows:
+            row = np.where(matched_columns, 0, weight_matrix[i])
+            best_anchors[i] = np.argmax(row)
+            overlaps[i] = row[best_anchors[i]]
 
     return matches
 
@@ -128,6 +143,85 @@ def match_multi(weight_matrix, threshold):
     return gt_indices_thresh_met, anchor_indices_thresh_met
 
 
+def match_bipartite_greedy_batch(weight_matrix, number_of_boxes):
+    '''
+    Runs `match_bipartite_greedy` for all the images of a batch at once, the matches are identical.
+
+    The best anchor box of each ground truth box is computed once, and only recomputed for the ground truth
+    boxes whose best anchor box was just matched, instead of reducing the whole weight matrix at each step.
+
+    Arguments:
+        weight_matrix (array): A 3D Numpy array of shape `(batch_size, m, n)`, the weight matrix of each image.
+            The rows of the padding ground truth boxes must be negative.
+        number_of_boxes (array): A 1D Numpy array with the number of ground truth boxes of each image, the
+            first rows of the weight matrix of the image.
+
+    Returns:
+        A 2D Numpy array of shape `(batch_size, m)`, the matched index along the last axis of `weight_matrix`
+        for each ground truth box (0 for the padding boxes).
+    '''
+
+    batch_size, max_boxes, _ = weight_matrix.shape
+    matches = np.zeros((batch_size, max_boxes), dtype=np.int64)
+    # The weight matrix is not modified: the matched rows and the matched anchor boxes (in the order of the steps)
+    # are tracked instead of being set to zero.
+    matched_rows = np.zeros((batch_size, max_boxes), dtype=np.bool_)
+    matched_anchors = np.zeros((batch_size, max_boxes), dtype=np.int64)
+
+    best_anchors = np.argmax(weight_matrix, axis=2)
+    best_overlaps = np.take_along_axis(
+        weight_matrix, best_anchors[..., np.newaxis], axis=2)[..., 0]
+
+    for step in range(max_boxes):
+        # The images with ground truth boxes left to match
+        active = np.nonzero(number_of_boxes > step)[0]
+        ground_truth_indices = np.argmax(best_overlaps[active], axis=1)
+        anchor_indices = best_anchors[active, ground_truth_indices]
+        matches[active, ground_truth_indices] = anchor_indices
+        matched_rows[active, ground_truth_indices] = True
+        matched_anchors[active, step] = anchor_indices
+
+        # The rows whose best anchor box was just matched (including the matched row) get a new best anchor box,
+        # zeroing a column does not change the argmax of the other rows.
+        stale_images, stale_boxes = np.nonzero(
+            best_anchors[active] == anchor_indices[:, np.newaxis])
+        stale_images = active[stale_images]
+        rows = weight_matrix[stale_images, stale_boxes]
+        rows[np.arange(len(rows))[:, np.newaxis], matched_anchors[stale_images, :step + 1]] = 0
+        rows[matched_rows[stale_images, stale_boxes]] = 0
+        best_anchors[stale_images, stale_boxes] = np.argmax(rows, axis=1)
+        best_overlaps[stale_images, stale_boxes] = np.amax(rows, axis=1)
+
+    return matches
+
+
+def match_multi_batch(weight_matrix, threshold):
+    '''
+    Runs `match_multi` for all the images of a batch at once.
+
+    Arguments:
+        weight_matrix (array): A 3D Numpy array of shape `(batch_size, m, n)`, the weight matrix of each image.
+        threshold (float): The lower bound of the weight of a match.
+
+    Returns:
+        Three 1D Numpy arrays of equal length that represent the matches: the index of the image, the index
+        of the ground truth box and the index of the anchor box.
+    '''
+
+    # Reduce over the ground truth boxes one row at a time, `argmax` along a non-contiguous axis is much slower.
+    # The strict comparison keeps the first maximum, as `argmax`.
+    overlaps = np.copy(weight_matrix[:, 0])
+    ground_truth_indices = np.zeros(overlaps.shape, dtype=np.int64)
+    for i in range(1, weight_matrix.shape[1]):
+        better = weight_matrix[:, i] > overlaps
+        ground_truth_indices[better] = i
+        np.maximum(overlaps, weight_matrix[:, i], out=overlaps)
+
+    image_indices, anchor_indices = np.nonzero(overlaps >= threshold)
+
+    return image_indices, ground_truth_indices[image_indices, anchor_indices], anchor_indices
+
+
 class BoundGenerator:
     def __init__(self,
                  sample_space=((0.1, None),
@@ -474,7 +568,11 @@ class SSDInputEncoder:
                  border_pixels='half',
                  coords='centroids',
                  normalize_coords=True,
-                 background_id=0):
+                 background_id=0,
+                 batched_matching=True,
+                 iou_dtype=np.float64,
+                 sparse_targets=False,
+                 max_positives=None):
         '''
         Transforms ground truth labels for object detection in images
         (2D bounding box coordinates and class labels) to the format required for
@@ -558,6 +656,17 @@ class SSDInputEncoder:
                 This means instead of using absolute tartget coordinates, the encoder will scale all coordinates to be within [0,1].
                 This way learning becomes independent of the input image size.
             - background_id (int, optional): Determines which class ID is for the background class.
+            - batched_matching (bool, optional): If `True`, the ground truth boxes of all the images of a batch are
+                matched at once, with broadcasted IoUs and vectorized matching. Otherwise, the images are matched one by one.
+            - iou_dtype (type, optional): The type of the IoUs of the batched matching. With float64, the result is identical
+                to the per image matching. float32 halves the memory of the `(batch_size, max_boxes, #boxes)` IoU array, but
+                the IoUs closer than the float32 precision (e.g: anchor boxes symmetric around a ground truth box) may then
+                be matched differently.
+            - sparse_targets (bool, optional): If `True`, the encoder produces the compact targets of `sparsify()` instead of the
+                dense `(batch_size, #boxes, #classes + 12)` tensor, to be used with `SparseSSDLoss`. Requires `background_id` 0.
+            - max_positives (int, optional): The number of positive anchor boxes per image in the sparse targets. By default,
+                the targets are padded to the largest number of positives of the batch. It has to be set when the targets of
+                the images are produced one by one and batched afterwards (e.g: `TFDataAdapter`).
         '''
         ##################################################################################
         # Handle exceptions.
@@ -571,6 +680,10 @@ class SSDInputEncoder:
             raise ValueError(
                 "4 variance values must be pased, but {} values were received.".format(len(variances)))
         variances = np.array(variances)
+
+        if sparse_targets and background_id != 0:
+            raise ValueError(
+                "The sparse targets require the background class to be 0, but `background_id` is {}.".format(background_id))
         if np.any(variances <= 0):
             raise ValueError(
                 "All variances must be >0, but the variances given are {}".format(variances))
@@ -644,6 +757,10 @@ class SSDInputEncoder:
         self.coords = coords
         self.normalize_coords = normalize_coords
         self.background_id = background_id
+        self.batched_matching = batched_matching
+        self.iou_dtype = iou_dtype
+        self.sparse_targets = sparse_targets
+        self.max_positives = max_positives
 
         # Compute the number of boxes per spatial location for each predictor layer.
         # For example, if a predictor layer has three different aspect ratios, [1.0, 0.5, 2.0], and is
@@ -698,7 +815,20 @@ class SSDInputEncoder:
             self.offsets_diag.append(offset)
             self.centers_diag.append(center)
 
-    def __call__(self, ground_truth_labels, diagnostics=False):
+        # The anchor boxes of all the predictor layers as a `(#boxes, 4)` array, in the order of the model output. They
+        # are kept in double precision for the matching.
+        self.anchors = np.concatenate(
+            [np.reshape(boxes, (-1, 4)) for boxes in self.boxes_list], axis=0)
+
+        # The encoding template of one image, the same for all the batches: zero class vectors, the anchor boxes (twice,
+        # the first ones are replaced by the ground truth coordinates) and the variances.
+        self.template = np.zeros(
+            (self.anchors.shape[0], self.n_classes + 12), dtype=np.float32)
+        self.template[:, -12:-8] = self.anchors
+        self.template[:, -8:-4] = self.anchors
+        self.template[:, -4:] = self.variances
+
+    def __call__(self, ground_truth_labels, diagnostics=False, out=None):
         '''
         Converts ground truth bounding box data into a suitable format to train an SSD model.
 
@@ -712,22 +842,19 @@ class SSDInputEncoder:
                 but also a copy of it with anchor box coordinates in place of the ground truth coordinates.
                 This can be very useful if you want to visualize which anchor boxes got matched to which ground truth
                 boxes.
+            out (array, optional): A float32 array of shape `(batch_size, #boxes, #classes + 12)` in which to write
+                the encoded labels, instead of allocating a new one. It is overwritten entirely. With `sparse_targets`,
+                it is only used as an intermediate buffer.
 
         Returns:
             `y_encoded`, a 3D numpy array of shape `(batch_size, #boxes, #classes + 4 + 4 + 4)` that serves as the
             ground truth label tensor for training, where `#boxes` is the total number of boxes predicted by the
             model per image, and the classes are one-hot-encoded. The four elements after the class vecotrs in
             the last axis are the box coordinates, the next four elements after that are just dummy elements, and
-            the last four elements are the variances.
+            the last four elements are the variances. With `sparse_targets`, the compact targets of `sparsify()`
+            (the diagnostics are still dense).
         '''
 
-        # Mapping to define which indices represent which coordinates in the ground truth.
-        class_id = 0
-        xmin = 1
-        ymin = 2
-        xmax = 3
-        ymax = 4
-
         batch_size = len(ground_truth_labels)
 
         ##################################################################################
@@ -735,7 +862,7 @@ class SSDInputEncoder:
         ##################################################################################
 
         y_encoded = self.generate_encoding_template(
-            batch_size=batch_size, diagnostics=False)
+            batch_size=batch_size, diagnostics=False, out=out)
 
         ##################################################################################
         # Match ground truth boxes to anchor boxes.
@@ -747,8 +874,157 @@ class SSDInputEncoder:
 
         # All boxes are background boxes by default.
         y_encoded[:, :, self.background_id] = 1
-        # The total number of boxes that the model predicts per batch item
-        n_boxes = y_encoded.shape[1]
+
+        if self.batched_matching:
+            self.match_batch(ground_truth_labels, y_encoded)
+        else:
+            self.match_per_image(ground_truth_labels, y_encoded)
+
+        ##################################################################################
+        # Convert box coordinates to anchor box offsets.
+        ##################################################################################
+
+        # The conversion is done in place, on a view of the ground truth coordinates. The anchor boxes and the
+        # variances are the same for all the batch items and are broadcast from the template.
+        offsets = y_encoded[:, :, -12:-8]
+        anchors = self.template[:, -8:-4]
+        variances = self.template[:, -4:]
+        if self.coords == 'centroids':
+            # cx(gt) - cx(anchor), cy(gt) - cy(anchor)
+            offsets[..., 0:2] -= anchors[:, 0:2]
+            # (cx(gt) - cx(anchor)) / w(anchor) / cx_variance, (cy(gt) - cy(anchor)) / h(anchor) / cy_variance
+            offsets[..., 0:2] /= anchors[:, 2:4] * variances[:, 0:2]
+            # w(gt) / w(anchor), h(gt) / h(anchor)
+            offsets[..., 2:4] /= anchors[:, 2:4]
+            # ln(w(gt) / w(anchor)) / w_variance, ln(h(gt) / h(anchor)) / h_variance (ln == natural logarithm)
+            np.log(offsets[..., 2:4], out=offsets[..., 2:4])
+            offsets[..., 2:4] /= variances[:, 2:4]
+        elif self.coords == 'corners':
+            # (gt - anchor) for all four coordinates
+            offsets -= anchors
+            # (xmin(gt) - xmin(anchor)) / w(anchor), (xmax(gt) - xmax(anchor)) / w(anchor)
+            offsets[..., 0::2] /= np.expand_dims(anchors[:, 2] - anchors[:, 0], axis=-1)
+            # (ymin(gt) - ymin(anchor)) / h(anchor), (ymax(gt) - ymax(anchor)) / h(anchor)
+            offsets[..., 1::2] /= np.expand_dims(anchors[:, 3] - anchors[:, 1], axis=-1)
+            # (gt - anchor) / size(anchor) / variance for all four coordinates, where 'size' refers to w and h respectively
+            offsets /= variances
+        elif self.coords == 'minmax':
+            # (gt - anchor) for all four coordinates
+            offsets -= anchors
+            # (xmin(gt) - xmin(anchor)) / w(anchor), (xmax(gt) - xmax(anchor)) / w(anchor)
+            offsets[..., 0:2] /= np.expand_dims(anchors[:, 1] - anchors[:, 0], axis=-1)
+            # (ymin(gt) - ymin(anchor)) / h(anchor), (ymax(gt) - ymax(anchor)) / h(anchor)
+            offsets[..., 2:4] /= np.expand_dims(anchors[:, 3] - anchors[:, 2], axis=-1)
+            # (gt - anchor) / size(anchor) / variance for all four coordinates, where 'size' refers to w and h respectively
+            offsets /= variances
+
+        if diagnostics:
+            # Here we'll save the matched anchor boxes (i.e. anchor boxes that were matched to a ground truth box, but keeping the anchor box coordinates).
+            y_matched_anchors = np.copy(y_encoded)
+            # Keeping the anchor box coordinates means setting the offsets to zero.
+            y_matched_anchors[:, :, -12:-8] = 0
+            return y_encoded, y_matched_anchors
+        elif self.sparse_targets:
+            return self.sparsify(y_encoded)
+        else:
+            return y_encoded
+
+    def sparsify(self, y_encoded):
+        '''
+        Converts the dense encoded labels to compact targets: for each image, the bitset of the neutral anchor boxes
+        followed by the anchor index, the class id and the offsets of each positive anchor box (see the layout in
+        `jpeg_deep.utils.ssd_utils`). The background boxes are implicit. `SparseSSDLoss` expands them back on the graph.
+
+        Arguments:
+            y_encoded (array): The dense encoded labels of shape `(batch_size, #boxes, #classes + 12)`.
+
+        Returns:
+            A float32 array of shape `(batch_size, #neutral rows + #positives, 6)`, where `#positives` is
+            `max_positives`, or the largest number of positive anchor boxes of an image of the batch.
+        '''
+        batch_size, n_boxes = y_encoded.shape[:2]
+        classes = y_encoded[:, :, :-12]
+        class_ids = np.argmax(classes, axis=-1)
+        # The neutral boxes have no class, the background ones have the class 0
+        assigned = np.amax(classes, axis=-1) > 0
+        neutral = ~assigned
+        positive = assigned & (class_ids != self.background_id)
+
+        counts = np.count_nonzero(positive, axis=1)
+        max_positives = self.max_positives if self.max_positives is not None else int(np.amax(counts, initial=0))
+        if np.any(counts > max_positives):
+            raise ValueError("An image has {} positive anchor boxes, more than `max_positives` ({}).".format(
+                int(np.amax(counts)), max_positives))
+
+        neutral_rows = sparse_neutral_rows(n_boxes)
+        y_sparse = np.zeros((batch_size, neutral_rows + max_positives, SPARSE_TARGET_WIDTH), dtype=np.float32)
+
+        # The bitset of the neutral boxes, the bit b of the word w is the anchor box w * NEUTRAL_WORD_BITS + b
+        bits = np.zeros((batch_size, neutral_rows * SPARSE_TARGET_WIDTH * NEUTRAL_WORD_BITS), dtype=np.int64)
+        bits[:, :n_boxes] = neutral
+        words = np.dot(bits.reshape(batch_size, -1, NEUTRAL_WORD_BITS), 1 << np.arange(NEUTRAL_WORD_BITS))
+        y_sparse[:, :neutral_rows] = words.reshape(batch_size, neutral_rows, SPARSE_TARGET_WIDTH)
+
+        # The positive boxes, in the order of the anchor boxes, in the first rows of each image
+        rows = y_sparse[:, neutral_rows:]
+        rows[:, :, 0] = -1
+        image_indices, anchor_indices = np.nonzero(positive)
+        ranks = np.arange(len(image_indices)) - np.repeat(np.cumsum(counts) - counts, counts)
+        rows[image_indices, ranks, 0] = anchor_indices
+        rows[image_indices, ranks, 1] = class_ids[image_indices, anchor_indices]
+        rows[image_indices, ranks, 2:] = y_encoded[image_indices, anchor_indices, -12:-8]
+
+        return y_sparse
+
+    def check_labels(self, labels, i):
+        '''
+        Raises a `DegenerateBoxError` if the labels of the batch item i contain degenerate boxes.
+        '''
+        xmin, ymin, xmax, ymax = 1, 2, 3, 4
+        if np.any(labels[..., [xmax]] - labels[..., [xmin]] <= 0) or np.any(labels[..., [ymax]] - labels[..., [ymin]] <= 0):
+            raise DegenerateBoxError("SSDInputEncoder detected degenerate ground truth bounding boxes for batch item {} with bounding boxes {}, ".format(i, labels) +
+                                     "i.e. bounding boxes where xmax <= xmin and/or ymax <= ymin. Degenerate ground truth " +
+                                     "bounding boxes will lead to NaN errors during the training.")
+
+    def convert_labels(self, labels):
+        '''
+        Normalizes the coordinates of the labels and converts them to the coordinate format of the encoder. The labels
+        can be the ones of one image `(k, 5)` or of a batch `(batch_size, k, 5)`.
+        '''
+        xmin, ymin, xmax, ymax = 1, 2, 3, 4
+
+        # Maybe normalize the box coordinates.
+        if self.normalize_coords:
+            # Normalize ymin and ymax relative to the image height
+            labels[..., [ymin, ymax]] /= self.img_height
+            # Normalize xmin and xmax relative to the image width
+            labels[..., [xmin, xmax]] /= self.img_width
+
+        # Maybe convert the box coordinate format.
+        if self.coords == 'centroids':
+            labels = convert_coordinates(
+                labels, start_index=xmin, conversion='corners2centroids', border_pixels=self.border_pixels)
+        elif self.coords == 'minmax':
+            labels = convert_coordinates(
+                labels, start_index=xmin, conversion='corners2minmax')
+        return labels
+
+    def match_per_image(self, ground_truth_labels, y_encoded):
+        '''
+        Matches the ground truth boxes to the anchor boxes of `y_encoded`, one image at a time.
+
+        Arguments:
+            ground_truth_labels (list): The labels of each image of the batch (see `__call__`).
+            y_encoded (array): The encoding template, the matched boxes are written in place.
+        '''
+        # Mapping to define which indices represent which coordinates in the ground truth.
+        class_id = 0
+        xmin = 1
+        ymin = 2
+        xmax = 3
+        ymax = 4
+
+        batch_size = len(ground_truth_labels)
         # An identity matrix that we'll use as one-hot class vectors
         class_vectors = np.eye(self.n_classes)
 
@@ -761,25 +1037,9 @@ class SSDInputEncoder:
                 np.float)  # The labels for this batch item
 
             # Check for degenerate ground truth bounding boxes before attempting any computations.
-            if np.any(labels[:, [xmax]] - labels[:, [xmin]] <= 0) or np.any(labels[:, [ymax]] - labels[:, [ymin]] <= 0):
-                raise DegenerateBoxError("SSDInputEncoder detected degenerate ground truth bounding boxes for batch item {} with bounding boxes {}, ".format(i, labels) +
-                                         "i.e. bounding boxes where xmax <= xmin and/or ymax <= ymin. Degenerate ground truth " +
-                                         "bounding boxes will lead to NaN errors during the training.")
+            self.check_labels(labels, i)
 
-            # Maybe normalize the box coordinates.
-            if self.normalize_coords:
-                # Normalize ymin and ymax relative to the image height
-                labels[:, [ymin, ymax]] /= self.img_height
-                # Normalize xmin and xmax relative to the image width
-                labels[:, [xmin, xmax]] /= self.img_width
-
-            # Maybe convert the box coordinate format.
-            if self.coords == 'centroids':
-                labels = convert_coordinates(
-                    labels, start_index=xmin, conversion='corners2centroids', border_pixels=self.border_pixels)
-            elif self.coords == 'minmax':
-                labels = convert_coordinates(
-                    labels, start_index=xmin, conversion='corners2minmax')
+            labels = self.convert_labels(labels)
 
             # The one-hot class IDs for the ground truth boxes of this batch item
             classes_one_hot = class_vectors[labels[:, class_id].astype(np.int)]
@@ -789,7 +1049,7 @@ class SSDInputEncoder:
 
             # Compute the IoU similarities between all anchor boxes and all ground truth boxes for this batch item.
             # This is a matrix of shape `(num_ground_truth_boxes, num_anchor_boxes)`.
-            similarities = iou(labels[:, [xmin, ymin, xmax, ymax]], y_encoded[i, :, -12:-8],
+            similarities = iou(labels[:, [xmin, ymin, xmax, ymax]], self.anchors,
                                coords=self.coords, mode='outer_product', border_pixels=self.border_pixels)
 
             # First: Do bipartite matching, i.e. match each ground truth box to the one anchor box with the highest IoU.
@@ -831,52 +1091,68 @@ class SSDInputEncoder:
                 max_background_similarities >= self.neg_iou_limit)[0]
             y_encoded[i, neutral_boxes, self.background_id] = 0
 
-        ##################################################################################
-        # Convert box coordinates to anchor box offsets.
-        ##################################################################################
-
-        if self.coords == 'centroids':
-            # cx(gt) - cx(anchor), cy(gt) - cy(anchor)
-            y_encoded[:, :, [-12, -11]] -= y_encoded[:, :, [-8, -7]]
-            # (cx(gt) - cx(anchor)) / w(anchor) / cx_variance, (cy(gt) - cy(anchor)) / h(anchor) / cy_variance
-            y_encoded[:, :, [-12, -11]] /= y_encoded[:,
-                                                     :, [-6, -5]] * y_encoded[:, :, [-4, -3]]
-            # w(gt) / w(anchor), h(gt) / h(anchor)
-            y_encoded[:, :, [-10, -9]] /= y_encoded[:, :, [-6, -5]]
-            # ln(w(gt) / w(anchor)) / w_variance, ln(h(gt) / h(anchor)) / h_variance (ln == natural logarithm)
-            y_encoded[:, :, [-10, -9]
-                      ] = np.log(y_encoded[:, :, [-10, -9]]) / y_encoded[:, :, [-2, -1]]
-        elif self.coords == 'corners':
-            # (gt - anchor) for all four coordinates
-            y_encoded[:, :, -12:-8] -= y_encoded[:, :, -8:-4]
-            # (xmin(gt) - xmin(anchor)) / w(anchor), (xmax(gt) - xmax(anchor)) / w(anchor)
-            y_encoded[:, :, [-12, -10]] /= np.expand_dims(
-                y_encoded[:, :, -6] - y_encoded[:, :, -8], axis=-1)
-            # (ymin(gt) - ymin(anchor)) / h(anchor), (ymax(gt) - ymax(anchor)) / h(anchor)
-            y_encoded[:, :, [-11, -9]] /= np.expand_dims(
-                y_encoded[:, :, -5] - y_encoded[:, :, -7], axis=-1)
-            # (gt - anchor) / size(anchor) / variance for all four coordinates, where 'size' refers to w and h respectively
-            y_encoded[:, :, -12:-8] /= y_encoded[:, :, -4:]
-        elif self.coords == 'minmax':
-            # (gt - anchor) for all four coordinates
-            y_encoded[:, :, -12:-8] -= y_encoded[:, :, -8:-4]
-            # (xmin(gt) - xmin(anchor)) / w(anchor), (xmax(gt) - xmax(anchor)) / w(anchor)
-            y_encoded[:, :, [-12, -11]] /= np.expand_dims(
-                y_encoded[:, :, -7] - y_encoded[:, :, -8], axis=-1)
-            # (ymin(gt) - ymin(anchor)) / h(anchor), (ymax(gt) - ymax(anchor)) / h(anchor)
-            y_encoded[:, :, [-10, -9]] /= np.expand_dims(
-                y_encoded[:, :, -5] - y_encoded[:, :, -6], axis=-1)
-            # (gt - anchor) / size(anchor) / variance for all four coordinates, where 'size' refers to w and h respectively
-            y_encoded[:, :, -12:-8] /= y_encoded[:, :, -4:]
+    def match_batch(self, ground_truth_labels, y_encoded):
+        '''
+        Matches the ground truth boxes to the anchor boxes of `y_encoded` for all the images of the batch at once. The
+        labels are padded to `(batch_size, max_boxes, 5)` with a mask, the IoUs are computed with broadcasting into a single
+        `(batch_size, max_boxes, #boxes)` array and the bipartite, multi and neutral assignments are vectorized. The
+        result is the same as `match_per_image` (see `iou_dtype`).
 
-        if diagnostics:
-            # Here we'll save the matched anchor boxes (i.e. anchor boxes that were matched to a ground truth box, but keeping the anchor box coordinates).
-            y_matched_anchors = np.copy(y_encoded)
-            # Keeping the anchor box coordinates means setting the offsets to zero.
-            y_matched_anchors[:, :, -12:-8] = 0
-            return y_encoded, y_matched_anchors
-        else:
-            return y_encoded
+        Arguments:
+            ground_truth_labels (list): The labels of each image of the batch (see `__call__`).
+            y_encoded (array): The encoding template, the matched boxes are written in place.
+        '''
+        batch_size = len(ground_truth_labels)
+        number_of_boxes = np.array([0 if labels.size == 0 else len(labels)
+                                    for labels in ground_truth_labels], dtype=np.int64)
+        max_boxes = int(number_of_boxes.max()) if batch_size > 0 else 0
+        if max_boxes == 0:
+            # If there is no ground truth in the batch, there is nothing to match.
+            return
+
+        # The padding boxes are valid boxes (no division by zero), they are masked.
+        labels = np.zeros((batch_size, max_boxes, 5))
+        labels[:, :, 3:] = 1
+        mask = np.arange(max_boxes) < number_of_boxes[:, np.newaxis]
+        for i in range(batch_size):
+            if number_of_boxes[i] > 0:
+                labels[i, :number_of_boxes[i]] = ground_truth_labels[i][:, :5]
+                self.check_labels(ground_truth_labels[i].astype(np.float64), i)
+
+        labels = self.convert_labels(labels)
+
+        # The one-hot version of the labels, the padding boxes get the background class.
+        class_ids = np.where(mask, labels[:, :, 0], 0).astype(np.int64)
+        labels_one_hot = np.concatenate(
+            [np.eye(self.n_classes)[class_ids], labels[:, :, 1:5]], axis=-1)
+
+        # The anchor boxes are the same for all the images of the batch. The IoUs are only computed for the actual
+        # ground truth boxes, the rows of the padding boxes are set to -1 so that they are never matched.
+        similarities = np.full((batch_size, max_boxes, y_encoded.shape[1]), -1, dtype=self.iou_dtype)
+        similarities[mask] = iou_batch(labels[mask][:, 1:5], self.anchors, coords=self.coords,
+                                       border_pixels=self.border_pixels, dtype=self.iou_dtype)
+
+        # First: Bipartite matching.
+        bipartite_matches = match_bipartite_greedy_batch(
+            similarities, number_of_boxes)
+        image_indices, box_indices = np.nonzero(mask)
+        anchor_indices = bipartite_matches[image_indices, box_indices]
+        y_encoded[image_indices, anchor_indices, :-8] = labels_one_hot[image_indices, box_indices]
+        similarities[image_indices, :, anchor_indices] = np.where(
+            mask[image_indices], 0, -1)
+
+        # Second: Maybe multi matching.
+        if self.matching_type == 'multi':
+            image_indices, box_indices, anchor_indices = match_multi_batch(
+                similarities, threshold=self.pos_iou_threshold)
+            y_encoded[image_indices, anchor_indices, :-8] = labels_one_hot[image_indices, box_indices]
+            similarities[image_indices, :, anchor_indices] = np.where(
+                mask[image_indices], 0, -1)
+
+        # Third: The negative boxes too close to a ground truth box become neutral.
+        neutral_images, neutral_boxes = np.nonzero(
+            np.amax(similarities, axis=1) >= self.neg_iou_limit)
+        y_encoded[neutral_images, neutral_boxes, self.background_id] = 0
 
     def generate_anchor_boxes_for_layer(self,
                                         feature_map_size,
@@ -1017,65 +1293,39 @@ class SSDInputEncoder:
         else:
             return boxes_tensor
 
-    def generate_encoding_template(self, batch_size, diagnostics=False):
+    def generate_encoding_template(self, batch_size, diagnostics=False, out=None):
         '''
         Produces an encoding template for the ground truth label tensor for a given batch.
 
-        Note that all tensor creation, reshaping and concatenation operations performed in this function
-        and the sub-functions it calls are identical to those performed inside the SSD model. This, of course,
-        must be the case in order to preserve the spatial meaning of each box prediction, but it's useful to make
-        yourself aware of this fact and why it is necessary.
+        Note that the order of the anchor boxes in the template is identical to the one of the SSD model output, they
+        are concatenated from the individual predictor layers in the same way. This, of course, must be the case in
+        order to preserve the spatial meaning of each box prediction.
 
-        In other words, the boxes in `y_encoded` must have a specific order in order correspond to the right spatial
-        positions and scales of the boxes predicted by the model. The sequence of operations here ensures that `y_encoded`
-        has this specific form.
+        The template of one image is computed once, when the encoder is created (see `self.template`), it is copied
+        to each batch item by broadcasting.
 
         # Arguments:
             - batch_size (int): The batch size.
             - diagnostics (bool, optional): See the documnentation for `generate_anchor_boxes()`. The diagnostic output
                 here is similar, just for all predictor conv layers.
+            - out (array, optional): A float32 array of shape `(batch_size, #boxes, #classes + 12)` to fill, instead of
+                allocating a new one.
 
         # Returns:
-            A Numpy array of shape `(batch_size, #boxes, #classes + 12)`, the template into which to encode
+            A float32 Numpy array of shape `(batch_size, #boxes, #classes + 12)`, the template into which to encode
             the ground truth labels for training. The last axis has length `#classes + 12` because the model
             output contains not only the 4 predicted box coordinate offsets, but also the 4 coordinates for
             the anchor boxes and the 4 variance values.
         '''
-        # Tile the anchor boxes for each predictor layer across all batch items.
-        boxes_batch = []
-        for boxes in self.boxes_list:
-            # Prepend one dimension to `self.boxes_list` to account for the batch size and tile it along.
-            # The result will be a 5D tensor of shape `(batch_size, feature_map_height, feature_map_width, n_boxes, 4)`
-            boxes = np.expand_dims(boxes, axis=0)
-            boxes = np.tile(boxes, (batch_size, 1, 1, 1, 1))
-
-            # Now reshape the 5D tensor above into a 3D tensor of shape
-            # `(batch, feature_map_height * feature_map_width * n_boxes, 4)`. The resulting
-            # order of the tensor content will be identical to the order obtained from the reshaping operation
-            # in our Keras model (we're using the Tensorflow backend, and tf.reshape() and np.reshape()
-            # use the same default index order, which is C-like index ordering)
-            boxes = np.reshape(boxes, (batch_size, -1, 4))
-            boxes_batch.append(boxes)
-
-        # Concatenate the anchor tensors from the individual layers to one.
-        boxes_tensor = np.concatenate(boxes_batch, axis=1)
-
-        # 3: Create a template tensor to hold the one-hot class encodings of shape `(batch, #boxes, #classes)`
-        #    It will contain all zeros for now, the classes will be set in the matching process that follows
-        classes_tensor = np.zeros(
-            (batch_size, boxes_tensor.shape[1], self.n_classes))
-
-        # 4: Create a tensor to contain the variances. This tensor has the same shape as `boxes_tensor` and simply
-        #    contains the same 4 variance values for every position in the last axis.
-        variances_tensor = np.zeros_like(boxes_tensor)
-        variances_tensor += self.variances  # Long live broadcasting
-
-        # 4: Concatenate the classes, boxes and variances tensors to get our final template for y_encoded. We also need
-        #    another tensor of the shape of `boxes_tensor` as a space filler so that `y_encoding_template` has the same
-        #    shape as the SSD model output tensor. The content of this tensor is irrelevant, we'll just use
-        #    `boxes_tensor` a second time.
-        y_encoding_template = np.concatenate(
-            (classes_tensor, boxes_tensor, boxes_tensor, variances_tensor), axis=2)
+        shape = (batch_size,) + self.template.shape
+        if out is None:
+            out = np.empty(shape, dtype=np.float32)
+        elif out.shape != shape or out.dtype != np.float32:
+            raise ValueError("The output buffer should be a float32 array of shape {}, got {} of shape {}.".format(
+                shape, out.dtype, out.shape))
+
+        out[...] = self.template  # Long live broadcasting
+        y_encoding_template = out
 
         if diagnostics:
             return y_encoding_template, self.centers_diag, self.wh_list_diag, self.steps_diag, self.offsets_diag
@@ -1083,6 +1333,66 @@ class SSDInputEncoder:
             return y_encoding_template
 
 
+class RawBoxesEncoder:
+    '''
+    Pads the ground truth boxes of a batch, for the anchor matching inside the training graph (see `MatchingSSDLoss`).
+    '''
+
+    def __init__(self,
+                 img_height=300,
+                 img_width=300,
+                 normalize_coords=True,
+                 max_boxes=None):
+        '''
+        Replaces `SSDInputEncoder` as the label encoder of the generators when the ground truth boxes are matched to the
+        anchor boxes by the loss: the labels are only normalized and padded.
+
+        # Arguments:
+            - img_height (int): The height of the input images.
+            - img_width (int): The width of the input images.
+            - normalize_coords (bool, optional): If `True`, the coordinates are normalized to be within [0,1]. Must be the
+                same as for the `AnchorBoxes` layers of the model.
+            - max_boxes (int, optional): The number of ground truth boxes per image in the output. By default, the labels
+                are padded to the largest number of boxes of the batch. It has to be set when the labels of the images are
+                produced one by one and batched afterwards (e.g: `TFDataAdapter`).
+        '''
+        self.img_height = img_height
+        self.img_width = img_width
+        self.normalize_coords = normalize_coords
+        self.max_boxes = max_boxes
+
+    def __call__(self, ground_truth_labels):
+        '''
+        Arguments:
+            ground_truth_labels (list): The labels of each image of the batch, 2D Numpy arrays of format
+                `(class_id, xmin, ymin, xmax, ymax)` (see `SSDInputEncoder.__call__`).
+
+        Returns:
+            A float32 array of shape `(batch_size, max_boxes, 5)` with the boxes of each image in the same format,
+            followed by padding boxes of class 0. There is at least one box per image.
+        '''
+        number_of_boxes = [0 if labels.size == 0 else len(labels) for labels in ground_truth_labels]
+        max_boxes = self.max_boxes if self.max_boxes is not None else max(number_of_boxes + [1])
+        if max(number_of_boxes + [0]) > max_boxes:
+            raise ValueError("An image has {} ground truth boxes, more than `max_boxes` ({}).".format(
+                max(number_of_boxes), max_boxes))
+
+        y_boxes = np.zeros((len(ground_truth_labels), max_boxes, 5), dtype=np.float32)
+        for i, labels in enumerate(ground_truth_labels):
+            if number_of_boxes[i] == 0:
+                continue
+            labels = labels[:, :5].astype(np.float64)
+            if np.any(labels[:, 3] - labels[:, 1] <= 0) or np.any(labels[:, 4] - labels[:, 2] <= 0):
+                raise DegenerateBoxError("RawBoxesEncoder detected degenerate ground truth bounding boxes for batch item {} with bounding boxes {}, ".format(i, labels) +
+                                         "i.e. bounding boxes where xmax <= xmin and/or ymax <= ymin.")
+            if self.normalize_coords:
+                labels[:, [1, 3]] /= self.img_width
+                labels[:, [2, 4]] /= self.img_height
+            y_boxes[i, :number_of_boxes[i]] = labels
+
+        return y_boxes
+
+
 class DegenerateBoxError(Exception):
     '''
     An exception class to be raised if degenerate boxes are being detected.
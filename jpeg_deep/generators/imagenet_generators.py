@@ -15,23 +15,33 @@ import cv2
 
 from tqdm import tqdm
 
-from PIL import Image
 from jpeg2dct.numpy import load, loads
 
 from keras.applications.vgg16 import preprocess_input
 
 from keras.utils import Sequence
 
+from .helper import is_dct_pipeline, load_dct, align_luminance, open_image, open_reduced_image, DecodePool, select_coefficients
+from .records import RecordReader, StringArray, encode_strings
+from .archives import TarReader, open_reader
+from .byte_cache import ByteCache
+from .sampler import Sampler, BucketSampler
 
-def prepare_imagenet(index_file, data_directory):
+
+def prepare_imagenet(index_file, data_directory, reader: RecordReader=None, manifest: str=None):
     """ Helper function to parse the ImageNet class json file. And get the images in the dataset.
 
+    The paths are stored in a single contiguous blob and the labels in an int16 array, which keeps the memory flat
+    when the generator is shared with forked workers.
+
     # Arguments:
         - index_file: The file with the mapping of the index to classes.
         - data_directory: The directory containing the data files (images)
+        - reader: If the dataset was packed into records or is read from a tar archive, the reader. The data directory is not scanned in this case, the labels of the images of an archive are derived from their path (e.g: "n01440764.tar/n01440764_10026.JPEG").
+        - manifest: Optional path to a manifest file (.npz). If it exists, the images and labels are loaded from it instead of scanning the data directory, else it is created.
 
     # Returns:
-        Three values, a dictionnary of mappings "class_id :index", the list of classes sorted by id and the path to the images
+        Four values, a dictionnary of mappings "class_id :index", the list of classes, the path to the images (`StringArray`) and the index of the class of each image (int16 array).
 
     """
 
@@ -41,19 +51,55 @@ def prepare_imagenet(index_file, data_directory):
         for id, value in data.items():
             association[value[0]] = id
 
+    # The class of the images of an archive is given by their directory or nested archive
+    if isinstance(reader, TarReader):
+        member_classes = reader.member_classes()
+        classes = sorted(set(member_classes))
+        missing = [name for name in classes if name not in association]
+        if missing:
+            raise ValueError("The classes of the images of {} could not be derived from their paths, unknown classes: {}.".format(
+                reader.archive_path, missing[:5]))
+        labels = np.array([int(association[name]) for name in member_classes], dtype=np.int16)
+        return association, classes, reader.paths, labels
+
+    # The records already contain the list of images and their labels
+    if reader is not None:
+        return association, reader.classes, reader.names, reader.labels.astype(np.int16)
+
+    if manifest is not None and os.path.isfile(manifest):
+        with np.load(manifest) as data:
+            images_path = StringArray(data["paths_blob"], data["paths_offsets"])
+            classes = list(StringArray(data["classes_blob"], data["classes_offsets"]))
+            labels = data["labels"]
+        return association, classes, images_path, labels
+
     # We process the data directory to get all the classes and images
     classes = []
     images_path = []
+    labels = []
 
-    for directory in tqdm(os.listdir(data_directory)):
+    for directory in tqdm(sorted(os.listdir(data_directory))):
         class_directory = os.path.join(data_directory, directory)
         if os.path.isdir(class_directory):
             classes.append(directory)
-            for image in os.listdir(class_directory):
+            for image in sorted(os.listdir(class_directory)):
                 image_path = os.path.join(class_directory, image)
                 images_path.append(image_path)
+                labels.append(int(association[directory]))
 
-    return association, classes, images_path
+    images_path = StringArray.from_list(images_path)
+    labels = np.array(labels, dtype=np.int16)
+
+    if manifest is not None:
+        classes_blob, classes_offsets = encode_strings(classes)
+        np.savez(manifest,
+                 paths_blob=images_path.blob,
+                 paths_offsets=images_path.offsets,
+                 classes_blob=classes_blob,
+                 classes_offsets=classes_offsets,
+                 labels=labels)
+
+    return association, classes, images_path, labels
 
 
 class DCTGeneratorJPEG2DCT(Sequence):
@@ -65,7 +111,15 @@ class DCTGeneratorJPEG2DCT(Sequence):
                  shuffle: bool=True,
                  split_cbcr: bool=False,
                  only_y: bool=False,
-                 transforms: List[object]=None):
+                 transforms: List[object]=None,
+                 records: str=None,
+                 manifest: str=None,
+                 seed: int=None,
+                 decode_threads: int=None,
+                 n_coefficients: int=64,
+                 bucket_step: int=None,
+                 sizes_file: str=None,
+                 byte_cache_size: int=None):
         """ Generates data in the DCT space for Keras. This generator makes usage of the [following](https://github.com/uber-research/jpeg2dct) repository to read the jpeg images in the correct format.
 
         # Arguments:
@@ -76,15 +130,25 @@ class DCTGeneratorJPEG2DCT(Sequence):
             - shuffle: If the data is to be shuffle.
             - split_cbcr: If the cb and cr component should be grouped or split in two vectors.
             - only_y: If only the Y input should be returned.
-            - transforms: The transformations to apply to the images. Use albumentations as transformations.
+            - transforms: The transformations to apply to the images. Use albumentations as transformations. If there is none, or if all the transformations are DCT transformations (see `jpeg_deep.transformations.dct_operations`), the coefficients are read from the original files and the images are never decoded (unless they are not 4:2:0).
+            - records: The directory of the packed records of the dataset (see `scripts/pack_dataset.py`), or the path to the tar archive of the dataset (see `TarReader`). If set, the images are read from the records or the archive and the data directory is not used.
+            - manifest: Optional path to a manifest (.npz) of the images and labels of the data directory. Created at the first start, it avoids scanning the data directory at the next ones.
+            - seed: The seed of the permutations used to shuffle the images, drawn randomly if not set (see `Sampler`).
+            - decode_threads: The number of threads used to decode and transform the images of a batch concurrently, the images are processed sequentially if None or 1.
+            - n_coefficients: The number of DCT coefficients kept per block and per component, the first ones in zig-zag order (see `select_coefficients`). The network should be built with the same value.
+            - bucket_step: When input_size is None, enables the batching of images of different sizes: the images are grouped in buckets of similar sizes, with a step of `bucket_step` blocks (see `BucketSampler`), and padded to the largest image of their batch. The validity mask of the batch, (batch_size, height, width, 1) at the resolution of the luminance, is then returned as last input (see `masked` in `jpeg_deep.networks`).
+            - sizes_file: Optional path to a .npy file holding the sizes of the images used by the buckets. Created at the first start, it avoids reading the headers of all the images at the next ones.
+            - byte_cache_size: The memory budget, in bytes, of a cache of the JPEG files shared by the worker processes (see `ByteCache`). When the dataset fits in the budget, the files are only read from the disk during the first epoch.
         """
 
-        if input_size is None and batch_size is not 1:
+        if input_size is None and batch_size is not 1 and bucket_step is None:
             raise RuntimeError(
-                "The when input_size is None, the batch size should be one.")
+                "The when input_size is None, the batch size should be one (or bucket_step should be set).")
         # Process the index dictionary to get the matching name/class_id
-        self.association, self.classes, self.images_path = prepare_imagenet(
-            index_file, data_directory)
+        self.reader = open_reader(records) if records is not None else None
+        self.association, self.classes, self.images_path, self.labels = prepare_imagenet(
+            index_file, data_directory, self.reader, manifest)
+        self.byte_cache = ByteCache(byte_cache_size, len(self.images_path)) if byte_cache_size else None
 
         self.images_path = self.images_path
 
@@ -97,17 +161,30 @@ class DCTGeneratorJPEG2DCT(Sequence):
         self.input_size = input_size
         self.split_cbcr = split_cbcr
         self.only_y = only_y
+        # Only the luminance is returned, the chrominance is then never loaded
+        self.luminance_only = only_y and not split_cbcr
         self.transforms = transforms
+        self.dct_domain = is_dct_pipeline(transforms)
         self.number_of_classes = len(self.classes)
 
         # Indexes for the images, will be used to generate the batches of data
-        self.indexes = np.arange(len(self.images_path))
+        self.decode_pool = DecodePool(decode_threads)
+        self.n_coefficients = n_coefficients
+        self.bucketing = input_size is None and bucket_step is not None
+        if self.bucketing:
+            self.sampler = BucketSampler(self.compute_sizes(
+                sizes_file), batch_size, shuffle, seed, bucket_step)
+        else:
+            self.sampler = Sampler(len(self.images_path), shuffle, seed)
 
         # An epoch sees all the images
-        self.batches_per_epoch = len(self.indexes) // self._batch_size
+        self.batches_per_epoch = self._count_batches()
 
-        # Initialization of the first batch
-        self.on_epoch_end()
+    def _count_batches(self):
+        """ Returns the number of batches of an epoch. """
+        if self.bucketing:
+            return len(self.sampler)
+        return len(self.indexes) // self._batch_size
 
     @property
     def batch_size(self):
@@ -116,7 +193,9 @@ class DCTGeneratorJPEG2DCT(Sequence):
     @batch_size.setter
     def batch_size(self, value):
         self._batch_size = value
-        self.batches_per_epoch = len(self.indexes) // self._batch_size
+        if self.bucketing:
+            self.sampler.batch_size = value
+        self.batches_per_epoch = self._count_batches()
 
     @property
     def number_of_data_samples(self):
@@ -133,10 +212,7 @@ class DCTGeneratorJPEG2DCT(Sequence):
     @shuffle.setter
     def shuffle(self, value):
         self._shuffle = value
-        if self.shuffle == False:
-            self.indexes = np.arange(len(self.indexes))
-        else:
-            self.on_epoch_end()
+        self.sampler.shuffle = value
 
     def __len__(self):
         'Denotes the number of batches per epoch'
@@ -151,21 +227,194 @@ class DCTGeneratorJPEG2DCT(Sequence):
         # Returns:
             The batch of data at index i, i.e: data, labels
         """
+        # Generate data
+        X, y = self._data_generation(self.get_batch_indexes(index))
+
+        return X, y
+
+    def get_batch_indexes(self, index: int):
+        """ Returns the indexes of the images of the batch of index i.
+
+        # Arguments:
+            - index: The index of the batch.
+
+        # Returns:
+            The indexes of the images of the batch.
+        """
         # We have to use modulo to avoid overflowing the index size if we have too many batches per epoch
         index = index % self.batches_per_epoch
-        indexes = self.indexes[index * self.batch_size:(index + 1) *
-                               self._batch_size]
+        if self.bucketing:
+            return self.sampler.batches[index]
+        return self.indexes[index * self.batch_size:(index + 1) *
+                            self._batch_size]
 
-        # Generate data
-        X, y = self._data_generation(indexes)
+    @property
+    def indexes(self):
+        """ The indexes of the images, in the order of the current epoch. """
+        return self.sampler.indexes
 
-        return X, y
+    def set_epoch(self, epoch: int):
+        """ Sets the order of the images to the one of the given epoch. The order only depends on the seed and the epoch, so copies of the generator in other processes stay consistent.
+
+        # Arguments:
+            - epoch: The epoch number.
+        """
+        self.sampler.set_epoch(epoch)
+
+    def set_shard(self, shard_index: int, number_of_shards: int, seed: int=None):
+        """ Restricts the generator to a shard of the images, e.g: the images of one Horovod rank. The shards are disjoint slices of the same permutation of the images for each epoch, all the shards must use the same seed.
+
+        # Arguments:
+            - shard_index: The index of the shard, e.g: `hvd.rank()`.
+            - number_of_shards: The number of shards, e.g: `hvd.size()`.
+            - seed: The seed of the permutations, shared by all the shards. The current seed is kept if not set.
+        """
+        self.sampler.set_shard(shard_index, number_of_shards, seed)
+        self.batches_per_epoch = self._count_batches()
+
+    def get_state(self):
+        """ Returns the state of the sampler (see `Sampler.get_state`), used to resume a training in the middle of an epoch. """
+        return self.sampler.get_state()
+
+    def set_state(self, state: dict):
+        """ Restores the state of the sampler (see `Sampler.set_state`), the batches then follow the order of the saved epoch.
+
+        # Arguments:
+            - state: The state to restore.
+        """
+        self.sampler.set_state(state)
 
     def on_epoch_end(self):
         """ Update function run by Keras at the end of each epoch. Will shuffle the images if shuffle was set as true.
         """
-        if self._shuffle == True:
-            np.random.shuffle(self.indexes)
+        self.set_epoch(self.sampler.epoch + 1)
+
+    def get_source(self, k: int):
+        """ Returns the bytes of the image k when reading from records or through the byte cache, its path otherwise. """
+        if self.byte_cache is not None:
+            return self.byte_cache.read(k, self._get_file)
+        return self._get_file(k)
+
+    def _get_file(self, k: int):
+        """ Returns the bytes of the image k when reading from records, its path otherwise. """
+        if self.reader is not None:
+            return self.reader.read(k)
+        return self.images_path[k]
+
+    def get_class_index(self, k: int):
+        """ Returns the index of the class of the image k. """
+        return int(self.labels[k])
+
+    def compute_sizes(self, sizes_file: str=None):
+        """ Computes the size of the coefficients of each of the images once transformed, used to group the images in buckets. Only the headers of the files are read: the effect of the transformations on the size is obtained by applying them to blank images.
+
+        # Argument:
+            - sizes_file: Optional path to a .npy file to read the sizes from, or to save them to if it does not exist.
+
+        # Returns:
+            The (height, width) of the luminance of each image, in blocks.
+        """
+        if sizes_file is not None and os.path.exists(sizes_file):
+            sizes = np.load(sizes_file)
+            if len(sizes) == len(self.images_path):
+                return sizes
+
+        sizes = np.array(self.decode_pool.map(self._estimate_size, tqdm(range(len(self.images_path)), desc="Reading the sizes of the images")),
+                         dtype=np.int32).reshape(-1, 2)
+        if sizes_file is not None:
+            np.save(sizes_file, sizes)
+        return sizes
+
+    def _estimate_size(self, k: int):
+        """ Returns the (height, width) of the luminance of the image k once transformed, in blocks. """
+        transforms = self.decode_pool.thread_copy(self.transforms)
+        with open_image(self.get_source(k)) as image:
+            width, height = image.size
+
+        if transforms and not self.dct_domain:
+            blank = np.zeros((height, width, 3), dtype=np.uint8)
+            for transform in transforms:
+                blank = transform(image=blank)['image']
+            height, width = blank.shape[:2]
+
+        # The luminance is aligned on the chrominance, made of blocks of 16x16 pixels
+        height, width = 2 * -(-height // 16), 2 * -(-width // 16)
+
+        if self.dct_domain and transforms:
+            blank = (np.zeros((height, width, 64), dtype=np.int16),
+                     np.zeros((height // 2, width // 2, 64), dtype=np.int16),
+                     np.zeros((height // 2, width // 2, 64), dtype=np.int16))
+            for transform in transforms:
+                blank = transform(blank)
+            height, width = blank[0].shape[:2]
+        return height, width
+
+    def _load_sample(self, k: int):
+        """ Loads the image k and applies the transformations. Called concurrently by the threads of the decode pool.
+
+        # Argument:
+            - k: The index of the image.
+
+        # Returns:
+            The transformed DCT coefficients, (dct_y, dct_cb, dct_cr).
+        """
+        # Each thread applies its own copy of the transformations, they store the parameters drawn for the image
+        transforms = self.decode_pool.thread_copy(self.transforms)
+
+        # If the transformations work on the coefficients (or if there is none), no need to decode and re-encode the image
+        dct = load_dct(self.get_source(k), self.luminance_only) if self.dct_domain else None
+
+        # Either pixel transformations or the file is not 4:2:0, we go through the decoding
+        if dct is None:
+            # Load the image
+            source = self.get_source(k)
+            if isinstance(source, bytes):
+                img = cv2.imdecode(np.frombuffer(source, dtype=np.uint8), cv2.IMREAD_COLOR)
+            else:
+                img = cv2.imread(source)
+
+            # Apply the transformations
+            if transforms and not self.dct_domain:
+                for transform in transforms:
+                    img = transform(image=img)['image']
+
+            # Only the luminance is encoded if the chrominance is not used
+            if self.luminance_only:
+                img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+            # Save the data to re-open it
+            _, buffer = cv2.imencode(".jpg", img)
+            io_buf = BytesIO(buffer)
+
+            # Read the data from the buffer
+            if self.luminance_only:
+                dct = load_dct(io_buf.getvalue(), only_y=True)
+            else:
+                dct = align_luminance(*loads(io_buf.getvalue()))
+
+        if self.dct_domain and transforms:
+            for transform in transforms:
+                dct = transform(dct)
+        return dct
+
+    def get_sample(self, k: int):
+        """ Returns the inputs and the target of the image k, used by the pipelines working sample per sample (see `TFDataAdapter`).
+
+        # Argument:
+            - k: The index of the image.
+
+        # Returns:
+            Two values, the tuple of the inputs of the network and the one-hot encoded class.
+        """
+        dct_y, dct_cb, dct_cr = select_coefficients(self._load_sample(k), self.n_coefficients)
+        y = np.zeros(self.number_of_classes, dtype=np.int32)
+        y[self.get_class_index(k)] = 1
+
+        if self.split_cbcr:
+            return (dct_y, dct_cb, dct_cr), y
+        if self.only_y:
+            return (dct_y,), y
+        return (dct_y, np.concatenate([dct_cb, dct_cr], axis=-1)), y
 
     def _data_generation(self, indexes):
         """ Internal function used to generate the batch of data.
@@ -179,81 +428,96 @@ class DCTGeneratorJPEG2DCT(Sequence):
         # Prepare the matrices to hold the data.
         if self.input_size is not None:
             X_y = np.empty(
-                (self._batch_size, *self.input_size, 64), dtype=np.int32)
-            if not self.split_cbcr:
-                X_cbcr = np.empty(
-                    (self._batch_size, self.input_size[0] // 2, self.input_size[1] // 2, 128), dtype=np.int32)
-            else:
+                (len(indexes), *self.input_size, self.n_coefficients), dtype=np.int16)
+            if self.split_cbcr:
                 X_cb = np.empty(
-                    (self._batch_size, self.input_size[0] // 2, self.input_size[1] // 2, 64), dtype=np.int32)
+                    (len(indexes), self.input_size[0] // 2, self.input_size[1] // 2, self.n_coefficients), dtype=np.int16)
                 X_cr = np.empty(
-                    (self._batch_size, self.input_size[0] // 2, self.input_size[1] // 2, 64), dtype=np.int32)
-        y = np.zeros((self._batch_size, self.number_of_classes),
+                    (len(indexes), self.input_size[0] // 2, self.input_size[1] // 2, self.n_coefficients), dtype=np.int16)
+            elif not self.only_y:
+                X_cbcr = np.empty(
+                    (len(indexes), self.input_size[0] // 2, self.input_size[1] // 2, 2 * self.n_coefficients), dtype=np.int16)
+        y = np.zeros((len(indexes), self.number_of_classes),
                      dtype=np.int32)
 
-        # Iterate over the indexes to get the data
-        for i, k in enumerate(indexes):
-
+        def fill(i, k):
             # Get the index of the class for later usage
-            last_slash = self.images_path[k].rfind("/")
-            second_last_slash = self.images_path[k][:last_slash].rfind("/")
-            index_class = self.images_path[k][second_last_slash + 1:last_slash]
-
-            # Load the image
-            img = cv2.imread(self.images_path[k])
+            index_class = self.get_class_index(k)
+            dct_y, dct_cb, dct_cr = select_coefficients(self._load_sample(k), self.n_coefficients)
 
-            # Apply the transformations
-            if self.transforms:
-                for transform in self.transforms:
-                    img = transform(image=img)['image']
-
-            # Save the data to re-open it
-            _, buffer = cv2.imencode(".jpg", img)
-            io_buf = BytesIO(buffer)
-
-            # Read the data from the buffer
-            dct_y, dct_cb, dct_cr = loads(io_buf.getvalue())
+            # Setting the target class to 1
+            y[i, index_class] = 1
 
-            # If the size of the input is not specified, create the matrices and load the data
+            # If the size of the input is not specified, the matrices are created once the size is known
             if self.input_size is None:
-                if not self.split_cbcr:
-                    X_cbcr = np.empty(
-                        (self._batch_size, dct_cb.shape[0], dct_cb.shape[1], dct_cb.shape[2] * 2), dtype=np.int32)
-                    X_cbcr[i] = np.concatenate([dct_cb, dct_cr], axis=-1)
-                else:
-                    X_cb = np.empty(
-                        (self._batch_size, dct_cb.shape[0], dct_cb.shape[1], dct_cb.shape[2]), dtype=np.int32)
-                    X_cr = np.empty(
-                        (self._batch_size, dct_cb.shape[0], dct_cb.shape[1], dct_cb.shape[2]), dtype=np.int32)
+                return dct_y, dct_cb, dct_cr
+
+            # load the data in the matrices
+            try:
+                X_y[i] = dct_y
+                if self.split_cbcr:
                     X_cb[i] = dct_cb
                     X_cr[i] = dct_cr
+                elif not self.only_y:
+                    X_cbcr[i, :, :, :dct_cb.shape[-1]] = dct_cb
+                    X_cbcr[i, :, :, dct_cb.shape[-1]:] = dct_cr
+            except Exception as e:
+                # Debug, should not go there anymore
+                raise Exception(str(e) + str(self.images_path[k]))
 
-                X_y = np.zeros(
-                    (self._batch_size, dct_cb.shape[0] * 2, dct_cb.shape[1] * 2, dct_cb.shape[2]), dtype=np.int32)
-                X_y[i, :dct_y.shape[0], :dct_y.shape[1], :] = dct_y
+        # Decode the images of the batch concurrently, directly into the matrices
+        samples = self.decode_pool.map(lambda sample: fill(*sample), enumerate(indexes))
 
-            else:
-                # load the data in the matrices
-                try:
-                    X_y[i] = dct_y
-                    if not self.split_cbcr:
-                        X_cbcr[i] = np.concatenate([dct_cb, dct_cr], axis=-1)
-                    else:
-                        X_cb[i] = dct_cb
-                        X_cr[i] = dct_cr
-                except Exception as e:
-                    # Debug, should not go there anymore
-                    raise Exception(str(e) + str(self.images_path[k]))
+        # If the size of the input is not specified, create the matrices and load the data
+        if self.input_size is None:
+            X_y, X_cb, X_cr, X_cbcr, mask = self._pad_samples(samples)
 
-            # Setting the target class to 1
-            y[i, int(self.association[index_class])] = 1
         if not self.split_cbcr:
             if self.only_y:
-                return X_y, y
+                X = [X_y]
             else:
-                return [X_y, X_cbcr], y
+                X = [X_y, X_cbcr]
         else:
-            return [X_y, X_cb, X_cr], y
+            X = [X_y, X_cb, X_cr]
+
+        # The validity mask of the padded batches is given as last input
+        if self.bucketing:
+            X.append(mask)
+        return (X[0] if len(X) == 1 else X), y
+
+    def _pad_samples(self, samples):
+        """ Creates the matrices of a batch of images of different sizes, padded with zeros to the size of the largest one.
+
+        # Argument:
+            - samples: The list of the (dct_y, dct_cb, dct_cr) of the images.
+
+        # Returns:
+            Five values, the matrices of the luminance, of the cb, cr and cbcr components (None if not used) and the validity mask of the luminance.
+        """
+        # The luminance is already padded to twice the size of the chrominance
+        height = max(dct_y.shape[0] for dct_y, _, _ in samples)
+        width = max(dct_y.shape[1] for dct_y, _, _ in samples)
+
+        X_y = np.zeros((len(samples), height, width, self.n_coefficients), dtype=np.int16)
+        mask = np.zeros((len(samples), height, width, 1), dtype=np.uint8)
+        X_cb, X_cr, X_cbcr = None, None, None
+        if self.split_cbcr:
+            X_cb = np.zeros((len(samples), height // 2, width // 2, self.n_coefficients), dtype=np.int16)
+            X_cr = np.zeros((len(samples), height // 2, width // 2, self.n_coefficients), dtype=np.int16)
+        elif not self.only_y:
+            X_cbcr = np.zeros((len(samples), height // 2, width // 2, 2 * self.n_coefficients), dtype=np.int16)
+
+        for i, (dct_y, dct_cb, dct_cr) in enumerate(samples):
+            X_y[i, :dct_y.shape[0], :dct_y.shape[1]] = dct_y
+            mask[i, :dct_y.shape[0], :dct_y.shape[1]] = 1
+            if self.split_cbcr:
+                X_cb[i, :dct_cb.shape[0], :dct_cb.shape[1]] = dct_cb
+                X_cr[i, :dct_cr.shape[0], :dct_cr.shape[1]] = dct_cr
+            elif not self.only_y:
+                X_cbcr[i, :dct_cb.shape[0], :dct_cb.shape[1], :dct_cb.shape[2]] = dct_cb
+                X_cbcr[i, :dct_cr.shape[0], :dct_cr.shape[1], dct_cb.shape[2]:] = dct_cr
+
+        return X_y, X_cb, X_cr, X_cbcr, mask
 
     def get_raw_input_label(self, index):
         """ Provide with the raw data, i.e displayable. Here we return the RGB image, same as the original __getitem__ function, without the preprocess input.
@@ -265,41 +529,37 @@ class DCTGeneratorJPEG2DCT(Sequence):
             Two values, the images and the associated labels.
 
         """
-        # We have to use modulo to avoid overflowing the index size if we have too many batches per epoch
-        index = index % self.batches_per_epoch
-        indexes = self.indexes[index * self.batch_size:(index + 1) *
-                               self._batch_size]
+        indexes = self.get_batch_indexes(index)
 
         # If we have an input size, generate the matrix to hold the data, else wait for the image size to be known
         if self.input_size is not None:
-            X = np.empty((self._batch_size, 224, 224, 3), dtype=np.uint8)
-        y = np.zeros((self._batch_size, self.number_of_classes),
+            X = np.empty((len(indexes), 224, 224, 3), dtype=np.uint8)
+        y = np.zeros((len(indexes), self.number_of_classes),
                      dtype=np.int32)
 
         # iterate over the indexes to get the data points
         for i, k in enumerate(indexes):
 
             # Get the index of the class to set the label value
-            last_slash = self.images_path[k].rfind("/")
-            second_last_slash = self.images_path[k][:last_slash].rfind("/")
-            index_class = self.images_path[k][second_last_slash + 1:last_slash]
+            index_class = self.get_class_index(k)
 
             # Setting the target class to 1
-            y[i, int(self.association[index_class])] = 1
+            y[i, index_class] = 1
 
             # Load the image
-            img = Image.open(self.images_path[k])
+            img = open_image(self.get_source(k))
             img = img.convert("RGB")
             img = np.asarray(img)
 
             # Apply the transformations if any. Careful, if they are not determinate, the displayed images will not be the ones fed to the network
-            if self.transforms:
+            # The DCT transformations cannot be applied on RGB images, the raw image is returned in this case.
+            if self.transforms and not self.dct_domain:
                 for transform in self.transforms:
                     img = transform(image=img)['image']
 
             # If no input size, set the X matrix to the image size
             if self.input_size is None:
-                X = np.empty((self._batch_size, *img.shape), dtype=np.uint8)
+                X = np.empty((len(indexes), *img.shape), dtype=np.uint8)
 
             # As we want displayable, do not do the preprocessing
             X[i] = img
@@ -315,7 +575,13 @@ class RGBGenerator(Sequence):
                  input_size: Tuple[int, int]=(224, 224),
                  batch_size: int=32,
                  shuffle: bool=True,
-                 transforms: List[object]=None):
+                 transforms: List[object]=None,
+                 records: str=None,
+                 manifest: str=None,
+                 seed: int=None,
+                 decode_threads: int=None,
+                 decode_size: tuple=None,
+                 byte_cache_size: int=None):
         """ Generator for RGB images for the Imagenet dataset. The generator needs a folder with all the classes as well as the index file to generate the data.
 
         # Arguments
@@ -325,13 +591,21 @@ class RGBGenerator(Sequence):
             - batch_size: The size of the batches to be generated.
             - shuffle: If the batch should be shuffled.
             - transforms: The transformations to apply to the images. Use albumentations as transformations.
+            - records: The directory of the packed records of the dataset (see `scripts/pack_dataset.py`), or the path to the tar archive of the dataset (see `TarReader`). If set, the images are read from the records or the archive and the data directory is not used.
+            - manifest: Optional path to a manifest (.npz) of the images and labels of the data directory. Created at the first start, it avoids scanning the data directory at the next ones.
+            - seed: The seed of the permutations used to shuffle the images, drawn randomly if not set (see `Sampler`).
+            - decode_threads: The number of threads used to decode and transform the images of a batch concurrently, the images are processed sequentially if None or 1.
+            - decode_size: For the pipelines resizing the images to a known size (e.g: test and validation), the (height, width) of the target. The JPEG images are then decoded at the smallest scale (1/2, 1/4 or 1/8) at or above this size. Leave None for the pipelines cropping the images.
+            - byte_cache_size: The memory budget, in bytes, of a cache of the JPEG files shared by the worker processes (see `ByteCache`). When the dataset fits in the budget, the files are only read from the disk during the first epoch.
         """
         if input_size is None and batch_size is not 1:
             raise RuntimeError(
                 "The when input_size is None, the batch size should be one.")
         # Process the index dictionary to get the matching name/class_id
-        self.association, self.classes, self.images_path = prepare_imagenet(
-            index_file, data_directory)
+        self.reader = open_reader(records) if records is not None else None
+        self.association, self.classes, self.images_path, self.labels = prepare_imagenet(
+            index_file, data_directory, self.reader, manifest)
+        self.byte_cache = ByteCache(byte_cache_size, len(self.images_path)) if byte_cache_size else None
 
         # External data
         self._batch_size = batch_size
@@ -344,14 +618,13 @@ class RGBGenerator(Sequence):
         self.number_of_classes = len(self.classes)
 
         # Indexes for the images, will be used to generate the batches of data
-        self.indexes = np.arange(len(self.images_path))
+        self.sampler = Sampler(len(self.images_path), shuffle, seed)
+        self.decode_pool = DecodePool(decode_threads)
+        self.decode_size = decode_size
 
         # An epoch sees all the images
         self.batches_per_epoch = len(self.indexes) // self._batch_size
 
-        # Initialization of the first batch
-        self.on_epoch_end()
-
     @property
     def batch_size(self):
         return self._batch_size
@@ -375,8 +648,7 @@ class RGBGenerator(Sequence):
     @shuffle.setter
     def shuffle(self, value):
         self._shuffle = value
-        if self._shuffle == True:
-            np.random.shuffle(self.indexes)
+        self.sampler.shuffle = value
 
     def __len__(self):
         return self.batches_per_epoch
@@ -400,11 +672,99 @@ class RGBGenerator(Sequence):
 
         return X, y
 
+    @property
+    def indexes(self):
+        """ The indexes of the images, in the order of the current epoch. """
+        return self.sampler.indexes
+
+    def set_epoch(self, epoch: int):
+        """ Sets the order of the images to the one of the given epoch. The order only depends on the seed and the epoch, so copies of the generator in other processes stay consistent.
+
+        # Arguments:
+            - epoch: The epoch number.
+        """
+        self.sampler.set_epoch(epoch)
+
+    def set_shard(self, shard_index: int, number_of_shards: int, seed: int=None):
+        """ Restricts the generator to a shard of the images, e.g: the images of one Horovod rank. The shards are disjoint slices of the same permutation of the images for each epoch, all the shards must use the same seed.
+
+        # Arguments:
+            - shard_index: The index of the shard, e.g: `hvd.rank()`.
+            - number_of_shards: The number of shards, e.g: `hvd.size()`.
+            - seed: The seed of the permutations, shared by all the shards. The current seed is kept if not set.
+        """
+        self.sampler.set_shard(shard_index, number_of_shards, seed)
+        self.batches_per_epoch = len(self.indexes) // self._batch_size
+
+    def get_state(self):
+        """ Returns the state of the sampler (see `Sampler.get_state`), used to resume a training in the middle of an epoch. """
+        return self.sampler.get_state()
+
+    def set_state(self, state: dict):
+        """ Restores the state of the sampler (see `Sampler.set_state`), the batches then follow the order of the saved epoch.
+
+        # Arguments:
+            - state: The state to restore.
+        """
+        self.sampler.set_state(state)
+
     def on_epoch_end(self):
         """ Update function run by Keras at the end of each epoch. Will shuffle the images if shuffle was set as true.
         """
-        if self._shuffle == True:
-            np.random.shuffle(self.indexes)
+        self.set_epoch(self.sampler.epoch + 1)
+
+    def get_source(self, k: int):
+        """ Returns the bytes of the image k when reading from records or through the byte cache, its path otherwise. """
+        if self.byte_cache is not None:
+            return self.byte_cache.read(k, self._get_file)
+        return self._get_file(k)
+
+    def _get_file(self, k: int):
+        """ Returns the bytes of the image k when reading from records, its path otherwise. """
+        if self.reader is not None:
+            return self.reader.read(k)
+        return self.images_path[k]
+
+    def get_class_index(self, k: int):
+        """ Returns the index of the class of the image k. """
+        return int(self.labels[k])
+
+    def _load_image(self, k: int):
+        """ Loads the image k and applies the transformations. Called concurrently by the threads of the decode pool.
+
+        # Argument:
+            - k: The index of the image.
+
+        # Returns:
+            The transformed image, without the preprocessing.
+        """
+        if self.decode_size is not None:
+            # Decoded at a reduced resolution, the transformations bring it to the final size
+            img, _ = open_reduced_image(self.get_source(k), self.decode_size)
+        else:
+            img = open_image(self.get_source(k))
+        img = img.convert("RGB")
+        img = np.asarray(img)
+
+        # Apply the transformations if any, each thread applies its own copy
+        transforms = self.decode_pool.thread_copy(self.transforms)
+        if transforms:
+            for transform in transforms:
+                img = transform(image=img)['image']
+        return img
+
+    def get_sample(self, k: int):
+        """ Returns the inputs and the target of the image k, used by the pipelines working sample per sample (see `TFDataAdapter`).
+
+        # Argument:
+            - k: The index of the image.
+
+        # Returns:
+            Two values, the tuple of the inputs of the network and the one-hot encoded class.
+        """
+        y = np.zeros(self.number_of_classes, dtype=np.int32)
+        y[self.get_class_index(k)] = 1
+        return (preprocess_input(self._load_image(k)).astype(np.int32),), y
 
     def _data_generation(self, indexes):
         """ Internal function used to generate the batch of data.
@@ -421,34 +781,31 @@ class RGBGenerator(Sequence):
         y = np.zeros((self._batch_size, self.number_of_classes),
                      dtype=np.int32)
 
-        # iterate over the indexes to get the data points
-        for i, k in enumerate(indexes):
-
+        def fill(i, k):
             # Get the index of the class to set the label value
-            last_slash = self.images_path[k].rfind("/")
-            second_last_slash = self.images_path[k][:last_slash].rfind("/")
-            index_class = self.images_path[k][second_last_slash + 1:last_slash]
+            index_class = self.get_class_index(k)
 
             # Setting the target class to 1
-            y[i, int(self.association[index_class])] = 1
-
-            # Load the image
-            img = Image.open(self.images_path[k])
-            img = img.convert("RGB")
-            img = np.asarray(img)
+            y[i, index_class] = 1
 
-            # Apply the transformations if any
-            if self.transforms:
-                for transform in self.transforms:
-                    img = transform(image=img)['image']
+            img = self._load_image(k)
 
-            # If no input size, set the X matrix to the image size
+            # If no input size, the X matrix is created once the image size is known
             if self.input_size is None:
-                X = np.empty((self._batch_size, *img.shape), dtype=np.int32)
+                return img
 
             # Apply the usual preprocessing
             X[i] = preprocess_input(img)
 
+        # Decode the images of the batch concurrently, directly into the matrix
+        samples = self.decode_pool.map(lambda sample: fill(*sample), enumerate(indexes))
+
+        # If no input size, set the X matrix to the image size
+        if self.input_size is None:
+            for i, img in enumerate(samples):
+                X = np.empty((self._batch_size, *img.shape), dtype=np.int32)
+                X[i] = preprocess_input(img)
+
         return np.array(X), np.array(y)
 
     def get_raw_input_label(self, index):
@@ -476,15 +833,13 @@ class RGBGenerator(Sequence):
         for i, k in enumerate(indexes):
 
             # Get the index of the class to set the label value
-            last_slash = self.images_path[k].rfind("/")
-            second_last_slash = self.images_path[k][:last_slash].rfind("/")
-            index_class = self.images_path[k][second_last_slash + 1:last_slash]
+            index_class = self.get_class_index(k)
 
             # Setting the target class to 1
-            y[i, int(self.association[index_class])] = 1
+            y[i, index_class] = 1
 
             # Load the image
-            img = Image.open(self.images_path[k])
+            img = open_image(self.get_source(k))
             img = img.convert("RGB")
             img = np.asarray(img)
 
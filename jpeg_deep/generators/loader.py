@@ -0,0 +1,229 @@
+""" Multiprocess loader writing the batches in shared memory.
+
+With `fit_generator(workers=..., use_multiprocessing=True)`, every batch is pickled by the worker and unpickled by the
+training process. The loader instead pre-allocates a ring of batch slots in shared memory: the workers write the
+arrays of each batch directly into a free slot, and the training process gets views on the slot, without any copy.
+
+The workers receive (epoch, batch) tasks and set the epoch of their copy of the generator themselves (see `Sampler`),
+so the shuffling is consistent across the processes without any synchronisation.
+"""
+
+import sys
+import traceback
+import multiprocessing as mp
+
+from queue import Empty
+
+import numpy as np
+
+# Alignment of the arrays in the slots, in bytes
+ALIGNMENT = 64
+
+
+def _flatten(batch):
+    """ Flattens a batch (X, y) into a list of arrays and its structure, None if the batch is not made of arrays only. """
+    arrays, structure = [], []
+    for value in batch:
+        if isinstance(value, np.ndarray):
+            arrays.append(value)
+            structure.append(None)
+        elif isinstance(value, (list, tuple)) and all(isinstance(element, np.ndarray) for element in value):
+            arrays.extend(value)
+            structure.append(len(value))
+        else:
+            return None, None
+    return arrays, structure
+
+
+def _unflatten(arrays, structure):
+    """ Rebuilds the batch (X, y) from the list of arrays and the structure given by `_flatten`. """
+    batch, position = [], 0
+    for length in structure:
+        if length is None:
+            batch.append(arrays[position])
+            position += 1
+        else:
+            batch.append(arrays[position:position + length])
+            position += length
+    return tuple(batch)
+
+
+def _compute_layout(arrays):
+    """ Computes the (offset, shape, dtype) of each of the arrays in a slot and the size of the slot. """
+    layout, size = [], 0
+    for array in arrays:
+        layout.append((size, array.shape, array.dtype))
+        size += (array.nbytes + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+    return layout, size
+
+
+def _slot_views(buffer, slot: int, slot_size: int, layout):
+    """ Returns the numpy views on the arrays of a slot. """
+    memory = np.frombuffer(buffer, dtype=np.uint8)
+    views = []
+    for offset, shape, dtype in layout:
+        start = slot * slot_size + offset
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        views.append(memory[start:start + nbytes].view(dtype).reshape(shape))
+    return views
+
+
+def _worker_loop(generator, buffer, slot_size, layout, tasks, results, seed):
+    """ Loop of the worker processes: generates the requested batches and writes them into their slots. """
+    # Each worker gets its own random state for the random transformations
+    np.random.seed(seed % 2**32)
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        position, epoch, batch_index, slot = task
+        try:
+            generator.set_epoch(epoch)
+            batch = generator[batch_index]
+            arrays, structure = _flatten(batch)
+
+            fits = arrays is not None and layout is not None and len(arrays) == len(layout) and all(
+                array.shape == shape and array.dtype == dtype for array, (_, shape, dtype) in zip(arrays, layout))
+            if fits:
+                for view, array in zip(_slot_views(buffer, slot, slot_size, layout), arrays):
+                    view[...] = array
+                results.put((position, structure, None, None))
+            else:
+                # The batch does not fit the slot (e.g: variable image size), it is sent through the queue
+                results.put((position, None, batch, None))
+        except Exception:
+            results.put((position, None, None, traceback.format_exc()))
+
+
+class SharedMemoryLoader(object):
+    def __init__(self,
+                 generator: object,
+                 workers: int=4,
+                 slots: int=None,
+                 initial_epoch: int=0,
+                 timeout: float=600,
+                 initial_batch: int=0):
+        """ Loads the batches of a generator with several processes, through a ring of pre-allocated slots in shared memory.
+        Works with all the generators of `jpeg_deep.generators`. The layout of the slots is inferred from the first batch,
+        the batches with a different layout (e.g: images of variable size) are sent through a queue instead.
+
+        The loader is an infinite iterator, to be used with `fit_generator(loader, steps_per_epoch=len(loader), workers=0)`.
+        The arrays returned are views on the shared memory: they are valid until the next batch is requested.
+
+        # Arguments:
+            - generator: The generator to load the batches from (must implement `set_epoch`).
+            - workers: The number of worker processes.
+            - slots: The number of batches that can be prepared in advance, twice the number of workers by default.
+            - initial_epoch: The epoch to start from.
+            - timeout: The maximum time to wait for a batch, in seconds.
+            - initial_batch: The batch of the initial epoch to start from, to resume a training in the middle of an epoch. The previous batches are skipped without being loaded.
+        """
+        self.generator = generator
+        self.workers = workers
+        self.slots = slots if slots is not None else 2 * workers
+        self.timeout = timeout
+        self.steps_per_epoch = len(generator)
+        self.epoch = initial_epoch
+
+        # The layout of the slots is given by the first batch
+        self.generator.set_epoch(initial_epoch)
+        arrays, _ = _flatten(generator[0])
+        if arrays is not None:
+            self.layout, self.slot_size = _compute_layout(arrays)
+        else:
+            print("The batches are not made of arrays only, they will be sent through a queue.", file=sys.stderr)
+            self.layout, self.slot_size = None, 0
+        self.buffer = mp.RawArray("b", max(self.slot_size * self.slots, 1))
+
+        # The workers are forked to get a copy of the generator without pickling it
+        context = mp.get_context("fork")
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        seed = int(np.random.randint(0, 2**31 - 1))
+        self.processes = [context.Process(target=_worker_loop,
+                                          args=(generator, self.buffer, self.slot_size, self.layout,
+                                                self.tasks, self.results, seed + i),
+                                          daemon=True)
+                          for i in range(workers)]
+        for process in self.processes:
+            process.start()
+
+        # Position in the stream of batches, of the next batch to submit and of the next batch to return
+        self._submitted = initial_epoch * self.steps_per_epoch + initial_batch
+        self._position = self._submitted
+        self._free_slots = list(range(self.slots))
+        self._slot_of = {}
+        self._ready = {}
+        self._released = None
+
+        for _ in range(self.slots):
+            self._submit()
+
+    def __len__(self):
+        return self.steps_per_epoch
+
+    def __iter__(self):
+        return self
+
+    def _submit(self):
+        """ Submits the next batch of the stream in a free slot. """
+        slot = self._free_slots.pop()
+        epoch, batch_index = divmod(self._submitted, self.steps_per_epoch)
+        self._slot_of[self._submitted] = slot
+        self.tasks.put((self._submitted, epoch, batch_index, slot))
+        self._submitted += 1
+
+    def __next__(self):
+        # The slot of the previous batch can be reused, the previous views must not be used anymore
+        if self._released is not None:
+            self._free_slots.append(self._released)
+            self._released = None
+            self._submit()
+
+        position = self._position
+        while position not in self._ready:
+            try:
+                result = self.results.get(timeout=self.timeout)
+            except Empty:
+                if not all(process.is_alive() for process in self.processes):
+                    raise RuntimeError("A worker of the loader died unexpectedly.")
+                raise RuntimeError(
+                    "No batch received from the workers after {} seconds.".format(self.timeout))
+            self._ready[result[0]] = result[1:]
+
+        structure, batch, error = self._ready.pop(position)
+        slot = self._slot_of.pop(position)
+        if error is not None:
+            self._free_slots.append(slot)
+            self._submit()
+            raise RuntimeError(
+                "A worker of the loader failed to generate a batch:\n{}".format(error))
+
+        # Keep the generator of the main process at the same epoch as the workers
+        epoch = position // self.steps_per_epoch
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.generator.set_epoch(epoch)
+
+        self._position += 1
+        self._released = slot
+        if batch is not None:
+            return batch
+        return _unflatten(_slot_views(self.buffer, slot, self.slot_size, self.layout), structure)
+
+    def close(self):
+        """ Stops the workers. """
+        for _ in self.processes:
+            self.tasks.put(None)
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        self.processes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
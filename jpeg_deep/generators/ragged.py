@@ -0,0 +1,57 @@
+""" Ragged storage for the per-image labels of the detection datasets.
+
+All the values (e.g: the boxes of all the images) are stored in a single flat numpy array, and the values of the
+image i are the rows `offsets[i]:offsets[i + 1]`. Compared to nested Python lists, this removes the `deepcopy` and
+list to array conversion of each sample, and keeps the memory compact.
+"""
+
+from typing import List
+
+import numpy as np
+
+
+class RaggedArray(object):
+    def __init__(self, values: np.ndarray, offsets: np.ndarray):
+        """ Ragged array, i.e: a list of arrays with a variable number of rows stored in a single flat array.
+
+        # Arguments:
+            - values: The rows of all the elements, concatenated along the first axis.
+            - offsets: The offset of the first row of each element in `values`, len(elements) + 1 values.
+        """
+        self.values = values
+        self.offsets = offsets
+
+    @classmethod
+    def from_lists(cls, elements: List, dtype: object=np.float32, shape: tuple=(5,)):
+        """ Creates a ragged array from a list of elements (e.g: the list of the boxes of each image).
+
+        # Arguments:
+            - elements: The list of elements, each one being a list (or array) of rows.
+            - dtype: The type of the values.
+            - shape: The shape of each of the rows, e.g: (5,) for boxes in the format [class_id, xmin, ymin, xmax, ymax], () for flags.
+
+        # Returns:
+            The ragged array.
+        """
+        offsets = np.zeros(len(elements) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(element) for element in elements])
+        values = np.empty((offsets[-1], *shape), dtype=dtype)
+        for i, element in enumerate(elements):
+            if len(element) > 0:
+                values[offsets[i]:offsets[i + 1]] = element
+        return cls(values, offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int):
+        """ Returns a copy of the rows of the element i, which can safely be modified by the transformations. """
+        return np.array(self.values[self.offsets[i]:self.offsets[i + 1]])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def lengths(self):
+        """ Returns the number of rows of each element. """
+        return np.diff(self.offsets)
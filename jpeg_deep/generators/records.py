@@ -0,0 +1,200 @@
+""" Packed record format for the datasets.
+
+The JPEG files are concatenated (untouched) into large shard files. An index in numpy format stores for each
+image the shard, offset and length of its bytes, its label (e.g: the class index for ImageNet, -1 if unused)
+and its file name. Reading an image is then a single `pread` in an already opened file, instead of the
+directory scan and the `open` per image required by a tree of small files.
+"""
+
+import os
+import sys
+
+from os.path import join, basename
+from typing import List, Tuple
+
+import numpy as np
+
+from tqdm import tqdm
+
+INDEX_FILE = "index.npz"
+SHARD_FILE = "shard_{:05d}.bin"
+
+
+def encode_strings(strings: List[str]):
+    """ Encodes a list of strings as a contiguous utf-8 blob and offsets.
+
+    # Arguments:
+        - strings: The list of strings to encode.
+
+    # Returns:
+        Two numpy arrays, the blob (uint8) and the offsets (int64, len(strings) + 1 values).
+    """
+    encoded = [string.encode("utf-8") for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(string) for string in encoded])
+    blob = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+    return blob, offsets
+
+
+def decode_string(blob: np.ndarray, offsets: np.ndarray, i: int):
+    """ Decodes the string i of a blob created with `encode_strings`. """
+    return blob[offsets[i]:offsets[i + 1]].tobytes().decode("utf-8")
+
+
+class StringArray(object):
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray):
+        """ Compact, read-only list of strings stored as a single contiguous blob with offsets. Unlike a list of Python
+        strings, it holds two numpy arrays only, so the memory pages are not copied by the reference counting in
+        forked workers.
+
+        # Arguments:
+            - blob: The utf-8 encoded strings, concatenated (see `encode_strings`).
+            - offsets: The offsets of the strings in the blob, len(strings) + 1 values.
+        """
+        self.blob = blob
+        self.offsets = offsets
+
+    @classmethod
+    def from_list(cls, strings: List[str]):
+        """ Creates the array from a list of strings. """
+        return cls(*encode_strings(strings))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int):
+        return decode_string(self.blob, self.offsets, i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def pack_records(output_directory: str,
+                 samples: List[Tuple[str, int]],
+                 classes: List[str]=None,
+                 shard_size: int=2**30):
+    """ Packs the files of a dataset into shards, and writes the index.
+
+    # Arguments:
+        - output_directory: The directory where to write the shards and the index.
+        - samples: A list of tuples (path, label), use -1 as label if not relevant.
+        - classes: The list of class names if relevant, saved in the index.
+        - shard_size: The approximate size of each shard in bytes.
+    """
+    os.makedirs(output_directory, exist_ok=True)
+
+    n_samples = len(samples)
+    offsets = np.zeros(n_samples, dtype=np.int64)
+    lengths = np.zeros(n_samples, dtype=np.int64)
+    shards = np.zeros(n_samples, dtype=np.int32)
+    labels = np.array([label for _, label in samples], dtype=np.int64)
+
+    shard, position = 0, 0
+    output = open(join(output_directory, SHARD_FILE.format(shard)), "wb")
+    for i, (path, _) in enumerate(tqdm(samples, desc="Packing the dataset", file=sys.stdout)):
+        with open(path, "rb") as image:
+            data = image.read()
+
+        if position > 0 and position + len(data) > shard_size:
+            output.close()
+            shard, position = shard + 1, 0
+            output = open(join(output_directory, SHARD_FILE.format(shard)), "wb")
+
+        output.write(data)
+        shards[i] = shard
+        offsets[i] = position
+        lengths[i] = len(data)
+        position += len(data)
+    output.close()
+
+    names_blob, names_offsets = encode_strings(
+        [basename(path) for path, _ in samples])
+    classes_blob, classes_offsets = encode_strings(classes or [])
+
+    np.savez(join(output_directory, INDEX_FILE),
+             offsets=offsets,
+             lengths=lengths,
+             shards=shards,
+             labels=labels,
+             names_blob=names_blob,
+             names_offsets=names_offsets,
+             classes_blob=classes_blob,
+             classes_offsets=classes_offsets)
+
+
+class RecordReader(object):
+    def __init__(self, directory: str):
+        """ Reader for the datasets packed with `pack_records` (see `scripts/pack_dataset.py`). The shards are opened lazily in
+        each process and read with `os.pread`, which makes the reader safe to share with forked workers.
+
+        # Arguments:
+            - directory: The directory containing the shards and the index.
+        """
+        self.directory = directory
+        self.index_path = join(directory, INDEX_FILE)
+
+        with np.load(self.index_path) as index:
+            self.offsets = index["offsets"]
+            self.lengths = index["lengths"]
+            self.shards = index["shards"]
+            self.labels = index["labels"]
+            self.names = StringArray(index["names_blob"], index["names_offsets"])
+            classes_blob = index["classes_blob"]
+            classes_offsets = index["classes_offsets"]
+
+        self.classes = list(StringArray(classes_blob, classes_offsets))
+
+        self._descriptors = {}
+        self._pid = None
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getstate__(self):
+        # The file descriptors are not transferred to other processes
+        state = self.__dict__.copy()
+        state["_descriptors"] = {}
+        state["_pid"] = None
+        return state
+
+    def _descriptor(self, shard: int):
+        """ Returns the file descriptor of a shard, opening it if required. """
+        if self._pid != os.getpid():
+            self._descriptors = {}
+            self._pid = os.getpid()
+        if shard not in self._descriptors:
+            self._descriptors[shard] = os.open(
+                join(self.directory, SHARD_FILE.format(shard)), os.O_RDONLY)
+        return self._descriptors[shard]
+
+    def read(self, i: int):
+        """ Returns the bytes of the file i.
+
+        # Arguments:
+            - i: The index of the file in the records.
+
+        # Returns:
+            The content of the file, as bytes.
+        """
+        return os.pread(self._descriptor(int(self.shards[i])), int(self.lengths[i]), int(self.offsets[i]))
+
+    def name(self, i: int):
+        """ Returns the name of the file i. """
+        return self.names[i]
+
+    def lookup(self, paths: List[str]):
+        """ Returns the index in the records of each of the paths, the files are matched on their names.
+
+        # Arguments:
+            - paths: The list of paths to look for.
+
+        # Returns:
+            A numpy array with the index of each of the paths.
+        """
+        indexes = {name: i for i, name in enumerate(self.names)}
+        try:
+            return np.array([indexes[basename(path)] for path in paths], dtype=np.int64)
+        except KeyError as error:
+            raise KeyError(
+                "The file {} is missing from the records in {}.".format(error, self.directory))
@@ -0,0 +1,157 @@
+""" Resuming a training in the middle of an epoch.
+
+`ResumeCheckpoint` regularly saves the model with the state of the sampler of the training generator (seed, epoch and
+number of batches already used). On restart, the state is restored and the batches already used in the interrupted
+epoch are skipped by `SkipBatches`, without loading them, the training then continues into the following epochs.
+
+The epochs of the sampler and the epochs of Keras differ when `steps_per_epoch` is not the length of the generator, the
+checkpoint saves both positions: the sampler one gives the batches to skip, the Keras one the epoch to restart from.
+"""
+
+import os
+import json
+
+from copy import copy, deepcopy
+from os.path import join, isfile
+
+from keras.callbacks import Callback
+from keras.utils import Sequence
+
+RESUME_STATE_FILE = "sampler_state.json"
+
+
+def load_resume_state(directory: str):
+    """ Loads the state saved by a `ResumeCheckpoint`.
+
+    # Arguments:
+        - directory: The directory of the checkpoint.
+
+    # Returns:
+        The state of the sampler, with the name of the file of the model in the directory under the key "model". None if there is no checkpoint in the directory.
+    """
+    if not isfile(join(directory, RESUME_STATE_FILE)):
+        return None
+    with open(join(directory, RESUME_STATE_FILE)) as state_file:
+        state = json.load(state_file)
+    if not isfile(join(directory, state["model"])):
+        return None
+    return state
+
+
+class SkipBatches(Sequence):
+    def __init__(self, generator: Sequence, skip: int, steps: int=None):
+        """ Gives the batches of a generator from the batch `skip` of its current epoch, then the batches of the following
+        epochs of the sampler, as an uninterrupted training would. The skipped batches are never loaded, the other ones
+        are the same as the ones of the generator.
+
+        Each epoch of the sampler is read from a copy of the generator with its own sampler, so that the batches of two
+        epochs can be loaded at the same time by the workers. The generator itself is not modified.
+
+        # Arguments:
+            - generator: The generator (must have a `sampler`), set to the epoch to continue.
+            - skip: The number of batches of the epoch to skip.
+            - steps: The number of batches given by each pass over the sequence, `len(generator)` if not set. The next pass continues from the end of the previous one.
+        """
+        if not 0 <= skip < len(generator):
+            raise ValueError("The number of batches to skip should be in [0, {}), got {}.".format(len(generator), skip))
+        self.generator = generator
+        self.epoch = generator.sampler.epoch
+        self.skip = skip
+        self.steps = steps if steps is not None else len(generator)
+        self._generators = {}
+
+    def _generator_at(self, epoch: int):
+        """ Returns a copy of the generator set to an epoch, sharing everything but the sampler. """
+        if epoch not in self._generators:
+            generator = copy(self.generator)
+            generator.sampler = deepcopy(self.generator.sampler)
+            generator.set_epoch(epoch)
+            self._generators[epoch] = generator
+        return self._generators[epoch]
+
+    def __len__(self):
+        return self.steps
+
+    def __getitem__(self, index: int):
+        epoch, batch = divmod(self.skip + index, len(self.generator))
+        return self._generator_at(self.epoch + epoch)[batch]
+
+    def on_epoch_end(self):
+        # The batches of the pass are all loaded, the next pass starts where this one ended
+        epochs, self.skip = divmod(self.skip + self.steps, len(self.generator))
+        self.epoch += epochs
+        self._generators = {}
+
+
+class ResumeCheckpoint(Callback):
+    def __init__(self, directory: str, generator: object, period: int=1000, initial_epoch: int=0, initial_batch: int=0):
+        """ Saves the model and the state of the sampler of the training generator every `period` batches and at the end
+        of each epoch, to resume the training from the last saved batch (see `scripts/training.py --restart`). The
+        batches have to be used in the order of the generator, i.e: `fit_generator(..., shuffle=False)`.
+
+        The position of the sampler is the one of the generator when the callback is created (see `set_state`), it then
+        follows the batches used, the sampler moving to its next epoch after `len(generator)` batches.
+
+        # Arguments:
+            - directory: The directory in which the checkpoint is saved, the previous checkpoint is replaced.
+            - generator: The training generator (must implement `get_state`).
+            - period: The number of batches between two checkpoints.
+            - initial_epoch: The epoch of Keras the training starts from.
+            - initial_batch: The batch of the initial epoch of Keras the training starts from.
+        """
+        super(ResumeCheckpoint, self).__init__()
+        self.directory = directory
+        self.generator = generator
+        self.period = period
+        self.epoch = initial_epoch
+        self.batch = initial_batch
+        os.makedirs(directory, exist_ok=True)
+
+        # The epoch of the sampler and the number of batches of this epoch already used
+        state = generator.get_state()
+        self.sampler_epoch = state["epoch"]
+        self.sampler_cursor = state["cursor"]
+
+        # The model of the previous checkpoint, deleted once replaced
+        previous_state = load_resume_state(directory)
+        self._model_file = previous_state["model"] if previous_state is not None else None
+
+    def save(self):
+        """ Saves the model, then the state pointing to it. The state always points to a complete model, even if the
+        process is killed while saving. """
+        model_file = "model_epoch-{:03d}_batch-{:06d}.h5".format(self.epoch, self.batch)
+        self.model.save(join(self.directory, model_file))
+
+        # The generator of the main process may be ahead of the batches used (e.g: prefetched by the enqueuer), only its
+        # seed is kept
+        state = self.generator.get_state()
+        state.update(epoch=self.sampler_epoch, cursor=self.sampler_cursor,
+                     keras_epoch=self.epoch, keras_batch=self.batch, model=model_file)
+        temporary_state = join(self.directory, "{}.tmp".format(RESUME_STATE_FILE))
+        with open(temporary_state, "w") as state_file:
+            json.dump(state, state_file)
+        os.replace(temporary_state, join(self.directory, RESUME_STATE_FILE))
+
+        if self._model_file is not None and self._model_file != model_file and isfile(join(self.directory, self._model_file)):
+            os.remove(join(self.directory, self._model_file))
+        self._model_file = model_file
+
+    def on_epoch_begin(self, epoch, logs=None):
+        # The epoch following the saved one starts from its first batch
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.batch = 0
+
+    def on_batch_end(self, batch, logs=None):
+        self.batch += 1
+        self.sampler_cursor += 1
+        if self.sampler_cursor >= len(self.generator):
+            self.sampler_epoch += 1
+            self.sampler_cursor = 0
+        if self.batch % self.period == 0:
+            self.save()
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.epoch = epoch + 1
+        self.batch = 0
+        self.save()
@@ -0,0 +1,194 @@
+""" Order of the images for each epoch.
+
+The permutation of an epoch only depends on the seed and the epoch number. Any process holding a copy of the
+generator (e.g: the workers of a loader) gets the same order by setting the same epoch, without sharing any state.
+
+In distributed training, all the ranks use the same seed and each of them takes a disjoint shard of the permutation.
+
+The state of a sampler (seed, epoch and number of batches already used in the epoch) can be saved and restored to
+resume a training in the middle of an epoch (see `ResumeCheckpoint`).
+"""
+
+import numpy as np
+
+
+class Sampler(object):
+    def __init__(self, number_of_samples: int, shuffle: bool=True, seed: int=None):
+        """ Gives the order in which the images are used for each epoch.
+
+        # Arguments:
+            - number_of_samples: The number of images in the dataset.
+            - shuffle: If the images should be shuffled, the order is the natural order otherwise.
+            - seed: The seed of the permutations, drawn randomly if not set.
+        """
+        self.number_of_samples = number_of_samples
+        self._shuffle = shuffle
+        self.seed = seed if seed is not None else int(
+            np.random.randint(0, 2**31 - 1))
+        self.epoch = 0
+        # The number of batches of the current epoch already used, set when a state is restored
+        self.cursor = 0
+        self.shard_index = 0
+        self.number_of_shards = 1
+        self._indexes = None
+
+    @property
+    def shuffle(self):
+        return self._shuffle
+
+    @shuffle.setter
+    def shuffle(self, value):
+        self._shuffle = value
+        self._indexes = None
+
+    def set_epoch(self, epoch: int):
+        """ Sets the current epoch, the indexes are recomputed when accessed.
+
+        # Arguments:
+            - epoch: The epoch number.
+        """
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.cursor = 0
+            self._indexes = None
+
+    def get_state(self):
+        """ Returns the state of the sampler, a dictionary that can be serialized to json.
+
+        # Returns:
+            The dictionary with the seed, the epoch and the cursor (the number of batches already used in the epoch).
+        """
+        return {"seed": int(self.seed), "epoch": int(self.epoch), "cursor": int(self.cursor)}
+
+    def set_state(self, state: dict):
+        """ Restores a state given by `get_state`, the order of the images is then the one of the saved epoch.
+
+        # Arguments:
+            - state: The state to restore.
+        """
+        self.seed = state["seed"]
+        self.epoch = state["epoch"]
+        self.cursor = state.get("cursor", 0)
+        self._indexes = None
+
+    def set_shard(self, shard_index: int, number_of_shards: int, seed: int=None):
+        """ Restricts the sampler to one shard of the images, e.g: the images of one rank in distributed training. The
+        shards are disjoint and of the same size, the images left over are skipped for the epoch.
+
+        # Arguments:
+            - shard_index: The index of the shard, e.g: the rank.
+            - number_of_shards: The number of shards, e.g: the number of ranks.
+            - seed: The seed of the permutations, has to be the same for all the shards. The current seed is kept if not set.
+        """
+        if not 0 <= shard_index < number_of_shards:
+            raise ValueError("The index of the shard should be in [0, {}), got {}.".format(
+                number_of_shards, shard_index))
+        self.shard_index = shard_index
+        self.number_of_shards = number_of_shards
+        if seed is not None:
+            self.seed = seed
+        self._indexes = None
+
+    def _shard(self, values):
+        """ Returns the part of the values belonging to the shard of the sampler. """
+        if self.number_of_shards == 1:
+            return values
+        shard_size = len(values) // self.number_of_shards
+        return values[self.shard_index:shard_size * self.number_of_shards:self.number_of_shards]
+
+    @property
+    def indexes(self):
+        """ The indexes of the images, in the order of the current epoch. """
+        if self._indexes is None:
+            if self._shuffle:
+                random_state = np.random.RandomState([self.seed, self.epoch])
+                indexes = random_state.permutation(
+                    self.number_of_samples)
+            else:
+                indexes = np.arange(self.number_of_samples)
+            self._indexes = self._shard(indexes)
+        return self._indexes
+
+
+class BucketSampler(Sampler):
+    def __init__(self, sizes: np.ndarray, batch_size: int, shuffle: bool=True, seed: int=None, bucket_step: int=2):
+        """ Groups the images of similar sizes into buckets, and gives the batches of each epoch. All the images of a batch
+        come from the same bucket, they can be padded to a common size with little waste.
+
+        The buckets are defined by rounding up the size of the images to a multiple of `bucket_step`. With shuffling, the
+        images are shuffled within each bucket and the order of the batches is shuffled, the number of batches of an epoch
+        stays the same.
+
+        # Arguments:
+            - sizes: The (height, width) of each of the images, in blocks of the luminance.
+            - batch_size: The maximum number of images per batch, the last batch of a bucket may be smaller.
+            - shuffle: If the images should be shuffled, the batches follow the natural order within the buckets otherwise.
+            - seed: The seed of the permutations, drawn randomly if not set.
+            - bucket_step: The step, in blocks of the luminance, between the sizes of two buckets. The images are padded by less than `bucket_step` blocks in each dimension.
+        """
+        super(BucketSampler, self).__init__(len(sizes), shuffle, seed)
+        self.sizes = np.asarray(sizes, dtype=np.int64).reshape(-1, 2)
+        self._batch_size = batch_size
+        self.bucket_step = bucket_step
+
+        # Images of the same bucket have the same rounded up size, stable to keep the natural order in the buckets
+        keys = -(-self.sizes // bucket_step)
+        order = np.lexsort((keys[:, 1], keys[:, 0]))
+        starts = np.flatnonzero(np.any(np.diff(keys[order], axis=0) != 0, axis=1)) + 1
+        self.buckets = np.split(order, starts) if len(order) > 0 else []
+        self._batches = None
+
+    @property
+    def batch_size(self):
+        return self._batch_size
+
+    @batch_size.setter
+    def batch_size(self, value):
+        self._batch_size = value
+        self._batches = None
+
+    @Sampler.shuffle.setter
+    def shuffle(self, value):
+        Sampler.shuffle.fset(self, value)
+        self._batches = None
+
+    def set_epoch(self, epoch: int):
+        if epoch != self.epoch:
+            self._batches = None
+        super(BucketSampler, self).set_epoch(epoch)
+
+    def set_state(self, state: dict):
+        super(BucketSampler, self).set_state(state)
+        self._batches = None
+
+    def set_shard(self, shard_index: int, number_of_shards: int, seed: int=None):
+        """ Restricts the sampler to one shard of the batches (see `Sampler.set_shard`). """
+        super(BucketSampler, self).set_shard(shard_index, number_of_shards, seed)
+        self._batches = None
+
+    def __len__(self):
+        number_of_batches = int(sum(-(-len(bucket) // self._batch_size) for bucket in self.buckets))
+        return number_of_batches // self.number_of_shards
+
+    @property
+    def batches(self):
+        """ The indexes of the images of each batch, in the order of the current epoch. """
+        if self._batches is None:
+            random_state = np.random.RandomState([self.seed, self.epoch]) if self._shuffle else None
+            batches = []
+            for bucket in self.buckets:
+                if random_state is not None:
+                    bucket = bucket[random_state.permutation(len(bucket))]
+                batches.extend(bucket[start:start + self._batch_size]
+                               for start in range(0, len(bucket), self._batch_size))
+            if random_state is not None:
+                batches = [batches[i] for i in random_state.permutation(len(batches))]
+            self._batches = self._shard(batches)
+        return self._batches
+
+    @property
+    def indexes(self):
+        """ The indexes of the images, in the order of the batches of the current epoch. """
+        if self._indexes is None:
+            self._indexes = np.concatenate(self.batches) if self.batches else np.zeros(0, dtype=np.int64)
+        return self._indexes
@@ -0,0 +1,133 @@
+""" Adapter exposing the generators as a `tf.data.Dataset`.
+
+The images are loaded one by one by the `get_sample` method of the generators, called through `tf.numpy_function` in a
+parallel `map`. The batches are then assembled and prefetched by the TensorFlow runtime, in background threads, while
+the model trains on the previous ones. The threads of TensorFlow each apply their own copy of the transformations (see
+`DecodePool.thread_copy`), as the transformations store the parameters they draw.
+"""
+
+import numpy as np
+
+import tensorflow as tf
+import keras.backend as K
+
+
+class TFDataAdapter(object):
+    def __init__(self,
+                 generator: object,
+                 parallel_calls: int=4,
+                 prefetch: int=2,
+                 initial_epoch: int=0,
+                 initial_batch: int=0):
+        """ Exposes a generator as a `tf.data.Dataset`. Works with all the generators of `jpeg_deep.generators` that
+        produce inputs of a fixed size. The structure of the samples (types and shapes) is inferred from the first one.
+
+        The dataset is available in the `dataset` attribute. The adapter itself is an infinite iterator over the batches,
+        to be used with `fit_generator(adapter, steps_per_epoch=len(adapter), workers=0)`.
+
+        # Arguments:
+            - generator: The generator to adapt (must implement `get_sample` and `set_epoch`).
+            - parallel_calls: The number of images loaded in parallel, by the threads of TensorFlow.
+            - prefetch: The number of batches prepared in advance.
+            - initial_epoch: The epoch to start from.
+            - initial_batch: The batch of the initial epoch to start from, to resume a training in the middle of an epoch. The previous images are skipped without being loaded.
+        """
+        # The samples are loaded concurrently, the transformations can only be shared through per-thread copies
+        if parallel_calls > 1 and not hasattr(generator, "decode_pool"):
+            raise ValueError(
+                "The generator does not copy its transformations for each thread, use parallel_calls=1.")
+        self.generator = generator
+        self.batch_size = generator.batch_size
+        self.steps_per_epoch = len(generator)
+        self.epoch = initial_epoch
+        self.initial_batch = initial_batch
+
+        # The structure of the samples is given by the first one
+        self.generator.set_epoch(initial_epoch)
+        inputs, target = None, None
+        for k in self.generator.indexes:
+            inputs, target = self.generator.get_sample(int(k))
+            if inputs is not None:
+                break
+        if inputs is None:
+            raise RuntimeError("The generator did not produce any sample.")
+        self.number_of_inputs = len(inputs)
+        self.dtypes = [array.dtype for array in (*inputs, target)]
+        self.shapes = [array.shape for array in (*inputs, target)]
+
+        self.dataset = self.build_dataset(parallel_calls, prefetch)
+        self._next_batch = None
+
+    def __len__(self):
+        return self.steps_per_epoch
+
+    def __iter__(self):
+        return self
+
+    def _index_stream(self):
+        """ Yields the indexes of the images, epoch after epoch, in the order given by the generator. """
+        epoch = self.epoch
+        number_of_samples = self.steps_per_epoch * self.batch_size
+        start = self.initial_batch * self.batch_size
+        while True:
+            self.generator.set_epoch(epoch)
+            for k in self.generator.indexes[start:number_of_samples]:
+                yield k
+            epoch += 1
+            start = 0
+
+    def _load_sample(self, k):
+        """ Loads the sample k, returns if it is valid followed by its arrays. """
+        inputs, target = self.generator.get_sample(int(k))
+        if inputs is None:
+            return [np.array(False)] + [np.zeros(shape, dtype=dtype) for shape, dtype in zip(self.shapes, self.dtypes)]
+
+        arrays = [np.asarray(array, dtype=dtype) for array, dtype in zip((*inputs, target), self.dtypes)]
+        if any(array.shape != shape for array, shape in zip(arrays, self.shapes)):
+            raise ValueError(
+                "The samples should all have the same shape to be batched, image {} has a different shape.".format(k))
+        return [np.array(True)] + arrays
+
+    def _map_sample(self, k):
+        """ Graph function loading a sample through `tf.numpy_function`. """
+        values = tf.numpy_function(self._load_sample, [k], [tf.bool] + [tf.as_dtype(dtype) for dtype in self.dtypes])
+        values[0].set_shape(())
+        for value, shape in zip(values[1:], self.shapes):
+            value.set_shape(shape)
+        return tuple(values)
+
+    def _split_batch(self, *arrays):
+        """ Graph function splitting the arrays of a batch into the inputs and the target. """
+        inputs = arrays[:self.number_of_inputs]
+        return (inputs[0] if self.number_of_inputs == 1 else inputs), arrays[-1]
+
+    def build_dataset(self, parallel_calls: int=4, prefetch: int=2):
+        """ Builds the dataset of the batches.
+
+        # Arguments:
+            - parallel_calls: The number of images loaded in parallel.
+            - prefetch: The number of batches prepared in advance.
+
+        # Returns:
+            The `tf.data.Dataset` of the (inputs, target) batches.
+        """
+        dataset = tf.data.Dataset.from_generator(
+            self._index_stream, tf.int64, tf.TensorShape([]))
+        dataset = dataset.map(self._map_sample, num_parallel_calls=parallel_calls)
+
+        # The images for which a transformation failed are skipped
+        dataset = dataset.filter(lambda valid, *arrays: valid)
+        dataset = dataset.map(lambda valid, *arrays: arrays)
+
+        dataset = dataset.batch(self.batch_size, drop_remainder=True)
+        dataset = dataset.map(self._split_batch)
+        return dataset.prefetch(prefetch)
+
+    def __next__(self):
+        if self._next_batch is None:
+            self._next_batch = tf.compat.v1.data.make_one_shot_iterator(
+                self.dataset).get_next()
+        inputs, target = K.get_session().run(self._next_batch)
+        if isinstance(inputs, tuple):
+            inputs = list(inputs)
+        return inputs, target
@@ -1,24 +1,19 @@
-import sys
-
 from os.path import join
 
-from copy import deepcopy
-from io import BytesIO
 from typing import List
-from random import shuffle
+from functools import partial
 
 import numpy as np
 
-from PIL import Image
-
-from tqdm import tqdm
-
-from jpeg2dct.numpy import load, loads
-
 from keras.applications.vgg16 import preprocess_input
+from keras.utils import Sequence
 
 from .helper_ssd import BoxFilter
-from .helper import parse_xml_voc
+from .dct_cache import DCTCache
+from .archives import open_reader
+from .byte_cache import ByteCache
+from .sampler import Sampler
+from .helper import parse_voc_annotations, DEFAULT_CACHE_DIRECTORY, is_dct_pipeline, load_dct, encode_dct, open_image, DecodePool, open_reduced_image, select_coefficients
 
 
 class DegenerateBatchError(Exception):
@@ -37,7 +32,7 @@ class DatasetError(Exception):
     pass
 
 
-class VOCGenerator(object):
+class VOCGenerator(Sequence):
 
     def __init__(self,
                  images_path: List[str],
@@ -50,7 +45,14 @@ class VOCGenerator(object):
                  only_y: bool=False,
                  train_mode: bool = True,
                  labels_output_format: List[str] = (
-                     'class_id', 'xmin', 'ymin', 'xmax', 'ymax')):
+                     'class_id', 'xmin', 'ymin', 'xmax', 'ymax'),
+                 cache_directory: str=None,
+                 records: str=None,
+                 seed: int=None,
+                 decode_threads: int=None,
+                 decode_size: tuple=None,
+                 n_coefficients: int=64,
+                 byte_cache_size: int=None):
         '''
         Generator for the Pascal VOC dataset.
 
@@ -59,12 +61,19 @@ class VOCGenerator(object):
             - batch_size: The size of the batch to be return by the generator.
             - shuffle: If the images should be shuffle on epoch end.
             - label_encoder: Object to encode the label in the SSD format.
-            - transforms: The transformations to apply to the images.
+            - transforms: The transformations to apply to the images. If `dct` is set and there is no transformation, or if all the transformations are DCT transformations (see `jpeg_deep.transformations.dct_operations`), the coefficients are read from the original files and the images are never decoded (unless they are not 4:2:0).
             - dct: If the generator should return the DCT encoded images.
             - mode: The mode of the generator, `train` or `test`, in test mode, the generator will ignore the labels.
             - split_cbcr: If the Cb and Cr inputs should be split in two arrays.
             - only_y: If only the Y component should be returned.
             - labels_output_format: The format of the output (leave as is).
+            - cache_directory: If set (requires `dct`), the output of the deterministic transformations is cached as memory-mapped shards in this directory, the remaining transformations should be DCT transformations. Use for the validation/test pipelines, e.g: `[ConvertTo3Channels(), Resize(300, 300)]`.
+            - records: The directory of the packed records containing the images (see `scripts/pack_dataset.py`), or the path to a tar archive of the images (see `TarReader`). If set, the images are read from the records, matched on their file names.
+            - seed: The seed of the permutations used to shuffle the images, drawn randomly if not set (see `Sampler`).
+            - decode_threads: The number of threads used to decode and transform the images of a batch concurrently, the images are processed sequentially if None or 1.
+            - decode_size: For the pipelines resizing the images to a known size (e.g: test and validation), the (height, width) of the target. The JPEG images are then decoded at the smallest scale (1/2, 1/4 or 1/8) at or above this size, and the boxes are rescaled accordingly. Leave None for the pipelines cropping the images.
+            - n_coefficients: The number of DCT coefficients kept per block and per component, the first ones in zig-zag order (see `select_coefficients`). The network should be built with the same value.
+            - byte_cache_size: The memory budget, in bytes, of a cache of the JPEG files shared by the worker processes (see `ByteCache`). When the dataset fits in the budget, the files are only read from the disk during the first epoch.
         '''
         self.labels_output_format = labels_output_format
         self.labels_format = {'class_id': 0,
@@ -75,7 +84,9 @@ class VOCGenerator(object):
         self.transforms = transforms
         self.label_encoder = label_encoder
 
+        self.set_files = []
         for image_dir, set_file in images_path:
+            self.set_files.append(set_file)
             with open(set_file, "r") as f:
                 files = [file.rstrip() for file in f.readlines()]
 
@@ -86,23 +97,39 @@ class VOCGenerator(object):
         self.images_path = self.images_path
         self.split_cbcr = split_cbcr
         self.only_y = only_y
+        # Only the luminance is returned, the chrominance is then never loaded
+        self.luminance_only = only_y and not split_cbcr
         self._batch_size = batch_size
         self._shuffle = shuffle
         self._train_mode = train_mode
         self._number_of_data_samples = len(self.images_path)
 
-        self.batch_per_epoch = len(self.images_path) // self._batch_size
-        self.indexes = np.arange(len(self.images_path))
+        self.sampler = Sampler(len(self.images_path), shuffle, seed)
+        self.batch_per_epoch = len(self.indexes) // self._batch_size
+        self.decode_pool = DecodePool(decode_threads)
+        self.decode_size = decode_size
+        self.n_coefficients = n_coefficients
 
+        # Filled by `prepare_dataset` (see `RaggedArray`)
         self.labels = []
         self.flagged_boxes = []
         self.dct = dct
+        self.dct_domain = dct and is_dct_pipeline(transforms)
+
+        if cache_directory is not None and not dct:
+            raise ValueError("The cache can only be used when generating DCT data.")
+        self.cache_directory = cache_directory
+        self.cache = None
+
+        # Position of each of the images in the records if any
+        self.reader = open_reader(records) if records is not None else None
+        self.record_indexes = self.reader.lookup(
+            self.images_path) if self.reader is not None else None
+        self.byte_cache = ByteCache(byte_cache_size, len(self.images_path)) if byte_cache_size else None
 
         self.box_filter = BoxFilter(check_overlap=False, check_min_area=False,
                                     check_degenerate=True, labels_format=self.labels_format)
 
-        self.on_epoch_end()
-
     @property
     def batch_size(self):
         return self._batch_size
@@ -110,7 +137,7 @@ class VOCGenerator(object):
     @batch_size.setter
     def batch_size(self, value):
         self._batch_size = value
-        self.batch_per_epoch = len(self.images_path) // self._batch_size
+        self.batch_per_epoch = len(self.indexes) // self._batch_size
 
     @property
     def number_of_data_samples(self):
@@ -123,10 +150,43 @@ class VOCGenerator(object):
     @shuffle.setter
     def shuffle(self, value):
         self._shuffle = value
-        if self.shuffle == False:
-            self.indexes = np.arange(len(self.indexes))
-        else:
-            self.on_epoch_end()
+        self.sampler.shuffle = value
+
+    @property
+    def indexes(self):
+        """ The indexes of the images, in the order of the current epoch. """
+        return self.sampler.indexes
+
+    def set_epoch(self, epoch: int):
+        """ Sets the order of the images to the one of the given epoch. The order only depends on the seed and the epoch, so copies of the generator in other processes stay consistent.
+
+        # Arguments:
+            - epoch: The epoch number.
+        """
+        self.sampler.set_epoch(epoch)
+
+    def set_shard(self, shard_index: int, number_of_shards: int, seed: int=None):
+        """ Restricts the generator to a shard of the images, e.g: the images of one Horovod rank. The shards are disjoint slices of the same permutation of the images for each epoch, all the shards must use the same seed.
+
+        # Arguments:
+            - shard_index: The index of the shard, e.g: `hvd.rank()`.
+            - number_of_shards: The number of shards, e.g: `hvd.size()`.
+            - seed: The seed of the permutations, shared by all the shards. The current seed is kept if not set.
+        """
+        self.sampler.set_shard(shard_index, number_of_shards, seed)
+        self.batch_per_epoch = len(self.indexes) // self._batch_size
+
+    def get_state(self):
+        """ Returns the state of the sampler (see `Sampler.get_state`), used to resume a training in the middle of an epoch. """
+        return self.sampler.get_state()
+
+    def set_state(self, state: dict):
+        """ Restores the state of the sampler (see `Sampler.set_state`), the batches then follow the order of the saved epoch.
+
+        # Arguments:
+            - state: The state to restore.
+        """
+        self.sampler.set_state(state)
 
     def __len__(self):
         """ Should return the number of batch per epoch."""
@@ -139,8 +199,6 @@ class VOCGenerator(object):
             - index: The index of the batch
         """
         index = index % self.batch_per_epoch
-        if index == 0:
-            self.on_epoch_end()
         indexes = self.indexes[index * self.batch_size:(index + 1) *
                                self._batch_size]
 
@@ -151,56 +209,123 @@ class VOCGenerator(object):
 
     def on_epoch_end(self):
         """ Updates indexes after each epoch. """
-        if self.shuffle:
-            np.random.shuffle(self.indexes)
+        self.set_epoch(self.sampler.epoch + 1)
 
-    def __data_generation(self, indexes):
+    def _prepare_sample(self, transforms: List[object], i: int):
+        """ Loads the image i and its labels, and applies the transformations. Called concurrently by the threads of the decode pool.
+
+        # Arguments:
+            - transforms: The transformations to apply.
+            - i: The index of the image.
+
+        # Returns:
+            Two values, the image (None if a transformation failed to produce an output image) and the labels.
+        """
+        # Each thread applies its own copy of the transformations, they store the parameters drawn for the image
+        transforms = self.decode_pool.thread_copy(transforms)
+
+        if self.cache is not None:
+            # The deterministic transformations were already applied, read the coefficients from the cache
+            image, labels = self.cache[i]
+        else:
+            # If the transformations work on the coefficients (or if there is none), no need to decode the image
+            dct = load_dct(self.get_source(i), self.luminance_only) if self.dct_domain else None
+            labels = self.labels[i] if self._train_mode else None
+            if dct is None and self.decode_size is not None and not self.dct_domain:
+                # Decoded at a reduced resolution, the boxes are rescaled to match
+                image, (scale_y, scale_x) = open_reduced_image(self.get_source(i), self.decode_size)
+                with image:
+                    image = image.convert("RGB")
+                    image = np.array(image, dtype=np.uint8)
+                if labels is not None:
+                    labels[:, [self.labels_format['xmin'], self.labels_format['xmax']]] *= scale_x
+                    labels[:, [self.labels_format['ymin'], self.labels_format['ymax']]] *= scale_y
+            elif dct is None:
+                with open_image(self.get_source(i)) as image:
+                    image = image.convert("RGB")
+                    image = np.array(image, dtype=np.uint8)
+                # The file is not 4:2:0, it is re-encoded before applying the DCT transformations
+                if self.dct_domain:
+                    dct = encode_dct(image, self.luminance_only)
+            image = dct if self.dct_domain else image
+        if not self._train_mode:
+            labels = np.array([[0, 0, 0, 0, 0]])
+
+        # Apply any image transformations we may have received.
+        if transforms:
+            for transform in transforms:
+                image, labels = transform(image, labels)
+
+                # In case the transform failed to produce an output image, which is possible for some random transforms.
+                if image is None:
+                    return None, labels
+
+        xmin = self.labels_format['xmin']
+        ymin = self.labels_format['ymin']
+        xmax = self.labels_format['xmax']
+        ymax = self.labels_format['ymax']
+
+        if self._train_mode and (np.any(labels[:, xmax] - labels[:, xmin] <= 0) or np.any(labels[:, ymax] - labels[:, ymin] <= 0)):
+            labels = self.box_filter(labels)
+
+        # The images transformed in the pixel domain are encoded
+        if self.dct and not isinstance(image, tuple):
+            image = encode_dct(image, self.luminance_only)
+        if self.dct:
+            image = select_coefficients(image, self.n_coefficients)
+        elif not self.dct:
+            image = preprocess_input(image)
+
+        return image, labels
+
+    def _get_transforms(self):
+        """ Returns the transformations to apply to the loaded images. """
         # Override the labels formats of all the transformations to make sure they are set correctly.
         if not (self.labels is None):
             if self.transforms is not None:
                 for transform in self.transforms:
                     transform.labels_format = self.labels_format
 
-        batch_X, batch_y = [], []
+        # The deterministic transformations are skipped when the data comes from the cache
+        return self.cache.suffix if self.cache is not None else self.transforms
 
-        # Load the images and labels
-        for i in indexes:
-            with Image.open(self.images_path[i]) as image:
-                image = image.convert("RGB")
-                batch_X.append(np.array(image, dtype=np.uint8))
-            if self._train_mode:
-                batch_y.append(deepcopy(self.labels[i]))
-            else:
-                batch_y.append([[0, 0, 0, 0, 0]])
+    def get_sample(self, i: int):
+        """ Returns the inputs and the target of the image i, used by the pipelines working sample per sample (see `TFDataAdapter`).
 
-        # In case we need to remove any images from the batch, store their indices in this list.
-        batch_items_to_remove = []
-        for i in range(len(batch_X)):
+        # Arguments:
+            - i: The index of the image.
 
-            batch_y[i] = np.array(batch_y[i])
+        # Returns:
+            Two values, the tuple of the inputs of the network and the target (the encoded labels if there is a label encoder), None, None if a transformation failed to produce an output image.
+        """
+        image, labels = self._prepare_sample(self._get_transforms(), i)
+        if image is None:
+            return None, None
 
-            # Apply any image transformations we may have received.
-            if self.transforms:
-                for transform in self.transforms:
-                    batch_X[i], batch_y[i] = transform(
-                        batch_X[i], batch_y[i])
+        if self.label_encoder and self._train_mode:
+            target = self.label_encoder([labels])[0]
+        else:
+            target = labels
 
-                    # In case the transform failed to produce an output image, which is possible for some random transforms.
-                    if batch_X[i] is None:
-                        batch_items_to_remove.append(i)
-                        continue
+        if not self.dct:
+            return (image,), target
+        dct_y, dct_cb, dct_cr = image
+        if self.split_cbcr:
+            return (dct_y, dct_cb, dct_cr), target
+        if self.only_y:
+            return (dct_y,), target
+        return (dct_y, np.concatenate([dct_cb, dct_cr], axis=-1)), target
 
-            xmin = self.labels_format['xmin']
-            ymin = self.labels_format['ymin']
-            xmax = self.labels_format['xmax']
-            ymax = self.labels_format['ymax']
+    def __data_generation(self, indexes):
+        transforms = self._get_transforms()
 
-            if self._train_mode and (np.any(batch_y[i][:, xmax] - batch_y[i][:, xmin] <= 0) or np.any(batch_y[i][:, ymax] - batch_y[i][:, ymin] <= 0)):
-                batch_y[i] = self.box_filter(batch_y[i])
+        # Load and transform the images of the batch concurrently
+        samples = self.decode_pool.map(
+            partial(self._prepare_sample, transforms), indexes)
 
-        for to_remove in batch_items_to_remove[::-1]:
-            batch_X.pop(i)
-            batch_y.pop(i)
+        # The images for which a transformation failed are removed from the batch
+        batch_X = [image for image, _ in samples if image is not None]
+        batch_y = [labels for image, labels in samples if image is not None]
 
         if self.label_encoder and self._train_mode:
             batch_y_encoded = self.label_encoder(batch_y)
@@ -208,63 +333,82 @@ class VOCGenerator(object):
             batch_y_encoded = batch_y
 
         if not self.dct:
-            for i in range(len(batch_X)):
-                batch_X[i] = preprocess_input(batch_X[i])
-
-            batch_X = np.array(batch_X)
-            return batch_X, batch_y_encoded
+            return np.stack(batch_X), batch_y_encoded
         else:
-            X_y = []
+            # The matrices of the batch are allocated once, then filled with the coefficients of each of the images
+            dct_y, dct_cb, _ = batch_X[0]
+            X_y = np.empty((len(batch_X), *dct_y.shape), dtype=np.int16)
             if self.split_cbcr:
-                X_cb = []
-                X_cr = []
-            else:
-                X_cbcr = []
-            for i, image_to_save in enumerate(batch_X):
-                im = Image.fromarray(image_to_save)
-                fake_file = BytesIO()
-                im.save(fake_file, format="jpeg")
-
-                dct_y, dct_cb, dct_cr = loads(fake_file.getvalue())
-
-                y_x, y_y, y_c = dct_y.shape
-                cb_x, cb_y, cb_c = dct_cb.shape
-
-                temp_y = np.zeros((cb_x * 2, cb_y * 2, y_c), dtype=np.int16)
-
-                temp_y[:y_x, :y_y, :] = dct_y
-
-                X_y.append(temp_y)
+                X_cb = np.empty((len(batch_X), *dct_cb.shape), dtype=np.int16)
+                X_cr = np.empty((len(batch_X), *dct_cb.shape), dtype=np.int16)
+            elif not self.only_y:
+                X_cbcr = np.empty((len(batch_X), *dct_cb.shape[:-1], 2 * dct_cb.shape[-1]), dtype=np.int16)
+            for i, (dct_y, dct_cb, dct_cr) in enumerate(batch_X):
+                X_y[i] = dct_y
 
                 if self.split_cbcr:
-                    X_cb.append(dct_cb)
-                    X_cr.append(dct_cr)
-                else:
-                    X_cbcr.append(np.concatenate([dct_cb, dct_cr], axis=-1))
+                    X_cb[i] = dct_cb
+                    X_cr[i] = dct_cr
+                elif not self.only_y:
+                    X_cbcr[i, ..., :dct_cb.shape[-1]] = dct_cb
+                    X_cbcr[i, ..., dct_cb.shape[-1]:] = dct_cr
 
             if self.split_cbcr:
-                return [np.array(X_y), np.array(X_cb), np.array(X_cr)], batch_y_encoded
+                return [X_y, X_cb, X_cr], batch_y_encoded
             else:
                 if self.only_y:
-                    return np.array(X_y), batch_y_encoded
+                    return X_y, batch_y_encoded
                 else:
-                    return [np.array(X_y), np.array(X_cbcr)], batch_y_encoded
+                    return [X_y, X_cbcr], batch_y_encoded
 
-    def prepare_dataset(self, exclude_difficult=False):
-        """ We load all the labels when preparing the data. If there is the load in memory option activated, we pre-load the images as well. """
+    def prepare_dataset(self, exclude_difficult=False, annotations_cache_directory: str=DEFAULT_CACHE_DIRECTORY, processes: int=None):
+        """ We load all the labels when preparing the data. If a cache directory was specified, the cache of the deterministic transformations is built as well.
+
+        # Arguments:
+            - exclude_difficult: If the difficult boxes should be excluded.
+            - annotations_cache_directory: Where to persist the parsed annotations, None to always parse them.
+            - processes: The number of processes used to parse the annotations, defaults to the number of CPUs.
+        """
 
         if not self._train_mode:
             print("Skipping the loading of the parameters as we are in test mode.")
+            self.prepare_cache()
+            return None
+
+        annotation_files = [filename.replace("JPEGImages", "Annotations").replace(
+            "jpg", "xml") for filename in self.images_path]
+        self.labels, self.flagged_boxes = parse_voc_annotations(annotation_files,
+                                                                key_files=self.set_files,
+                                                                exclude_difficult=exclude_difficult,
+                                                                cache_directory=annotations_cache_directory,
+                                                                processes=processes)
+
+        self.prepare_cache()
+
+    def prepare_cache(self):
+        """ Builds the cache of the deterministic transformations (or opens it if it already exists). Does nothing if no cache directory was specified. """
+        if self.cache_directory is None:
             return None
 
-        it = tqdm(self.images_path,
-                  desc='Preparing the dataset', file=sys.stdout)
-        for filename in it:
+        if self.transforms is not None:
+            for transform in self.transforms:
+                transform.labels_format = self.labels_format
+
+        self.cache = DCTCache(self.cache_directory, self.images_path, self.transforms,
+                              reader=self.reader, record_indexes=self.record_indexes,
+                              labels=self.labels if self._train_mode else None)
 
-            boxes, flagged_boxes = parse_xml_voc(filename.replace(
-                "JPEGImages", "Annotations").replace("jpg", "xml"), exclude_difficult=exclude_difficult)
-            self.labels.append(boxes)
-            self.flagged_boxes.append(flagged_boxes)
+    def get_source(self, i: int):
+        """ Returns the bytes of the image i when reading from records or through the byte cache, its path otherwise. """
+        if self.byte_cache is not None:
+            return self.byte_cache.read(i, self._get_file)
+        return self._get_file(i)
+
+    def _get_file(self, i: int):
+        """ Returns the bytes of the image i when reading from records, its path otherwise. """
+        if self.reader is not None:
+            return self.reader.read(self.record_indexes[i])
+        return self.images_path[i]
 
     def get_raw_input_label(self, index):
         """ Should return the raw input at a given batch index, i.e something displayable.
@@ -284,9 +428,9 @@ class VOCGenerator(object):
         batch_X, batch_y = [], []
 
         for i in indexes:
-            with Image.open(self.images_path[i]) as image:
+            with open_image(self.get_source(i)) as image:
                 batch_X.append(np.array(image, dtype=np.uint8))
-            batch_y.append(deepcopy(self.labels[i]))
+            batch_y.append(self.labels[i])
 
         # In case we need to remove any images from the batch, store their indices in this list.
         batch_items_to_remove = []
@@ -297,7 +441,8 @@ class VOCGenerator(object):
             batch_y[i] = np.array(batch_y[i])
 
             # Apply any image transformations we may have received.
-            if self.transforms:
+            # The DCT transformations cannot be applied on RGB images, the raw image is returned in this case.
+            if self.transforms and not self.dct_domain:
                 for transform in self.transforms:
 
                     batch_X[i], batch_y[i] = transform(
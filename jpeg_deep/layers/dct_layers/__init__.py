@@ -0,0 +1,2 @@
+from .cast import CastToFloat
+from .masked_pooling import MaskedGlobalAveragePooling2D
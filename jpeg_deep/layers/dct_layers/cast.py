@@ -0,0 +1,24 @@
+import keras.backend as K
+from keras.engine.topology import Layer
+
+
+class CastToFloat(Layer):
+
+    def __init__(self, **kwargs):
+        '''
+        Casts the quantized DCT coefficients, fed to the network as int16, to the float type of the network.
+        The coefficients are exactly representable in float32, the cast does not change their values.
+
+        # Input Shape:
+            Any tensor of integers.
+
+        # Returns:
+            The same tensor, with the type `K.floatx()`.
+        '''
+        super(CastToFloat, self).__init__(**kwargs)
+
+    def call(self, x, mask=None):
+        return K.cast(x, K.floatx())
+
+    def compute_output_shape(self, input_shape):
+        return input_shape
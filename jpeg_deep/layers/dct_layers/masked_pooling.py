@@ -0,0 +1,55 @@
+from typing import List, Tuple
+
+import keras.backend as K
+from keras.engine.topology import Layer
+
+
+class MaskedGlobalAveragePooling2D(Layer):
+
+    def __init__(self, reductions: List[Tuple[int, int]]=(), **kwargs):
+        '''
+        Global average pooling restricted to the valid part of the inputs. Used when images of different sizes are
+        padded to be processed in the same batch: the padding does not contribute to the average.
+
+        The mask, given at the resolution of the input of the network, is brought to the resolution of the feature map
+        through the same windows as the network: each pooling or 'valid' convolution between the input and the feature
+        map is given as its (window, stride). A position of the feature map is kept if all the inputs of its window are
+        valid, i.e: the positions also computed for the image alone. The 'same' convolutions keep the resolution and
+        are not listed, the borders of the image may still differ slightly as they see the normalized padding instead
+        of zeros.
+
+        # Arguments:
+            - reductions: The (window, stride) of the poolings and 'valid' convolutions of the network, in order, e.g: `[(2, 2), (2, 2), (7, 1)]` for two 2x2 max poolings followed by a 7x7 convolution.
+
+        # Input Shape:
+            A list of two 4D tensors, the feature map `(batch, height, width, channels)` and the validity mask
+            `(batch, mask_height, mask_width, 1)`, 1 for valid positions and 0 for the padding.
+
+        # Returns:
+            The averaged features, a 2D tensor of shape `(batch, channels)`.
+        '''
+        self.reductions = [tuple(reduction) for reduction in reductions]
+        super(MaskedGlobalAveragePooling2D, self).__init__(**kwargs)
+
+    def call(self, inputs, mask=None):
+        x, validity = inputs
+        # Erosion of the mask: a window is valid only if all of its inputs are
+        weights = validity
+        for window, stride in self.reductions:
+            weights = -K.pool2d(-weights, (window, window), strides=(stride, stride),
+                                padding='valid', pool_mode='max')
+        total = K.sum(weights, axis=[1, 2])
+        return K.sum(x * weights, axis=[1, 2]) / K.maximum(total, K.epsilon())
+
+    def compute_output_shape(self, input_shape):
+        return (input_shape[0][0], input_shape[0][3])
+
+    def compute_mask(self, inputs, mask=None):
+        return None
+
+    def get_config(self):
+        config = {
+            'reductions': self.reductions
+        }
+        base_config = super(MaskedGlobalAveragePooling2D, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
@@ -1 +1,2 @@
-from .ssd_loss import SSDLoss
+from .ssd_loss import SSDLoss, SparseSSDLoss, MatchingSSDLoss
+from .ssd_matching import match_anchors
@@ -20,6 +20,10 @@ limitations under the License.
 from __future__ import division
 import tensorflow as tf
 
+from jpeg_deep.utils import SPARSE_TARGET_WIDTH, NEUTRAL_WORD_BITS
+
+from .ssd_matching import match_anchors
+
 
 class SSDLoss:
     '''
@@ -226,3 +230,113 @@ class SSDLoss:
         total_loss = total_loss * tf.to_float(batch_size)
 
         return total_loss
+
+
+class SparseSSDLoss(SSDLoss):
+    '''
+    The SSD loss computed from the sparse targets of `SSDInputEncoder(sparse_targets=True)`, with the same arguments as `SSDLoss`.
+    '''
+
+    def expand_targets(self, y_true, y_pred):
+        '''
+        Expands the sparse targets to the dense ground truth tensor, on the graph.
+
+        # Arguments
+            - y_true: The sparse targets, of shape `(batch_size, #neutral rows + #positives, 6)` (see `SSDInputEncoder.sparsify`).
+            - y_pred: The model prediction, of shape `(batch_size, #boxes, #classes + 12)`.
+
+        # Returns:
+            The dense ground truth tensor, of the shape of `y_pred`: the one-hot classes (all zeros for the neutral boxes),
+            the offsets and 8 zero entries.
+        '''
+        batch_size = tf.shape(y_pred)[0]
+        n_boxes = tf.shape(y_pred)[1]
+        n_classes = tf.shape(y_pred)[2] - 12
+
+        n_words = (n_boxes + NEUTRAL_WORD_BITS - 1) // NEUTRAL_WORD_BITS
+        neutral_rows = (n_words + SPARSE_TARGET_WIDTH - 1) // SPARSE_TARGET_WIDTH
+
+        # Unpack the bitset of the neutral boxes. Tensor of shape (batch_size, n_boxes)
+        words = tf.to_int32(tf.reshape(
+            y_true[:, :neutral_rows], [batch_size, -1])[:, :n_words])
+        bits = tf.bitwise.bitwise_and(tf.bitwise.right_shift(
+            tf.expand_dims(words, axis=-1), tf.range(NEUTRAL_WORD_BITS)), 1)
+        neutral = tf.to_float(tf.reshape(bits, [batch_size, -1])[:, :n_boxes])
+
+        # Scatter the positive boxes, the padding rows have the anchor index -1
+        rows = y_true[:, neutral_rows:]
+        valid = tf.where(tf.greater_equal(rows[:, :, 0], 0))
+        positives = tf.gather_nd(rows, valid)  # Tensor of shape (n_positives, 6)
+        indices = tf.stack([tf.to_int32(valid[:, 0]), tf.to_int32(positives[:, 0])], axis=1)
+        shape = tf.stack([batch_size, n_boxes])
+
+        # The background class (0) everywhere but on the positive boxes, no class on the neutral boxes
+        class_ids = tf.scatter_nd(indices, tf.to_int32(positives[:, 1]), shape)
+        classes = tf.one_hot(class_ids, n_classes) * tf.expand_dims(1 - neutral, axis=-1)
+        offsets = tf.scatter_nd(indices, positives[:, 2:], tf.concat([shape, [4]], axis=0))
+
+        return tf.concat([classes, offsets, tf.zeros_like(y_pred[:, :, -8:])], axis=-1)
+
+    def compute_loss(self, y_true, y_pred):
+        '''
+        Compute the loss of the SSD model prediction against the sparse targets produced by
+        `SSDInputEncoder(sparse_targets=True)`. The targets are expanded on the graph (see `expand_targets`), the
+        loss is then the same as the one of `SSDLoss`.
+
+        # Arguments
+            - y_true: The sparse targets, of shape `(batch_size, #neutral rows + #positives, 6)`.
+            - y_pred: The model prediction, of shape `(batch_size, #boxes, #classes + 12)`.
+
+        Returns:
+            A scalar, the total multitask loss for classification and localization.
+        '''
+        return super(SparseSSDLoss, self).compute_loss(self.expand_targets(y_true, y_pred), y_pred)
+
+
+class MatchingSSDLoss(SSDLoss):
+    '''
+    The SSD loss computed from the raw ground truth boxes of `RawBoxesEncoder`, matched to the anchor boxes in the graph.
+    '''
+
+    def __init__(self,
+                 neg_pos_ratio: int = 3,
+                 n_neg_min: int = 0,
+                 alpha: float = 1.0,
+                 coords: str = 'centroids',
+                 matching_type: str = 'multi',
+                 pos_iou_threshold: float = 0.5,
+                 neg_iou_limit: float = 0.5):
+        '''
+        The matching is the one of `SSDInputEncoder`, computed with TensorFlow operations for the whole batch (see
+        `jpeg_deep.losses.ssd_matching`). The anchor boxes are taken from the model output, i.e: they are the ones of the
+        `AnchorBoxes` layers.
+
+        # Arguments:
+            - neg_pos_ratio: The maximum ratio of negative (i.e. background) to positive ground truth boxes to include in the loss computation.
+            - n_neg_min: The minimum number of negative ground truth boxes to take into consideration.
+            - alpha: A factor to weight the localization loss in the computation of the total loss.
+            - coords: The box coordinate format of the model, one of 'centroids', 'minmax' or 'corners'.
+            - matching_type: Can be either 'multi' or 'bipartite' (see `SSDInputEncoder`).
+            - pos_iou_threshold: The IoU threshold of the multi matching.
+            - neg_iou_limit: The maximum IoU of a background anchor box with any ground truth box.
+        '''
+        super(MatchingSSDLoss, self).__init__(neg_pos_ratio, n_neg_min, alpha)
+        self.coords = coords
+        self.matching_type = matching_type
+        self.pos_iou_threshold = pos_iou_threshold
+        self.neg_iou_limit = neg_iou_limit
+
+    def compute_loss(self, y_true, y_pred):
+        '''
+        Compute the loss of the SSD model prediction against the ground truth boxes.
+
+        # Arguments
+            - y_true: The ground truth boxes, of shape `(batch_size, max_boxes, 5)` (see `RawBoxesEncoder`).
+            - y_pred: The model prediction, of shape `(batch_size, #boxes, #classes + 12)`.
+
+        Returns:
+            A scalar, the total multitask loss for classification and localization.
+        '''
+        y_true = tf.stop_gradient(match_anchors(y_true, y_pred, coords=self.coords, matching_type=self.matching_type,
+                                                pos_iou_threshold=self.pos_iou_threshold, neg_iou_limit=self.neg_iou_limit))
+        return super(MatchingSSDLoss, self).compute_loss(y_true, y_pred)
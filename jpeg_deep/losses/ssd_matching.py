@@ -0,0 +1,232 @@
+'''
+Matching of the ground truth boxes to the anchor boxes inside the training graph.
+
+The same algorithm as `SSDInputEncoder` (bipartite greedy matching, then multi matching and neutral boxes), computed
+for the whole batch with TensorFlow operations. The generators then only produce the padded ground truth boxes (see
+`RawBoxesEncoder`), and the anchor boxes are the ones given by the `AnchorBoxes` layers in the model output.
+'''
+from __future__ import division
+import tensorflow as tf
+
+
+def corners_from_coords(boxes, coords: str = 'centroids'):
+    '''
+    Converts boxes to the `(xmin, ymin, xmax, ymax)` format.
+
+    # Arguments:
+        - boxes: A tensor whose last axis contains the box coordinates.
+        - coords: The format of the boxes, one of 'centroids' `(cx, cy, w, h)`, 'minmax' `(xmin, xmax, ymin, ymax)` or 'corners'.
+
+    # Returns:
+        The boxes in the 'corners' format.
+    '''
+    if coords == 'centroids':
+        cx, cy, w, h = boxes[..., 0], boxes[..., 1], boxes[..., 2], boxes[..., 3]
+        return tf.stack([cx - w / 2.0, cy - h / 2.0, cx + w / 2.0, cy + h / 2.0], axis=-1)
+    elif coords == 'minmax':
+        xmin, xmax, ymin, ymax = boxes[..., 0], boxes[..., 1], boxes[..., 2], boxes[..., 3]
+        return tf.stack([xmin, ymin, xmax, ymax], axis=-1)
+    return boxes
+
+
+def iou_matrix(boxes, anchors):
+    '''
+    Computes the IoU of each ground truth box with each anchor box (the border pixels are counted as 'half').
+
+    # Arguments:
+        - boxes: The ground truth boxes, a tensor of shape `(batch_size, max_boxes, 4)` in the 'corners' format.
+        - anchors: The anchor boxes, a tensor of shape `(n_boxes, 4)` in the 'corners' format.
+
+    # Returns:
+        A tensor of shape `(batch_size, max_boxes, n_boxes)`.
+    '''
+    boxes = tf.expand_dims(boxes, axis=2)
+    widths = tf.maximum(tf.minimum(boxes[..., 2], anchors[:, 2]) - tf.maximum(boxes[..., 0], anchors[:, 0]), 0.0)
+    heights = tf.maximum(tf.minimum(boxes[..., 3], anchors[:, 3]) - tf.maximum(boxes[..., 1], anchors[:, 1]), 0.0)
+    intersection = widths * heights
+
+    boxes_areas = (boxes[..., 2] - boxes[..., 0]) * (boxes[..., 3] - boxes[..., 1])
+    anchors_areas = (anchors[:, 2] - anchors[:, 0]) * (anchors[:, 3] - anchors[:, 1])
+    return intersection / (boxes_areas + anchors_areas - intersection)
+
+
+def mask_weights(weights, fill, rows, columns):
+    '''
+    Replaces the weights of the given rows and columns by `fill`.
+
+    # Arguments:
+        - weights: A tensor of shape `(batch_size, max_boxes, n_boxes)`.
+        - fill: The replacement value of each row, a tensor of shape `(batch_size, max_boxes)`.
+        - rows: A float tensor of shape `(batch_size, max_boxes)`, 1 for the rows to replace.
+        - columns: A float tensor of shape `(batch_size, n_boxes)`, 1 for the columns to replace.
+
+    # Returns:
+        The masked weights.
+    '''
+    keep = (1 - tf.expand_dims(rows, axis=2)) * (1 - tf.expand_dims(columns, axis=1))
+    return weights * keep + tf.expand_dims(fill, axis=2) * (1 - keep)
+
+
+def match_bipartite_greedy(weights, valid):
+    '''
+    Matches each ground truth box to one anchor box, the ground truth box that has the greatest similarity with any of
+    the remaining anchor boxes being matched first (see `jpeg_deep.generators.helper_ssd.match_bipartite_greedy`).
+    All the images of the batch are matched at once, in as many steps as the largest number of ground truth boxes.
+
+    At most `max_boxes - 1` anchor boxes are taken before a ground truth box is matched, its match is then among its
+    `max_boxes` most similar anchor boxes: the steps only reduce over these candidates, not over all the anchor boxes.
+
+    # Arguments:
+        - weights: The similarities, a tensor of shape `(batch_size, max_boxes, n_boxes)`. The rows of the padding ground truth boxes must be negative.
+        - valid: A boolean tensor of shape `(batch_size, max_boxes)`, false for the padding ground truth boxes.
+
+    # Returns:
+        Two tensors of shape `(batch_size, n_boxes)`: 1 for the matched anchor boxes (float), and the index of the ground truth box they are matched to (int32).
+    '''
+    batch_size = tf.shape(weights)[0]
+    max_boxes = tf.shape(weights)[1]
+    n_boxes = tf.shape(weights)[2]
+
+    # Sorted by decreasing similarity, the lowest anchor box index first in case of equality (as `argmax`).
+    # Tensors of shape (batch_size, max_boxes, max_boxes)
+    candidates, candidate_anchors = tf.nn.top_k(weights, k=max_boxes)
+
+    number_of_boxes = tf.reduce_sum(tf.to_int32(valid), axis=1)
+    image_indices = tf.range(batch_size)
+
+    def body(step, matched_rows, taken, matches):
+        # The taken anchor boxes are set below any IoU, even 0, so that a remaining candidate is always chosen first.
+        # The matched rows are set below the padding rows (-1), so that they are never chosen again.
+        masked = candidates * (1 - taken) - 2 * taken
+        best_candidates = tf.argmax(masked, axis=2, output_type=tf.int32)
+        best_weights = tf.reduce_max(masked, axis=2)
+        best_weights = best_weights * (1 - matched_rows) - 3 * matched_rows
+
+        rows = tf.argmax(best_weights, axis=1, output_type=tf.int32)
+        columns = tf.gather_nd(candidate_anchors, tf.stack(
+            [image_indices, rows, tf.gather_nd(best_candidates, tf.stack([image_indices, rows], axis=1))], axis=1))
+
+        # The images with ground truth boxes left to match
+        active = tf.to_float(tf.less(step, number_of_boxes))
+        row_hot = tf.one_hot(rows, max_boxes) * tf.expand_dims(active, axis=1)
+        matches += tf.to_int32(row_hot) * (tf.expand_dims(columns, axis=1) - matches)
+        taken = tf.maximum(taken, tf.to_float(tf.equal(candidate_anchors, tf.reshape(columns, [-1, 1, 1]))) *
+                           tf.reshape(active, [-1, 1, 1]))
+        return step + 1, tf.maximum(matched_rows, row_hot), taken, matches
+
+    _, _, _, matches = tf.while_loop(
+        lambda step, *_: tf.less(step, tf.reduce_max(number_of_boxes)),
+        body,
+        [tf.constant(0),
+         tf.zeros([batch_size, max_boxes]),
+         tf.zeros_like(candidates),
+         tf.zeros([batch_size, max_boxes], dtype=tf.int32)],
+        back_prop=False)
+
+    # The taken anchor boxes are never chosen again, each anchor box is matched at most once
+    matched_boxes = tf.to_int32(tf.where(valid))
+    indices = tf.stack([matched_boxes[:, 0], tf.gather_nd(matches, matched_boxes)], axis=1)
+    shape = tf.stack([batch_size, n_boxes])
+    matched_columns = tf.scatter_nd(indices, tf.ones_like(matched_boxes[:, 0], dtype=tf.float32), shape)
+    column_boxes = tf.scatter_nd(indices, matched_boxes[:, 1], shape)
+    return matched_columns, column_boxes
+
+
+def encode_offsets(boxes, anchors, variances, coords: str = 'centroids'):
+    '''
+    Encodes the ground truth boxes as offsets to the anchor boxes, as `SSDInputEncoder`.
+
+    # Arguments:
+        - boxes: The ground truth box of each anchor box, a tensor of shape `(batch_size, n_boxes, 4)` in the 'corners' format.
+        - anchors: The anchor boxes, a tensor of shape `(n_boxes, 4)` in the `coords` format.
+        - variances: The variances of the anchor boxes, a tensor of shape `(n_boxes, 4)`.
+        - coords: The format of the anchor boxes and of the offsets.
+
+    # Returns:
+        The offsets, a tensor of shape `(batch_size, n_boxes, 4)`.
+    '''
+    xmin, ymin, xmax, ymax = boxes[..., 0], boxes[..., 1], boxes[..., 2], boxes[..., 3]
+    if coords == 'centroids':
+        # (cx(gt) - cx(anchor)) / w(anchor) / cx_variance, (cy(gt) - cy(anchor)) / h(anchor) / cy_variance
+        # ln(w(gt) / w(anchor)) / w_variance, ln(h(gt) / h(anchor)) / h_variance
+        offsets = tf.stack([((xmin + xmax) / 2.0 - anchors[:, 0]) / anchors[:, 2],
+                            ((ymin + ymax) / 2.0 - anchors[:, 1]) / anchors[:, 3],
+                            tf.log((xmax - xmin) / anchors[:, 2]),
+                            tf.log((ymax - ymin) / anchors[:, 3])], axis=-1)
+    elif coords == 'corners':
+        # (gt - anchor) / size(anchor) for all four coordinates, where 'size' refers to w and h respectively
+        widths = anchors[:, 2] - anchors[:, 0]
+        heights = anchors[:, 3] - anchors[:, 1]
+        offsets = (boxes - anchors) / tf.stack([widths, heights, widths, heights], axis=-1)
+    else:
+        widths = anchors[:, 1] - anchors[:, 0]
+        heights = anchors[:, 3] - anchors[:, 2]
+        offsets = (tf.stack([xmin, xmax, ymin, ymax], axis=-1) - anchors) / \
+            tf.stack([widths, widths, heights, heights], axis=-1)
+    return offsets / variances
+
+
+def match_anchors(y_true,
+                  y_pred,
+                  coords: str = 'centroids',
+                  matching_type: str = 'multi',
+                  pos_iou_threshold: float = 0.5,
+                  neg_iou_limit: float = 0.5):
+    '''
+    Matches the ground truth boxes to the anchor boxes of the model output and encodes them as the ground truth tensor
+    expected by `SSDLoss`.
+
+    # Arguments:
+        - y_true: The ground truth boxes, a tensor of shape `(batch_size, max_boxes, 5)` with the format `(class_id, xmin, ymin, xmax, ymax)` (see `RawBoxesEncoder`), the padding boxes have the class 0.
+        - y_pred: The model prediction, of shape `(batch_size, #boxes, #classes + 12)`, with the anchor boxes and the variances in the last eight entries.
+        - coords: The format of the anchor boxes, one of 'centroids', 'minmax' or 'corners'.
+        - matching_type: Can be either 'multi' or 'bipartite' (see `SSDInputEncoder`).
+        - pos_iou_threshold: The IoU threshold of the multi matching.
+        - neg_iou_limit: The maximum IoU of a background anchor box with any ground truth box.
+
+    # Returns:
+        The dense ground truth tensor, of the shape of `y_pred`: the one-hot classes (all zeros for the neutral boxes), the offsets and 8 zero entries.
+    '''
+    n_classes = tf.shape(y_pred)[2] - 12
+    max_boxes = tf.shape(y_true)[1]
+    # The anchor boxes are the same for all the images
+    anchors = y_pred[0, :, -8:-4]
+    variances = y_pred[0, :, -4:]
+    anchors_corners = corners_from_coords(anchors, coords)
+
+    valid = tf.greater(y_true[:, :, 0], 0)
+    fill = tf.to_float(valid) - 1
+    no_rows = tf.zeros_like(fill)
+
+    # The IoUs of the padding boxes are set to -1 so that they are never matched
+    similarities = iou_matrix(y_true[:, :, 1:5], anchors_corners)
+    similarities = mask_weights(similarities, fill, 1 - tf.to_float(valid), tf.zeros_like(similarities[:, 0]))
+
+    # First: Bipartite matching.
+    matched, box_indices = match_bipartite_greedy(similarities, valid)
+    similarities = mask_weights(similarities, fill, no_rows, matched)
+
+    # Second: Maybe multi matching, each remaining anchor box is matched to its most similar ground truth box.
+    if matching_type == 'multi':
+        multi_matched = tf.to_float(tf.greater_equal(
+            tf.reduce_max(similarities, axis=1), pos_iou_threshold)) * (1 - matched)
+        multi_indices = tf.argmax(similarities, axis=1, output_type=tf.int32)
+        box_indices += tf.to_int32(multi_matched) * (multi_indices - box_indices)
+        matched += multi_matched
+        similarities = mask_weights(similarities, fill, no_rows, multi_matched)
+
+    # Third: The negative boxes too close to a ground truth box become neutral.
+    neutral = tf.to_float(tf.greater_equal(tf.reduce_max(similarities, axis=1), neg_iou_limit)) * (1 - matched)
+
+    # Gather the ground truth box of each matched anchor box. Tensor of shape (batch_size, n_boxes, 5)
+    assignment = tf.one_hot(box_indices, max_boxes) * tf.expand_dims(matched, axis=-1)
+    matched_boxes = tf.matmul(assignment, y_true)
+
+    # The background class for the anchor boxes that are not matched, no class for the neutral ones
+    classes = tf.one_hot(tf.to_int32(tf.round(matched_boxes[:, :, 0])), n_classes) * \
+        tf.expand_dims(1 - neutral, axis=-1)
+    # The anchor boxes that are not matched are encoded with themselves, their offsets are irrelevant but finite
+    boxes = matched_boxes[:, :, 1:5] + tf.expand_dims(1 - matched, axis=-1) * anchors_corners
+    offsets = encode_offsets(boxes, anchors, variances, coords)
+
+    return tf.concat([classes, offsets, tf.zeros_like(y_pred[:, :, -8:])], axis=-1)
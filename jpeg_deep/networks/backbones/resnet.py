@@ -9,6 +9,7 @@ from keras.layers import Input, Lambda, Activation, Conv2D, MaxPooling2D, Reshap
 from keras.regularizers import l2
 
 from jpeg_deep.layers.ssd_layers import AnchorBoxes, L2Normalization, DecodeDetections
+from jpeg_deep.layers.dct_layers import CastToFloat
 
 from ..resnet_blocks import conv_block, identity_block
 
@@ -83,25 +84,30 @@ def feature_map_resnet_rgb(image_shape: Tuple[int, int], kernel_initializer: str
     return input_layer, last, block4_conv3
 
 
-def feature_map_lcrfa(image_shape: Tuple[int, int],  kernel_initializer: str = 'he_normal', l2_reg=0.0005):
+def feature_map_lcrfa(image_shape: Tuple[int, int],  kernel_initializer: str = 'he_normal', l2_reg=0.0005, n_coefficients: int=64):
     """ Helper function that generates the first layers of the SSD. This function generates the layers for the DCT network.
 
     # Arguments:
         - image_shape: A tuple containing the shape of the image.
         - l2_regularization: The float value for the l2 normalization.
         - kernel_initializer: The type of initializer for the convolution kernels.
+        - n_coefficients: The number of DCT coefficients per block and per component given as input, the first ones in zig-zag order (see `n_coefficients` in `jpeg_deep.generators`).
 
     # Returns:
         Three layers: input_layer, block4_pool, block4_conv3. These layers are used to intantiate the network.
     """
-    input_shape_y = (38, 38, 64)
-    input_shape_cbcr = (19, 19, 128)
+    input_shape_y = (38, 38, n_coefficients)
+    input_shape_cbcr = (19, 19, 2 * n_coefficients)
 
-    input_y = Input(shape=input_shape_y)
-    input_cbcr = Input(shape=input_shape_cbcr)
+    input_y = Input(shape=input_shape_y, dtype="int16")
+    input_cbcr = Input(shape=input_shape_cbcr, dtype="int16")
+
+    # The coefficients are given as int16 and cast on the graph
+    float_y = CastToFloat(name="cast_y")(input_y)
+    float_cbcr = CastToFloat(name="cast_cbcr")(input_cbcr)
 
     bn_y = BatchNormalization(
-        axis=3, momentum=0.9, epsilon=1e-5, name='bn_y')(input_y)
+        axis=3, momentum=0.9, epsilon=1e-5, name='bn_y')(float_y)
 
     y = conv_block(bn_y, 1, [256, 256, 1024],
                    stage=1, block="a_y", strides=(1, 1), kernel_reg=l2_reg)
@@ -123,7 +129,7 @@ def feature_map_lcrfa(image_shape: Tuple[int, int],  kernel_initializer: str = '
                    stage=3, block='a_y', kernel_reg=l2_reg)
 
     bn_cbcr = BatchNormalization(
-        axis=3, momentum=0.9, epsilon=1e-5, name='bn_cbcr')(input_cbcr)
+        axis=3, momentum=0.9, epsilon=1e-5, name='bn_cbcr')(float_cbcr)
     cbcr = conv_block(bn_cbcr, 1, [128, 128, 512],
                       stage=1, block='a_cbcr', strides=(1, 1), kernel_reg=l2_reg)
 
@@ -150,25 +156,30 @@ def feature_map_lcrfa(image_shape: Tuple[int, int],  kernel_initializer: str = '
     return [input_y, input_cbcr], last, block4_conv3
 
 
-def feature_map_lcrfat(image_shape: Tuple[int, int],  kernel_initializer: str = 'he_normal', l2_reg=0.0005):
+def feature_map_lcrfat(image_shape: Tuple[int, int],  kernel_initializer: str = 'he_normal', l2_reg=0.0005, n_coefficients: int=64):
     """ Helper function that generates the first layers of the SSD. This function generates the layers for the DCT network.
 
     # Arguments:
         - image_shape: A tuple containing the shape of the image.
         - l2_regularization: The float value for the l2 normalization.
         - kernel_initializer: The type of initializer for the convolution kernels.
+        - n_coefficients: The number of DCT coefficients per block and per component given as input, the first ones in zig-zag order (see `n_coefficients` in `jpeg_deep.generators`).
 
     # Returns:
         Three layers: input_layer, block4_pool, block4_conv3. These layers are used to intantiate the network.
     """
-    input_shape_y = (38, 38, 64)
-    input_shape_cbcr = (19, 19, 128)
+    input_shape_y = (38, 38, n_coefficients)
+    input_shape_cbcr = (19, 19, 2 * n_coefficients)
+
+    input_y = Input(shape=input_shape_y, dtype="int16")
+    input_cbcr = Input(shape=input_shape_cbcr, dtype="int16")
 
-    input_y = Input(shape=input_shape_y)
-    input_cbcr = Input(shape=input_shape_cbcr)
+    # The coefficients are given as int16 and cast on the graph
+    float_y = CastToFloat(name="cast_y")(input_y)
+    float_cbcr = CastToFloat(name="cast_cbcr")(input_cbcr)
 
     bn_y = BatchNormalization(
-        axis=3, momentum=0.9, epsilon=1e-5, name='bn_y')(input_y)
+        axis=3, momentum=0.9, epsilon=1e-5, name='bn_y')(float_y)
 
     y = conv_block(bn_y, 1, [256, 256, 384],
                    stage=1, block="a_y", strides=(1, 1), kernel_reg=l2_reg)
@@ -190,7 +201,7 @@ def feature_map_lcrfat(image_shape: Tuple[int, int],  kernel_initializer: str =
                    stage=3, block='a_y', kernel_reg=l2_reg)
 
     bn_cbcr = BatchNormalization(
-        axis=3, momentum=0.9, epsilon=1e-5, name='bn_cbcr')(input_cbcr)
+        axis=3, momentum=0.9, epsilon=1e-5, name='bn_cbcr')(float_cbcr)
     cbcr = conv_block(bn_cbcr, 1, [128, 128, 256],
                       stage=1, block='a_cbcr', strides=(1, 1), kernel_reg=l2_reg)
 
@@ -217,31 +228,37 @@ def feature_map_lcrfat(image_shape: Tuple[int, int],  kernel_initializer: str =
     return [input_y, input_cbcr], last, block4_conv3
 
 
-def feature_map_deconvolution_rfa(image_shape: Tuple[int, int],  kernel_initializer: str = 'he_normal', l2_reg=0.0005):
+def feature_map_deconvolution_rfa(image_shape: Tuple[int, int],  kernel_initializer: str = 'he_normal', l2_reg=0.0005, n_coefficients: int=64):
     """ Helper function that generates the first layers of the SSD. This function generates the layers for the DCT network.
 
     # Arguments:
         - image_shape: A tuple containing the shape of the image.
         - l2_regularization: The float value for the l2 normalization.
         - kernel_initializer: The type of initializer for the convolution kernels.
+        - n_coefficients: The number of DCT coefficients per block and per component given as input, the first ones in zig-zag order (see `n_coefficients` in `jpeg_deep.generators`).
 
     # Returns:
         Three layers: input_layer, block4_pool, block4_conv3. These layers are used to intantiate the network.
     """
-    input_shape_y = (38, 38, 64)
-    input_shape_cb = (19, 19, 64)
-    input_shape_cr = (19, 19, 64)
+    input_shape_y = (38, 38, n_coefficients)
+    input_shape_cb = (19, 19, n_coefficients)
+    input_shape_cr = (19, 19, n_coefficients)
+
+    input_y = Input(shape=input_shape_y, dtype="int16")
+    input_cb = Input(shape=input_shape_cb, dtype="int16")
+    input_cr = Input(shape=input_shape_cr, dtype="int16")
 
-    input_y = Input(shape=input_shape_y)
-    input_cb = Input(shape=input_shape_cb)
-    input_cr = Input(shape=input_shape_cr)
+    # The coefficients are given as int16 and cast on the graph
+    float_y = CastToFloat(name="cast_y")(input_y)
+    float_cb = CastToFloat(name="cast_cb")(input_cb)
+    float_cr = CastToFloat(name="cast_cr")(input_cr)
 
     cb = Conv2DTranspose(64, kernel_size=(2, 2), strides=2,
-                         kernel_regularizer=l2(l2_reg))(input_cb)
+                         kernel_regularizer=l2(l2_reg))(float_cb)
     cr = Conv2DTranspose(64, kernel_size=(2, 2), strides=2,
-                         kernel_regularizer=l2(l2_reg))(input_cr)
+                         kernel_regularizer=l2(l2_reg))(float_cr)
 
-    x = Concatenate(axis=-1)([input_y, cb, cr])
+    x = Concatenate(axis=-1)([float_y, cb, cr])
     x = BatchNormalization(axis=3, momentum=0.9,
                            epsilon=1e-5, name='bn_cbcr')(x)
 
@@ -284,23 +301,27 @@ def feature_map_deconvolution_rfa(image_shape: Tuple[int, int],  kernel_initiali
 
     return [input_y, input_cb, input_cr], last, block4_conv3
 
-def feature_map_lcrfa_y(image_shape: Tuple[int, int],  kernel_initializer: str = 'he_normal', l2_reg=0.0005):
+def feature_map_lcrfa_y(image_shape: Tuple[int, int],  kernel_initializer: str = 'he_normal', l2_reg=0.0005, n_coefficients: int=64):
     """ Helper function that generates the first layers of the SSD. This function generates the layers for the DCT network.
 
     # Arguments:
         - image_shape: A tuple containing the shape of the image.
         - l2_regularization: The float value for the l2 normalization.
         - kernel_initializer: The type of initializer for the convolution kernels.
+        - n_coefficients: The number of DCT coefficients per block and per component given as input, the first ones in zig-zag order (see `n_coefficients` in `jpeg_deep.generators`).
 
     # Returns:
         Three layers: input_layer, block4_pool, block4_conv3. These layers are used to intantiate the network.
     """
-    input_shape_y = (38, 38, 64)
+    input_shape_y = (38, 38, n_coefficients)
 
-    input_y = Input(shape=input_shape_y)
+    input_y = Input(shape=input_shape_y, dtype="int16")
+
+    # The coefficients are given as int16 and cast on the graph
+    float_y = CastToFloat(name="cast_y")(input_y)
 
     bn_y = BatchNormalization(
-        axis=3, momentum=0.9, epsilon=1e-5, name='bn_y')(input_y)
+        axis=3, momentum=0.9, epsilon=1e-5, name='bn_y')(float_y)
 
     x = conv_block(bn_y, 1, [256, 256, 1024],
                    stage=1, block="a_y", strides=(1, 1), kernel_reg=l2_reg)
@@ -342,23 +363,27 @@ def feature_map_lcrfa_y(image_shape: Tuple[int, int],  kernel_initializer: str =
     return input_y, last, block4_conv3
 
 
-def feature_map_lcrfat_y(image_shape: Tuple[int, int],  kernel_initializer: str = 'he_normal', l2_reg=0.0005):
+def feature_map_lcrfat_y(image_shape: Tuple[int, int],  kernel_initializer: str = 'he_normal', l2_reg=0.0005, n_coefficients: int=64):
     """ Helper function that generates the first layers of the SSD. This function generates the layers for the DCT network.
 
     # Arguments:
         - image_shape: A tuple containing the shape of the image.
         - l2_regularization: The float value for the l2 normalization.
         - kernel_initializer: The type of initializer for the convolution kernels.
+        - n_coefficients: The number of DCT coefficients per block and per component given as input, the first ones in zig-zag order (see `n_coefficients` in `jpeg_deep.generators`).
 
     # Returns:
         Three layers: input_layer, block4_pool, block4_conv3. These layers are used to intantiate the network.
     """
-    input_shape_y = (38, 38, 64)
+    input_shape_y = (38, 38, n_coefficients)
+
+    input_y = Input(shape=input_shape_y, dtype="int16")
 
-    input_y = Input(shape=input_shape_y)
+    # The coefficients are given as int16 and cast on the graph
+    float_y = CastToFloat(name="cast_y")(input_y)
 
     bn_y = BatchNormalization(
-        axis=3, momentum=0.9, epsilon=1e-5, name='bn_y')(input_y)
+        axis=3, momentum=0.9, epsilon=1e-5, name='bn_y')(float_y)
 
     x = conv_block(bn_y, 1, [256, 256, 384],
                    stage=1, block="a_y", strides=(1, 1), kernel_reg=l2_reg)
@@ -8,6 +8,8 @@ from keras.models import Model
 from keras.layers import Input, Conv2D, MaxPooling2D, Concatenate, BatchNormalization, Conv2DTranspose, Lambda
 from keras.regularizers import l2
 
+from jpeg_deep.layers.dct_layers import CastToFloat
+
 
 def feature_map_rgb(image_shape: Tuple[int, int], kernel_initializer: str = 'he_normal', l2_reg=0.0005, rescale_position: int = 0):
     """ Helper function that generates the first layers of the SSD. This function generates the layers for the RGB network.
@@ -61,33 +63,38 @@ def identity_layer(tensor):
     return tensor
 
 
-def feature_map_dct(image_shape: Tuple[int, int],  kernel_initializer: str = 'he_normal', l2_reg=0.0005, rescale_position: int = 0):
+def feature_map_dct(image_shape: Tuple[int, int],  kernel_initializer: str = 'he_normal', l2_reg=0.0005, rescale_position: int = 0, n_coefficients: int=64):
     """ Helper function that generates the first layers of the SSD. This function generates the layers for the DCT network.
 
     # Arguments:
         - image_shape: A tuple containing the shape of the image.
         - l2_regularization: The float value for the l2 normalization.
         - kernel_initializer: The type of initializer for the convolution kernels.
+        - n_coefficients: The number of DCT coefficients per block and per component given as input, the first ones in zig-zag order (see `n_coefficients` in `jpeg_deep.generators`).
 
     # Returns:
         Three layers: input_layer, block4_pool, block4_conv3. These layers are used to intantiate the network.
     """
     if image_shape[0] is None:
-        input_shape_y = (None, None, 64)
-        input_shape_cbcr = (None, None, 128)
+        input_shape_y = (None, None, n_coefficients)
+        input_shape_cbcr = (None, None, 2 * n_coefficients)
     else:
         img_h, img_w = image_shape
-        input_shape_y = (img_h, img_w, 64)
-        input_shape_cbcr = (img_h / 2, img_w / 2, 128)
+        input_shape_y = (img_h, img_w, n_coefficients)
+        input_shape_cbcr = (img_h / 2, img_w / 2, 2 * n_coefficients)
+
+    input_y = Input(input_shape_y, dtype="int16")
+    input_cbcr = Input(input_shape_cbcr, dtype="int16")
 
-    input_y = Input(input_shape_y)
-    input_cbcr = Input(input_shape_cbcr)
+    # The coefficients are given as int16 and cast on the graph
+    float_y = CastToFloat(name="cast_y")(input_y)
+    float_cbcr = CastToFloat(name="cast_cbcr")(input_cbcr)
 
     norm_cbcr = BatchNormalization(
-        name="b_norm_cbcr", input_shape=input_shape_cbcr)(input_cbcr)
+        name="b_norm_cbcr", input_shape=input_shape_cbcr)(float_cbcr)
     # Block 1
     norm_y = BatchNormalization(
-        name="b_norm_y", input_shape=input_shape_y)(input_y)
+        name="b_norm_y", input_shape=input_shape_y)(float_y)
 
 
     block1_conv1 = Conv2D(256, (3, 3), kernel_regularizer=l2(l2_reg),
@@ -121,31 +128,37 @@ def feature_map_dct(image_shape: Tuple[int, int],  kernel_initializer: str = 'he
     return [input_y, input_cbcr], concat, block4_conv3
 
 
-def feature_map_dct_deconv(input_shape: Tuple[int, int],  kernel_initializer: str = 'he_normal', l2_reg=0.0005):
+def feature_map_dct_deconv(input_shape: Tuple[int, int],  kernel_initializer: str = 'he_normal', l2_reg=0.0005, n_coefficients: int=64):
     """ Helper function that generates the first layers of the SSD. This function generates the layers for the DCT network.
 
     # Arguments:
         - image_shape: A tuple containing the shape of the image.
         - l2_regularization: The float value for the l2 normalization.
         - kernel_initializer: The type of initializer for the convolution kernels.
+        - n_coefficients: The number of DCT coefficients per block and per component given as input, the first ones in zig-zag order (see `n_coefficients` in `jpeg_deep.generators`).
 
     # Returns:
         Three layers: input_layer, block4_pool, block4_conv3. These layers are used to intantiate the network.
     """
-    input_shape_y = (*input_shape, 64)
-    input_shape_cb = (input_shape[0] // 2, input_shape[1] // 2, 64)
-    input_shape_cr = (input_shape[0] // 2, input_shape[1] // 2, 64)
+    input_shape_y = (*input_shape, n_coefficients)
+    input_shape_cb = (input_shape[0] // 2, input_shape[1] // 2, n_coefficients)
+    input_shape_cr = (input_shape[0] // 2, input_shape[1] // 2, n_coefficients)
+
+    input_y = Input(input_shape_y, dtype="int16")
+    input_cb = Input(shape=input_shape_cb, dtype="int16")
+    input_cr = Input(shape=input_shape_cr, dtype="int16")
 
-    input_y = Input(input_shape_y)
-    input_cb = Input(shape=input_shape_cb)
-    input_cr = Input(shape=input_shape_cr)
+    # The coefficients are given as int16 and cast on the graph
+    float_y = CastToFloat(name="cast_y")(input_y)
+    float_cb = CastToFloat(name="cast_cb")(input_cb)
+    float_cr = CastToFloat(name="cast_cr")(input_cr)
 
     cb = Conv2DTranspose(64, kernel_size=(2, 2), strides=2,
-                         kernel_regularizer=l2(l2_reg), name="deconv_cb")(input_cb)
+                         kernel_regularizer=l2(l2_reg), name="deconv_cb")(float_cb)
     cr = Conv2DTranspose(64, kernel_size=(2, 2), strides=2,
-                         kernel_regularizer=l2(l2_reg), name="deconv_cr")(input_cr)
+                         kernel_regularizer=l2(l2_reg), name="deconv_cr")(float_cr)
 
-    x = Concatenate(axis=-1)([input_y, cb, cr])
+    x = Concatenate(axis=-1)([float_y, cb, cr])
 
     x = BatchNormalization(
         name="b_norm")(x)
@@ -171,21 +184,27 @@ def feature_map_dct_deconv(input_shape: Tuple[int, int],  kernel_initializer: st
     return [input_y, input_cb, input_cr], block4_pool, block4_conv3
 
 
-def feature_map_dct_y(input_shape: Tuple[int, int],  kernel_initializer: str = 'he_normal', l2_reg=0.0005):
+def feature_map_dct_y(input_shape: Tuple[int, int],  kernel_initializer: str = 'he_normal', l2_reg=0.0005, n_coefficients: int=64):
     """Instantiates the VGG16 architecture.
         classes: optional number of classes to classify images
             into, only to be specified if `include_top` is True, and
             if no `weights` argument is specified.
+
+    # Arguments:
+        - n_coefficients: The number of DCT coefficients per block and per component given as input, the first ones in zig-zag order (see `n_coefficients` in `jpeg_deep.generators`).
     # Returns
         A Keras model instance.
     """
-    input_shape_y = (*input_shape, 64)
+    input_shape_y = (*input_shape, n_coefficients)
+
+    input_y = Input(input_shape_y, dtype="int16")
 
-    input_y = Input(input_shape_y)
+    # The coefficients are given as int16 and cast on the graph
+    float_y = CastToFloat(name="cast_y")(input_y)
 
     # Block 1
     x = BatchNormalization(
-        name="b_norm_64", input_shape=input_shape_y)(input_y)
+        name="b_norm_64", input_shape=input_shape_y)(float_y)
 
     x = Conv2D(256, (3, 3),
                activation='relu',
@@ -13,34 +13,46 @@ from keras.regularizers import l2
 from keras.layers import Input, BatchNormalization, Concatenate, GlobalAveragePooling2D, Dense, Conv2DTranspose
 from keras.models import Model
 
+from jpeg_deep.layers.dct_layers import CastToFloat, MaskedGlobalAveragePooling2D
+
 from .resnet_blocks import identity_block, conv_block
 
 
-def late_concat_rfa(input_shape: Tuple[int]=(28, 28), classes: int = 1000):
+def late_concat_rfa(input_shape: Tuple[int]=(28, 28), classes: int = 1000, n_coefficients: int=64, masked: bool=False):
     """
     Random field aware DCT version of the ResNet50 network.
 
     # Arguments:
         - input_shape: The dimension of the inputs (x, y).
         - classes: The number of classes the network should predict.
+        - n_coefficients: The number of DCT coefficients per block and per component given as input, the first ones in zig-zag order (see `n_coefficients` in `jpeg_deep.generators`).
+        - masked: If the network takes the validity mask of padded inputs as last input (see `bucket_step` in `DCTGeneratorJPEG2DCT`), to exclude the padding from the global average pooling. Used for batched inference on images of different sizes.
 
     # Returns:
         A Keras model instance.
     """
     if input_shape is None:
-        input_shape_y = (None, None, 64)
-        input_shape_cbcr = (None, None, 128)
+        input_shape_y = (None, None, n_coefficients)
+        input_shape_cbcr = (None, None, 2 * n_coefficients)
     else:
-        input_shape_y = (*input_shape, 64)
-        input_shape_cbcr = (input_shape[0] // 2, input_shape[1] // 2, 128)
+        input_shape_y = (*input_shape, n_coefficients)
+        input_shape_cbcr = (input_shape[0] // 2, input_shape[1] // 2, 2 * n_coefficients)
+
+    input_y = Input(shape=input_shape_y, dtype="int16")
+    input_cbcr = Input(shape=input_shape_cbcr, dtype="int16")
 
-    input_y = Input(shape=input_shape_y)
-    input_cbcr = Input(shape=input_shape_cbcr)
+    # The coefficients are given as int16 and cast on the graph
+    float_y = CastToFloat(name="cast_y")(input_y)
+    float_cbcr = CastToFloat(name="cast_cbcr")(input_cbcr)
+
+    if masked:
+        input_mask = Input(input_shape_y[:2] + (1,), dtype="uint8")
+        float_mask = CastToFloat(name="cast_mask")(input_mask)
 
     bn_axis = 3
 
     bn_y = BatchNormalization(
-        axis=bn_axis, momentum=0.9, epsilon=1e-5, name='bn_y')(input_y)
+        axis=bn_axis, momentum=0.9, epsilon=1e-5, name='bn_y')(float_y)
 
     y = conv_block(bn_y, 1, [256, 256, 1024],
                    stage=1, block="a_y", strides=(1, 1))
@@ -55,7 +67,7 @@ def late_concat_rfa(input_shape: Tuple[int]=(28, 28), classes: int = 1000):
     y = conv_block(y, 3, [128, 128, 512], stage=3, block='a_y')
 
     bn_cbcr = BatchNormalization(
-        axis=bn_axis, momentum=0.9, epsilon=1e-5, name='bn_cbcr')(input_cbcr)
+        axis=bn_axis, momentum=0.9, epsilon=1e-5, name='bn_cbcr')(float_cbcr)
     cbcr = conv_block(bn_cbcr, 1, [128, 128, 512],
                       stage=1, block='a_cbcr', strides=(1, 1))
 
@@ -71,41 +83,54 @@ def late_concat_rfa(input_shape: Tuple[int]=(28, 28), classes: int = 1000):
     x = identity_block(x, 3, [512, 512, 2048], stage=5, block='b')
     x = identity_block(x, 3, [512, 512, 2048], stage=5, block='c')
 
-    x = GlobalAveragePooling2D(name='avg_pool')(x)
+    if masked:
+        x = MaskedGlobalAveragePooling2D(reductions=[(1, 2), (1, 2)], name='avg_pool')([x, float_mask])
+    else:
+        x = GlobalAveragePooling2D(name='avg_pool')(x)
     x = Dense(classes, activation='softmax',
               kernel_regularizer=l2(0.00005), name='fc1000')(x)
 
-    model = Model([input_y, input_cbcr], x,
+    model = Model([input_y, input_cbcr] + ([input_mask] if masked else []), x,
                   name='resnet50_late_concat_rfa')
 
     return model
 
 
-def late_concat_rfa_thinner(input_shape: Tuple[int]=(28, 28), classes:int=1000):
+def late_concat_rfa_thinner(input_shape: Tuple[int]=(28, 28), classes:int=1000, n_coefficients: int=64, masked: bool=False):
     """
     Random field aware DCT version of the ResNet50 network (thinner version).
 
     # Arguments:
         - input_shape: The dimension of the inputs (x, y).
         - classes: The number of classes the network should predict.
+        - n_coefficients: The number of DCT coefficients per block and per component given as input, the first ones in zig-zag order (see `n_coefficients` in `jpeg_deep.generators`).
+        - masked: If the network takes the validity mask of padded inputs as last input (see `bucket_step` in `DCTGeneratorJPEG2DCT`), to exclude the padding from the global average pooling. Used for batched inference on images of different sizes.
 
     # Returns:
         A Keras model instance.
     """
     if input_shape is None:
-        input_shape_y = (None, None, 64)
-        input_shape_cbcr = (None, None, 128)
+        input_shape_y = (None, None, n_coefficients)
+        input_shape_cbcr = (None, None, 2 * n_coefficients)
     else:
-        input_shape_y = (*input_shape, 64)
-        input_shape_cbcr = (input_shape[0] // 2, input_shape[1] // 2, 128)
+        input_shape_y = (*input_shape, n_coefficients)
+        input_shape_cbcr = (input_shape[0] // 2, input_shape[1] // 2, 2 * n_coefficients)
 
-    input_y = Input(shape=input_shape_y)
-    input_cbcr = Input(shape=input_shape_cbcr)
+    input_y = Input(shape=input_shape_y, dtype="int16")
+    input_cbcr = Input(shape=input_shape_cbcr, dtype="int16")
+
+    # The coefficients are given as int16 and cast on the graph
+    float_y = CastToFloat(name="cast_y")(input_y)
+    float_cbcr = CastToFloat(name="cast_cbcr")(input_cbcr)
+
+    if masked:
+        input_mask = Input(input_shape_y[:2] + (1,), dtype="uint8")
+        float_mask = CastToFloat(name="cast_mask")(input_mask)
 
     bn_axis = 3
 
     bn_y = BatchNormalization(
-        axis=bn_axis, momentum=0.9, epsilon=1e-5, name='bn_y')(input_y)
+        axis=bn_axis, momentum=0.9, epsilon=1e-5, name='bn_y')(float_y)
 
     y = conv_block(bn_y, 1, [256, 256, 384],
                    stage=1, block="a_y", strides=(1, 1))
@@ -120,7 +145,7 @@ def late_concat_rfa_thinner(input_shape: Tuple[int]=(28, 28), classes:int=1000):
     y = conv_block(y, 3, [128, 128, 768], stage=3, block='a_y')
 
     bn_cbcr = BatchNormalization(
-        axis=bn_axis, momentum=0.9, epsilon=1e-5, name='bn_cbcr')(input_cbcr)
+        axis=bn_axis, momentum=0.9, epsilon=1e-5, name='bn_cbcr')(float_cbcr)
     cbcr = conv_block(bn_cbcr, 1, [128, 128, 256],
                       stage=1, block='a_cbcr', strides=(1, 1))
 
@@ -136,47 +161,61 @@ def late_concat_rfa_thinner(input_shape: Tuple[int]=(28, 28), classes:int=1000):
     x = identity_block(x, 3, [512, 512, 2048], stage=5, block='b')
     x = identity_block(x, 3, [512, 512, 2048], stage=5, block='c')
 
-    x = GlobalAveragePooling2D(name='avg_pool')(x)
+    if masked:
+        x = MaskedGlobalAveragePooling2D(reductions=[(1, 2), (1, 2)], name='avg_pool')([x, float_mask])
+    else:
+        x = GlobalAveragePooling2D(name='avg_pool')(x)
     x = Dense(classes, activation='softmax',
               kernel_regularizer=l2(0.00005), name='fc1000')(x)
 
     # Create model.
-    model = Model([input_y, input_cbcr], x,
+    model = Model([input_y, input_cbcr] + ([input_mask] if masked else []), x,
                   name='resnet50_late_concat_rfa_thinner')
 
     return model
 
 
-def deconvolution_rfa(input_shape: Tuple[int]=(28, 28), classes: int = 1000):
+def deconvolution_rfa(input_shape: Tuple[int]=(28, 28), classes: int = 1000, n_coefficients: int=64, masked: bool=False):
     """
     Deconvolution DCT version of the ResNet network.
 
     # Arguments:
         - input_shape: The dimension of the inputs (x, y).
         - classes: The number of classes the network should predict.
+        - n_coefficients: The number of DCT coefficients per block and per component given as input, the first ones in zig-zag order (see `n_coefficients` in `jpeg_deep.generators`).
+        - masked: If the network takes the validity mask of padded inputs as last input (see `bucket_step` in `DCTGeneratorJPEG2DCT`), to exclude the padding from the global average pooling. Used for batched inference on images of different sizes.
 
     # Returns:
         A Keras model instance.
     """
     if input_shape is None:
-        input_shape_y = (None, None, 64)
-        input_shape_cb = (None, None, 64)
-        input_shape_cr = (None, None, 64)
+        input_shape_y = (None, None, n_coefficients)
+        input_shape_cb = (None, None, n_coefficients)
+        input_shape_cr = (None, None, n_coefficients)
     else:
-        input_shape_y = (*input_shape, 64)
-        input_shape_cb = (input_shape[0] // 2, input_shape[1] // 2, 64)
-        input_shape_cr = (input_shape[0] // 2, input_shape[1] // 2, 64)
+        input_shape_y = (*input_shape, n_coefficients)
+        input_shape_cb = (input_shape[0] // 2, input_shape[1] // 2, n_coefficients)
+        input_shape_cr = (input_shape[0] // 2, input_shape[1] // 2, n_coefficients)
+
+    input_y = Input(shape=input_shape_y, dtype="int16")
+    input_cb = Input(shape=input_shape_cb, dtype="int16")
+    input_cr = Input(shape=input_shape_cr, dtype="int16")
 
-    input_y = Input(shape=input_shape_y)
-    input_cb = Input(shape=input_shape_cb)
-    input_cr = Input(shape=input_shape_cr)
+    # The coefficients are given as int16 and cast on the graph
+    float_y = CastToFloat(name="cast_y")(input_y)
+    float_cb = CastToFloat(name="cast_cb")(input_cb)
+    float_cr = CastToFloat(name="cast_cr")(input_cr)
+
+    if masked:
+        input_mask = Input(input_shape_y[:2] + (1,), dtype="uint8")
+        float_mask = CastToFloat(name="cast_mask")(input_mask)
 
     cb = Conv2DTranspose(64, kernel_size=(2, 2), strides=2,
-                         kernel_regularizer=l2(0.00005))(input_cb)
+                         kernel_regularizer=l2(0.00005))(float_cb)
     cr = Conv2DTranspose(64, kernel_size=(2, 2), strides=2,
-                         kernel_regularizer=l2(0.00005))(input_cr)
+                         kernel_regularizer=l2(0.00005))(float_cr)
 
-    x = Concatenate(axis=-1)([input_y, cb, cr])
+    x = Concatenate(axis=-1)([float_y, cb, cr])
     x = BatchNormalization(axis=3, momentum=0.9,
                            epsilon=1e-5, name='bn_cbcr')(x)
 
@@ -200,38 +239,50 @@ def deconvolution_rfa(input_shape: Tuple[int]=(28, 28), classes: int = 1000):
     x = identity_block(x, 3, [512, 512, 2048], stage=5, block='b')
     x = identity_block(x, 3, [512, 512, 2048], stage=5, block='c')
 
-    x = GlobalAveragePooling2D(name='avg_pool')(x)
+    if masked:
+        x = MaskedGlobalAveragePooling2D(reductions=[(1, 2), (1, 2)], name='avg_pool')([x, float_mask])
+    else:
+        x = GlobalAveragePooling2D(name='avg_pool')(x)
     x = Dense(classes, activation='softmax',
               kernel_regularizer=l2(0.00005), name='fc1000')(x)
 
-    model = Model([input_y, input_cb, input_cr], x,
+    model = Model([input_y, input_cb, input_cr] + ([input_mask] if masked else []), x,
                   name='resnet50_deconv_rfa')
 
     return model
 
 
-def late_concat_rfa_y(input_shape: Tuple[int]=(28, 28), classes: int = 1000):
+def late_concat_rfa_y(input_shape: Tuple[int]=(28, 28), classes: int = 1000, n_coefficients: int=64, masked: bool=False):
     """
     Random field aware DCT Y version of the ResNet50 network.
 
     # Arguments:
         - input_shape: The dimension of the inputs (x, y).
         - classes: The number of classes the network should predict.
+        - n_coefficients: The number of DCT coefficients per block and per component given as input, the first ones in zig-zag order (see `n_coefficients` in `jpeg_deep.generators`).
+        - masked: If the network takes the validity mask of padded inputs as last input (see `bucket_step` in `DCTGeneratorJPEG2DCT`), to exclude the padding from the global average pooling. Used for batched inference on images of different sizes.
 
     # Returns:
         A Keras model instance.
     """
     if input_shape is None:
-        input_shape_y = (None, None, 64)
+        input_shape_y = (None, None, n_coefficients)
     else:
-        input_shape_y = (*input_shape, 64)
+        input_shape_y = (*input_shape, n_coefficients)
+
+    input_y = Input(shape=input_shape_y, dtype="int16")
+
+    # The coefficients are given as int16 and cast on the graph
+    float_y = CastToFloat(name="cast_y")(input_y)
 
-    input_y = Input(shape=input_shape_y)
+    if masked:
+        input_mask = Input(input_shape_y[:2] + (1,), dtype="uint8")
+        float_mask = CastToFloat(name="cast_mask")(input_mask)
 
     bn_axis = 3
 
     bn_y = BatchNormalization(
-        axis=bn_axis, momentum=0.9, epsilon=1e-5, name='bn_y')(input_y)
+        axis=bn_axis, momentum=0.9, epsilon=1e-5, name='bn_y')(float_y)
 
     x = conv_block(bn_y, 1, [256, 256, 1024],
                    stage=1, block="a_y", strides=(1, 1))
@@ -254,38 +305,50 @@ def late_concat_rfa_y(input_shape: Tuple[int]=(28, 28), classes: int = 1000):
     x = identity_block(x, 3, [512, 512, 2048], stage=5, block='b')
     x = identity_block(x, 3, [512, 512, 2048], stage=5, block='c')
 
-    x = GlobalAveragePooling2D(name='avg_pool')(x)
+    if masked:
+        x = MaskedGlobalAveragePooling2D(reductions=[(1, 2), (1, 2)], name='avg_pool')([x, float_mask])
+    else:
+        x = GlobalAveragePooling2D(name='avg_pool')(x)
     x = Dense(classes, activation='softmax',
               kernel_regularizer=l2(0.00005), name='fc1000')(x)
 
-    model = Model(input_y, x,
+    model = Model([input_y] + ([input_mask] if masked else []), x,
                   name='resnet50_late_concat_rfa_y')
 
     return model
 
 
-def late_concat_rfa_y_thinner(input_shape: Tuple[int]=(28, 28), classes:int=1000):
+def late_concat_rfa_y_thinner(input_shape: Tuple[int]=(28, 28), classes:int=1000, n_coefficients: int=64, masked: bool=False):
     """
     Random field aware DCT Y version of the ResNet50 network (thinner version).
 
     # Arguments:
         - input_shape: The dimension of the inputs (x, y).
         - classes: The number of classes the network should predict.
+        - n_coefficients: The number of DCT coefficients per block and per component given as input, the first ones in zig-zag order (see `n_coefficients` in `jpeg_deep.generators`).
+        - masked: If the network takes the validity mask of padded inputs as last input (see `bucket_step` in `DCTGeneratorJPEG2DCT`), to exclude the padding from the global average pooling. Used for batched inference on images of different sizes.
 
     # Returns:
         A Keras model instance.
     """
     if input_shape is None:
-        input_shape_y = (None, None, 64)
+        input_shape_y = (None, None, n_coefficients)
     else:
-        input_shape_y = (*input_shape, 64)
+        input_shape_y = (*input_shape, n_coefficients)
+
+    input_y = Input(shape=input_shape_y, dtype="int16")
 
-    input_y = Input(shape=input_shape_y)
+    # The coefficients are given as int16 and cast on the graph
+    float_y = CastToFloat(name="cast_y")(input_y)
+
+    if masked:
+        input_mask = Input(input_shape_y[:2] + (1,), dtype="uint8")
+        float_mask = CastToFloat(name="cast_mask")(input_mask)
 
     bn_axis = 3
 
     bn_y = BatchNormalization(
-        axis=bn_axis, momentum=0.9, epsilon=1e-5, name='bn_y')(input_y)
+        axis=bn_axis, momentum=0.9, epsilon=1e-5, name='bn_y')(float_y)
 
     x = conv_block(bn_y, 1, [256, 256, 384],
                    stage=1, block="a_y", strides=(1, 1))
@@ -309,12 +372,15 @@ def late_concat_rfa_y_thinner(input_shape: Tuple[int]=(28, 28), classes:int=1000
     x = identity_block(x, 3, [512, 512, 2048], stage=5, block='b')
     x = identity_block(x, 3, [512, 512, 2048], stage=5, block='c')
 
-    x = GlobalAveragePooling2D(name='avg_pool')(x)
+    if masked:
+        x = MaskedGlobalAveragePooling2D(reductions=[(1, 2), (1, 2)], name='avg_pool')([x, float_mask])
+    else:
+        x = GlobalAveragePooling2D(name='avg_pool')(x)
     x = Dense(classes, activation='softmax',
               kernel_regularizer=l2(0.00005), name='fc1000')(x)
 
     # Create model.
-    model = Model(input_y, x,
+    model = Model([input_y] + ([input_mask] if masked else []), x,
                   name='resnet50_late_concat_rfa_y_thinner')
 
     return model
@@ -22,7 +22,8 @@ def SSD300(n_classes: int = 20,
            nms_max_output_size: int = 400,
            dct: bool = False,
            scales:List=None,
-           image_shape: Tuple[int, int] = (300, 300)):
+           image_shape: Tuple[int, int] = (300, 300),
+           n_coefficients: int = 64):
     '''
     Builds a ssd network, the network built can either be an RGB or DCT network. For more details on the architecture, see [the article](https://arxiv.org/abs/1512.02325v5).
 
@@ -39,6 +40,7 @@ def SSD300(n_classes: int = 20,
         - dct: A boolean to set the network for DCT inference (or RGB is False).
         - scales: The scales for each of the prediction layers.
         - image_shape: If known, the size of the inputs, in the format (height, width).
+        - n_coefficients: For the DCT backbones, the number of DCT coefficients per block and per component given as input, the first ones in zig-zag order.
 
     # Returns:
         - model: A keras model, representation of the SSD.
@@ -85,13 +87,13 @@ def SSD300(n_classes: int = 20,
             image_shape, kernel_initializer=kernel_initializer)
     elif backbone == "VGGDCT":
         input_layer, block4_pool, block4_conv3 = feature_map_dct(
-            image_shape, kernel_initializer=kernel_initializer)
+            image_shape, kernel_initializer=kernel_initializer, n_coefficients=n_coefficients)
     elif backbone == "VGGDCT_deconv":
         input_layer, block4_pool, block4_conv3 = feature_map_dct_deconv(
-            (38, 38), kernel_initializer=kernel_initializer)
+            (38, 38), kernel_initializer=kernel_initializer, n_coefficients=n_coefficients)
     else:
         input_layer, block4_pool, block4_conv3 = feature_map_dct_y(
-            (38, 38), kernel_initializer=kernel_initializer)
+            (38, 38), kernel_initializer=kernel_initializer, n_coefficients=n_coefficients)
 
     # Create the network.
     if backbone == "VGG16":
@@ -25,7 +25,8 @@ def SSD300_resnet(n_classes: int = 20,
                   nms_max_output_size: int = 400,
                   dct: bool = False,
                   scales: int=None,
-                  image_shape: Tuple[int, int] = (300, 300)):
+                  image_shape: Tuple[int, int] = (300, 300),
+                  n_coefficients: int = 64):
     '''
     Builds a ssd network, the network built can either be an RGB or DCT network. For more details on the architecture, see [the article](https://arxiv.org/abs/1512.02325v5).
 
@@ -42,6 +43,7 @@ def SSD300_resnet(n_classes: int = 20,
         - dct: A boolean to set the network for DCT inference (or RGB is False).
         - scales: The scales for each of the prediction layers.
         - image_shape: If known, the size of the inputs, in the format (height, width).
+        - n_coefficients: For the DCT backbones, the number of DCT coefficients per block and per component given as input, the first ones in zig-zag order.
 
     # Returns:
         - model: A keras model, representation of the SSD.
@@ -87,19 +89,19 @@ def SSD300_resnet(n_classes: int = 20,
             image_shape, kernel_initializer=kernel_initializer, l2_reg=l2_regularizer)
     elif backbone == "lcrfa":
         input_layer, fc7, block4_conv3 = feature_map_lcrfa(
-            (38, 38), kernel_initializer=kernel_initializer, l2_reg=l2_regularizer)
+            (38, 38), kernel_initializer=kernel_initializer, l2_reg=l2_regularizer, n_coefficients=n_coefficients)
     elif backbone == "lcrfat":
         input_layer, fc7, block4_conv3 = feature_map_lcrfat(
-            (38, 38), kernel_initializer=kernel_initializer, l2_reg=l2_regularizer)
+            (38, 38), kernel_initializer=kernel_initializer, l2_reg=l2_regularizer, n_coefficients=n_coefficients)
     elif backbone == "deconv_rfa":
         input_layer, fc7, block4_conv3 = feature_map_deconvolution_rfa(
-            (38, 38), kernel_initializer=kernel_initializer, l2_reg=l2_regularizer)
+            (38, 38), kernel_initializer=kernel_initializer, l2_reg=l2_regularizer, n_coefficients=n_coefficients)
     elif backbone == "lcrfa_y":
         input_layer, fc7, block4_conv3 = feature_map_lcrfa_y(
-            (38, 38), kernel_initializer=kernel_initializer, l2_reg=l2_regularizer)
+            (38, 38), kernel_initializer=kernel_initializer, l2_reg=l2_regularizer, n_coefficients=n_coefficients)
     else:
         input_layer, fc7, block4_conv3 = feature_map_lcrfat_y(
-            (38, 38), kernel_initializer=kernel_initializer, l2_reg=l2_regularizer)
+            (38, 38), kernel_initializer=kernel_initializer, l2_reg=l2_regularizer, n_coefficients=n_coefficients)
 
     conv6_1 = Conv2D(256, (1, 1), activation='relu', padding='same',
                      kernel_initializer=kernel_initializer, kernel_regularizer=l2(l2_regularizer), bias_regularizer=l2(l2_regularizer), name='conv6_1')(fc7)
@@ -5,28 +5,35 @@ from keras.models import Model
 from keras.layers import Input, BatchNormalization, Conv2D, MaxPooling2D, Flatten, Dense, Dropout, Conv2DTranspose, Concatenate, GlobalAveragePooling2D
 from keras.regularizers import l2
 
+from jpeg_deep.layers.dct_layers import CastToFloat, MaskedGlobalAveragePooling2D
 
-def VGG16_dct(classes: int=1000):
+
+def VGG16_dct(classes: int=1000, n_coefficients: int=64):
     """Instantiates the VGG16 DCT architecture.
 
     # Argument:
         - classes: The number of classes the network should predict.
+        - n_coefficients: The number of DCT coefficients per block and per component given as input, the first ones in zig-zag order (see `n_coefficients` in `jpeg_deep.generators`).
 
     # Returns:
         A Keras model instance.
     """
-    input_shape_y = (28, 28, 64)
-    input_shape_cbcr = (14, 14, 128)
+    input_shape_y = (28, 28, n_coefficients)
+    input_shape_cbcr = (14, 14, 2 * n_coefficients)
+
+    input_y = Input(input_shape_y, dtype="int16")
+    input_cbcr = Input(input_shape_cbcr, dtype="int16")
 
-    input_y = Input(input_shape_y)
-    input_cbcr = Input(input_shape_cbcr)
+    # The coefficients are given as int16 and cast on the graph
+    float_y = CastToFloat(name="cast_y")(input_y)
+    float_cbcr = CastToFloat(name="cast_cbcr")(input_cbcr)
 
     norm_cbcr = BatchNormalization(
-        name="b_norm_128", input_shape=input_shape_cbcr)(input_cbcr)
+        name="b_norm_128", input_shape=input_shape_cbcr)(float_cbcr)
 
     # Block 1
     x = BatchNormalization(
-        name="b_norm_64", input_shape=input_shape_y)(input_y)
+        name="b_norm_64", input_shape=input_shape_y)(float_y)
 
     x = Conv2D(256, (3, 3),
                activation='relu',
@@ -85,32 +92,42 @@ def VGG16_dct(classes: int=1000):
     return Model(inputs=[input_y, input_cbcr], outputs=x)
 
 
-def VGG16_dct_conv(classes:int=1000, input_shape: Tuple[int]=None):
+def VGG16_dct_conv(classes:int=1000, input_shape: Tuple[int]=None, n_coefficients: int=64, masked: bool=False):
     """ This is a modified version of the VGG16 DCT network to be fully convolutional.
 
     # Arguments:
         - classes: The number of classes to predict.
         - input_shape: The dimension of the inputs (x, y).
+        - n_coefficients: The number of DCT coefficients per block and per component given as input, the first ones in zig-zag order (see `n_coefficients` in `jpeg_deep.generators`).
+        - masked: If the network takes the validity mask of padded inputs as last input (see `bucket_step` in `DCTGeneratorJPEG2DCT`), to exclude the padding from the global average pooling. Used for batched inference on images of different sizes.
         
     # Returns:
         A Keras model instance.
     """
     if input_shape is None:
-        input_shape_y = (None, None, 64)
-        input_shape_cbcr = (None, None, 128)
+        input_shape_y = (None, None, n_coefficients)
+        input_shape_cbcr = (None, None, 2 * n_coefficients)
     else:
-        input_shape_y = (*input_shape, 64)
-        input_shape_cbcr = (input_shape[0] // 2, input_shape[1] // 2, 128)
+        input_shape_y = (*input_shape, n_coefficients)
+        input_shape_cbcr = (input_shape[0] // 2, input_shape[1] // 2, 2 * n_coefficients)
+
+    input_y = Input(input_shape_y, dtype="int16")
+    input_cbcr = Input(input_shape_cbcr, dtype="int16")
+
+    # The coefficients are given as int16 and cast on the graph
+    float_y = CastToFloat(name="cast_y")(input_y)
+    float_cbcr = CastToFloat(name="cast_cbcr")(input_cbcr)
 
-    input_y = Input(input_shape_y)
-    input_cbcr = Input(input_shape_cbcr)
+    if masked:
+        input_mask = Input(input_shape_y[:2] + (1,), dtype="uint8")
+        float_mask = CastToFloat(name="cast_mask")(input_mask)
 
     norm_cbcr = BatchNormalization(
-        name="b_norm_128", input_shape=input_shape_cbcr)(input_cbcr)
+        name="b_norm_128", input_shape=input_shape_cbcr)(float_cbcr)
 
     # Block 1
     x = BatchNormalization(
-        name="b_norm_64", input_shape=input_shape_y)(input_y)
+        name="b_norm_64", input_shape=input_shape_y)(float_y)
 
     x = Conv2D(256, (3, 3),
                activation='relu',
@@ -163,34 +180,43 @@ def VGG16_dct_conv(classes:int=1000, input_shape: Tuple[int]=None):
                name='conv2d_2')(x)
     x = Conv2D(classes, (1, 1), activation='softmax',
                name='conv2d_3')(x)
-    x = GlobalAveragePooling2D()(x)
+    if masked:
+        x = MaskedGlobalAveragePooling2D(reductions=[(2, 2), (2, 2), (7, 1)])([x, float_mask])
+    else:
+        x = GlobalAveragePooling2D()(x)
 
-    return Model(inputs=[input_y, input_cbcr], outputs=x)
+    return Model(inputs=[input_y, input_cbcr] + ([input_mask] if masked else []), outputs=x)
 
 
-def VGG16_dct_deconv(classes:int=1000, input_shape:Tuple[int]=(28, 28)):
+def VGG16_dct_deconv(classes:int=1000, input_shape:Tuple[int]=(28, 28), n_coefficients: int=64):
     """Instantiates the VGG16 DCT architecture.
 
     # Argument:
         - classes: The number of classes the network should predict.
+        - n_coefficients: The number of DCT coefficients per block and per component given as input, the first ones in zig-zag order (see `n_coefficients` in `jpeg_deep.generators`).
 
     # Returns:
         A Keras model instance.
     """
-    input_shape_y = (*input_shape, 64)
-    input_shape_cb = (input_shape[0] // 2, input_shape[1] // 2, 64)
-    input_shape_cr = (input_shape[0] // 2, input_shape[1] // 2, 64)
+    input_shape_y = (*input_shape, n_coefficients)
+    input_shape_cb = (input_shape[0] // 2, input_shape[1] // 2, n_coefficients)
+    input_shape_cr = (input_shape[0] // 2, input_shape[1] // 2, n_coefficients)
 
-    input_y = Input(input_shape_y)
-    input_cb = Input(shape=input_shape_cb)
-    input_cr = Input(shape=input_shape_cr)
+    input_y = Input(input_shape_y, dtype="int16")
+    input_cb = Input(shape=input_shape_cb, dtype="int16")
+    input_cr = Input(shape=input_shape_cr, dtype="int16")
+
+    # The coefficients are given as int16 and cast on the graph
+    float_y = CastToFloat(name="cast_y")(input_y)
+    float_cb = CastToFloat(name="cast_cb")(input_cb)
+    float_cr = CastToFloat(name="cast_cr")(input_cr)
 
     cb = Conv2DTranspose(64, kernel_size=(2, 2), strides=2,
-                         kernel_regularizer=l2(0.0005), name="deconv_cb")(input_cb)
+                         kernel_regularizer=l2(0.0005), name="deconv_cb")(float_cb)
     cr = Conv2DTranspose(64, kernel_size=(2, 2), strides=2,
-                         kernel_regularizer=l2(0.0005), name="deconv_cr")(input_cr)
+                         kernel_regularizer=l2(0.0005), name="deconv_cr")(float_cr)
 
-    x = Concatenate(axis=-1)([input_y, cb, cr])
+    x = Concatenate(axis=-1)([float_y, cb, cr])
 
     x = BatchNormalization(
         name="b_norm", input_shape=input_shape_y)(x)
@@ -244,35 +270,46 @@ def VGG16_dct_deconv(classes:int=1000, input_shape:Tuple[int]=(28, 28)):
     return Model(inputs=[input_y, input_cb, input_cr], outputs=x)
 
 
-def VGG16_dct_deconv_conv(classes:int=1000, input_shape:Tuple[int]=None):
+def VGG16_dct_deconv_conv(classes:int=1000, input_shape:Tuple[int]=None, n_coefficients: int=64, masked: bool=False):
     """ This is a modified version of the VGG16 DCT network to be fully convolutional.
 
     # Arguments:
         - classes: The number of classes to predict.
         - input_shape: The dimension of the inputs (x, y).
+        - n_coefficients: The number of DCT coefficients per block and per component given as input, the first ones in zig-zag order (see `n_coefficients` in `jpeg_deep.generators`).
+        - masked: If the network takes the validity mask of padded inputs as last input (see `bucket_step` in `DCTGeneratorJPEG2DCT`), to exclude the padding from the global average pooling. Used for batched inference on images of different sizes.
         
     # Returns:
         A Keras model instance.
     """
     if input_shape is None:
-        input_shape_y = (None, None, 64)
-        input_shape_cb = (None, None, 64)
-        input_shape_cr = (None, None, 64)
+        input_shape_y = (None, None, n_coefficients)
+        input_shape_cb = (None, None, n_coefficients)
+        input_shape_cr = (None, None, n_coefficients)
     else:
-        input_shape_y = (*input_shape, 64)
-        input_shape_cb = (input_shape[0] // 2, input_shape[1] // 2, 64)
-        input_shape_cr = (input_shape[0] // 2, input_shape[1] // 2, 64)
+        input_shape_y = (*input_shape, n_coefficients)
+        input_shape_cb = (input_shape[0] // 2, input_shape[1] // 2, n_coefficients)
+        input_shape_cr = (input_shape[0] // 2, input_shape[1] // 2, n_coefficients)
+
+    input_y = Input(input_shape_y, dtype="int16")
+    input_cb = Input(shape=input_shape_cb, dtype="int16")
+    input_cr = Input(shape=input_shape_cr, dtype="int16")
 
-    input_y = Input(input_shape_y)
-    input_cb = Input(shape=input_shape_cb)
-    input_cr = Input(shape=input_shape_cr)
+    # The coefficients are given as int16 and cast on the graph
+    float_y = CastToFloat(name="cast_y")(input_y)
+    float_cb = CastToFloat(name="cast_cb")(input_cb)
+    float_cr = CastToFloat(name="cast_cr")(input_cr)
+
+    if masked:
+        input_mask = Input(input_shape_y[:2] + (1,), dtype="uint8")
+        float_mask = CastToFloat(name="cast_mask")(input_mask)
 
     cb = Conv2DTranspose(64, kernel_size=(2, 2), strides=2,
-                         kernel_regularizer=l2(0.0005), name="deconv_cb")(input_cb)
+                         kernel_regularizer=l2(0.0005), name="deconv_cb")(float_cb)
     cr = Conv2DTranspose(64, kernel_size=(2, 2), strides=2,
-                         kernel_regularizer=l2(0.0005), name="deconv_cr")(input_cr)
+                         kernel_regularizer=l2(0.0005), name="deconv_cr")(float_cr)
 
-    x = Concatenate(axis=-1)([input_y, cb, cr])
+    x = Concatenate(axis=-1)([float_y, cb, cr])
 
     x = BatchNormalization(
         name="b_norm", input_shape=input_shape_y)(x)
@@ -317,27 +354,34 @@ def VGG16_dct_deconv_conv(classes:int=1000, input_shape:Tuple[int]=None):
     x = Conv2D(4096, (7, 7), activation='relu', name='conv2d_1')(x)
     x = Conv2D(4096, (1, 1), activation='relu', name='conv2d_2')(x)
     x = Conv2D(classes, (1, 1), activation='softmax', name='conv2d_3')(x)
-    x = GlobalAveragePooling2D()(x)
+    if masked:
+        x = MaskedGlobalAveragePooling2D(reductions=[(2, 2), (2, 2), (7, 1)])([x, float_mask])
+    else:
+        x = GlobalAveragePooling2D()(x)
 
-    return Model(inputs=[input_y, input_cb, input_cr], outputs=x)
+    return Model(inputs=[input_y, input_cb, input_cr] + ([input_mask] if masked else []), outputs=x)
 
 
-def VGG16_dct_y(classes:int=1000):
+def VGG16_dct_y(classes:int=1000, n_coefficients: int=64):
     """Instantiates the VGG16 DCT architecture.
 
     # Argument:
         - classes: The number of classes the network should predict.
+        - n_coefficients: The number of DCT coefficients per block and per component given as input, the first ones in zig-zag order (see `n_coefficients` in `jpeg_deep.generators`).
 
     # Returns:
         A Keras model instance.
     """
-    input_shape_y = (28, 28, 64)
+    input_shape_y = (28, 28, n_coefficients)
+
+    input_y = Input(input_shape_y, dtype="int16")
 
-    input_y = Input(input_shape_y)
+    # The coefficients are given as int16 and cast on the graph
+    float_y = CastToFloat(name="cast_y")(input_y)
 
     # Block 1
     x = BatchNormalization(
-        name="b_norm_64", input_shape=input_shape_y)(input_y)
+        name="b_norm_64", input_shape=input_shape_y)(float_y)
 
     x = Conv2D(256, (3, 3),
                activation='relu',
@@ -394,23 +438,32 @@ def VGG16_dct_y(classes:int=1000):
     return Model(input_y, outputs=x)
 
 
-def VGG16_dct_y_conv(classes:int=1000, input_shape:Tuple[int]=(None, None)):
+def VGG16_dct_y_conv(classes:int=1000, input_shape:Tuple[int]=(None, None), n_coefficients: int=64, masked: bool=False):
     """ This is a modified version of the VGG16 DCT network to be fully convolutional.
 
     # Arguments:
         - classes: The number of classes to predict.
         - input_shape: The dimension of the inputs (x, y). Can be (None, None).
+        - n_coefficients: The number of DCT coefficients per block and per component given as input, the first ones in zig-zag order (see `n_coefficients` in `jpeg_deep.generators`).
+        - masked: If the network takes the validity mask of padded inputs as last input (see `bucket_step` in `DCTGeneratorJPEG2DCT`), to exclude the padding from the global average pooling. Used for batched inference on images of different sizes.
         
     # Returns:
         A Keras model instance.
     """
-    input_shape_y = (*input_shape, 64)
+    input_shape_y = (*input_shape, n_coefficients)
 
-    input_y = Input(input_shape_y)
+    input_y = Input(input_shape_y, dtype="int16")
+
+    # The coefficients are given as int16 and cast on the graph
+    float_y = CastToFloat(name="cast_y")(input_y)
+
+    if masked:
+        input_mask = Input(input_shape_y[:2] + (1,), dtype="uint8")
+        float_mask = CastToFloat(name="cast_mask")(input_mask)
 
     # Block 1
     x = BatchNormalization(
-        name="b_norm_64", input_shape=input_shape_y)(input_y)
+        name="b_norm_64", input_shape=input_shape_y)(float_y)
 
     x = Conv2D(256, (3, 3),
                activation='relu',
@@ -459,6 +512,9 @@ def VGG16_dct_y_conv(classes:int=1000, input_shape:Tuple[int]=(None, None)):
     x = Conv2D(4096, (7, 7), activation='relu', name='conv2d_1')(x)
     x = Conv2D(4096, (1, 1), activation='relu', name='conv2d_2')(x)
     x = Conv2D(classes, (1, 1), activation='softmax', name='conv2d_3')(x)
-    x = GlobalAveragePooling2D()(x)
+    if masked:
+        x = MaskedGlobalAveragePooling2D(reductions=[(2, 2), (2, 2), (7, 1)])([x, float_mask])
+    else:
+        x = GlobalAveragePooling2D()(x)
 
-    return Model(input_y, outputs=x)
+    return Model([input_y] + ([input_mask] if masked else []), outputs=x)
@@ -18,4 +18,7 @@ from .object_detection_2d_patch_sampling_ops import CropPad, Crop, Pad
 from .object_detection_2d_patch_sampling_ops import RandomPatch, RandomPatchInf
 from .object_detection_2d_patch_sampling_ops import RandomMaxCropFixedAR, RandomPadFixedAR
 
+from .dct_operations import DCTFlip, DCTRandomFlip
+from .dct_operations import DCTCropPad, DCTCenterCrop, DCTRandomCrop, DCTRandomExpand
+
 from .data_augmentation_ssd import SSDDataAugmentation
@@ -0,0 +1,409 @@
+'''
+Geometric transformations applied directly on the DCT coefficients of JPEG images.
+
+These transformations operate on the `(dct_y, dct_cb, dct_cr)` tuples returned by
+jpeg2dct and avoid the decode => transform => re-encode round trip of the pixel
+domain transformations. They only support the operations that can be expressed
+exactly on the 8x8 blocks: flips, and crops/pads aligned on the blocks.
+
+All the sizes and offsets are expressed in luminance blocks (8 pixels). As the chroma
+components are sub-sampled by two (4:2:0), the offsets and sizes must be even so that
+the luminance and chrominance grids stay aligned (i.e. multiples of 16 pixels). The
+luminance component is expected to be padded to twice the size of the chrominance
+components, which is what the generators do when loading the images.
+
+Copyright (C) 2019 Deguerre Benjamin
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+from __future__ import division
+
+from typing import Dict, Tuple
+import numpy as np
+
+from jpeg_deep.generators import BoxFilter, DeterministicTransform
+
+# Size of a block of coefficients in pixels.
+BLOCK_SIZE = 8
+
+# The coefficients are stored in natural order, i.e. index = 8 * v + u with u the horizontal
+# frequency and v the vertical frequency. Mirroring a block along one axis negates the
+# coefficients with an odd frequency along this axis.
+_FREQUENCIES_U = np.tile(np.arange(BLOCK_SIZE), BLOCK_SIZE)
+_FREQUENCIES_V = np.repeat(np.arange(BLOCK_SIZE), BLOCK_SIZE)
+HORIZONTAL_FLIP_SIGNS = np.where(_FREQUENCIES_U % 2 == 0, 1, -1).astype(np.int16)
+VERTICAL_FLIP_SIGNS = np.where(_FREQUENCIES_V % 2 == 0, 1, -1).astype(np.int16)
+
+
+def _flip_component(component: np.ndarray, dim: str):
+    ''' Flips one of the components of the image, the blocks are re-ordered and the coefficients mirrored. '''
+    if component is None:
+        return None
+    n_blocks = component.shape[-1] // BLOCK_SIZE**2
+    if dim == 'horizontal':
+        signs = np.tile(HORIZONTAL_FLIP_SIGNS, n_blocks)
+        return component[:, ::-1] * signs.astype(component.dtype)
+    else:
+        signs = np.tile(VERTICAL_FLIP_SIGNS, n_blocks)
+        return component[::-1] * signs.astype(component.dtype)
+
+
+def _crop_pad_component(component: np.ndarray,
+                        block_ymin: int,
+                        block_xmin: int,
+                        block_height: int,
+                        block_width: int):
+    ''' Crops and/or pads one of the components of the image. The padded blocks are set to zero, i.e. a gray background. '''
+    if component is None:
+        return None
+    height, width = component.shape[:2]
+    canvas = np.zeros((block_height, block_width, component.shape[2]), dtype=component.dtype)
+
+    # Area of the source overlapping with the patch.
+    src_ymin, src_ymax = max(block_ymin, 0), min(block_ymin + block_height, height)
+    src_xmin, src_xmax = max(block_xmin, 0), min(block_xmin + block_width, width)
+    if src_ymin < src_ymax and src_xmin < src_xmax:
+        canvas[src_ymin - block_ymin:src_ymax - block_ymin,
+               src_xmin - block_xmin:src_xmax - block_xmin] = component[src_ymin:src_ymax, src_xmin:src_xmax]
+    return canvas
+
+
+def _check_alignment(*values):
+    ''' Makes sure the offsets and sizes keep the luminance and chrominance grids aligned. '''
+    for value in values:
+        if value % 2 != 0:
+            raise ValueError(
+                "The offsets and sizes of the DCT transformations should be even (multiples of 16 pixels), got {}.".format(value))
+
+
+def image_blocks_size(image: Tuple[np.ndarray, np.ndarray, np.ndarray]):
+    ''' Returns the size of a DCT image in luminance blocks, i.e. (height, width). '''
+    return image[0].shape[:2]
+
+
+class DCTFlip(DeterministicTransform):
+    # Marks the transformations that can be applied on the DCT coefficients.
+    dct_domain = True
+
+    def __init__(self,
+                 dim: str='horizontal',
+                 labels_format: Dict={'class_id': 0, 'xmin': 1, 'ymin': 2, 'xmax': 3, 'ymax': 4}):
+        '''
+        Flips DCT images horizontally or vertically. The order of the blocks is reversed and the
+        coefficients with odd frequencies along the flipped axis are negated.
+
+        # Arguments:
+            - dim: Can be either of 'horizontal' and 'vertical'.
+            - labels_format: A dictionary that defines which index in the last axis of the labels
+                of an image contains which bounding box coordinate. The dictionary maps at least the keywords
+                'xmin', 'ymin', 'xmax', and 'ymax' to their respective indices within last axis of the labels array.
+        '''
+        if not (dim in {'horizontal', 'vertical'}):
+            raise ValueError("`dim` can be one of 'horizontal' and 'vertical'.")
+        self.dim = dim
+        self.labels_format = labels_format
+
+    def __call__(self, image, labels=None):
+
+        img_height, img_width = [value * BLOCK_SIZE for value in image_blocks_size(image)]
+
+        xmin = self.labels_format['xmin']
+        ymin = self.labels_format['ymin']
+        xmax = self.labels_format['xmax']
+        ymax = self.labels_format['ymax']
+
+        image = tuple(_flip_component(component, self.dim) for component in image)
+        if labels is None:
+            return image
+
+        labels = np.copy(labels)
+        if self.dim == 'horizontal':
+            labels[:, [xmin, xmax]] = img_width - labels[:, [xmax, xmin]]
+        else:
+            labels[:, [ymin, ymax]] = img_height - labels[:, [ymax, ymin]]
+        return image, labels
+
+
+class DCTRandomFlip:
+    dct_domain = True
+
+    def __init__(self,
+                 dim: str='horizontal',
+                 prob: float=0.5,
+                 labels_format: Dict={'class_id': 0, 'xmin': 1, 'ymin': 2, 'xmax': 3, 'ymax': 4}):
+        '''
+        Randomly flips DCT images horizontally or vertically. The randomness only refers
+        to whether or not the image will be flipped.
+
+        # Arguments:
+            - dim: Can be either of 'horizontal' and 'vertical'.
+            - prob: `(1 - prob)` determines the probability with which the original,
+                unaltered image is returned.
+            - labels_format: A dictionary that defines which index in the last axis of the labels
+                of an image contains which bounding box coordinate. The dictionary maps at least the keywords
+                'xmin', 'ymin', 'xmax', and 'ymax' to their respective indices within last axis of the labels array.
+        '''
+        self.dim = dim
+        self.prob = prob
+        self.labels_format = labels_format
+        self.flip = DCTFlip(dim=self.dim, labels_format=self.labels_format)
+
+    def __call__(self, image, labels=None):
+        p = np.random.uniform(0, 1)
+        if p >= (1.0 - self.prob):
+            self.flip.labels_format = self.labels_format
+            return self.flip(image, labels)
+        elif labels is None:
+            return image
+        else:
+            return image, labels
+
+
+class DCTCropPad(DeterministicTransform):
+    dct_domain = True
+
+    def __init__(self,
+                 block_ymin: int,
+                 block_xmin: int,
+                 block_height: int,
+                 block_width: int,
+                 clip_boxes: bool=True,
+                 box_filter: object=None,
+                 labels_format: Dict={'class_id': 0, 'xmin': 1, 'ymin': 2, 'xmax': 3, 'ymax': 4}):
+        '''
+        Crops and/or pads DCT images to the specified patch. The patch is expressed in luminance blocks,
+        offsets can be negative (padding) and the patch can be larger than the image. The padded blocks
+        are filled with zeros, which correspond to a gray background once decoded.
+
+        # Arguments:
+            - block_ymin: The vertical offset of the patch, in blocks. Must be even.
+            - block_xmin: The horizontal offset of the patch, in blocks. Must be even.
+            - block_height: The height of the patch, in blocks. Must be even.
+            - block_width: The width of the patch, in blocks. Must be even.
+            - clip_boxes: Only relevant if ground truth bounding boxes are given.
+                If `True`, any ground truth bounding boxes will be clipped to lie entirely within the
+                patch.
+            - box_filter: Only relevant if ground truth bounding boxes are given.
+                A `BoxFilter` object to filter out bounding boxes that don't meet the given criteria
+                after the transformation. If `None`, the validity of the bounding boxes is not checked.
+            - labels_format: A dictionary that defines which index in the last axis of the labels
+                of an image contains which bounding box coordinate. The dictionary maps at least the keywords
+                'xmin', 'ymin', 'xmax', and 'ymax' to their respective indices within last axis of the labels array.
+        '''
+        if (not (box_filter is None)) and not isinstance(box_filter, BoxFilter):
+            raise ValueError("`box_filter` must be either `None` or a `BoxFilter` object.")
+        self.block_ymin = block_ymin
+        self.block_xmin = block_xmin
+        self.block_height = block_height
+        self.block_width = block_width
+        self.clip_boxes = clip_boxes
+        self.box_filter = box_filter
+        self.labels_format = labels_format
+
+    def __call__(self, image, labels=None):
+
+        _check_alignment(self.block_ymin, self.block_xmin,
+                         self.block_height, self.block_width)
+
+        dct_y, dct_cb, dct_cr = image
+        dct_y = _crop_pad_component(
+            dct_y, self.block_ymin, self.block_xmin, self.block_height, self.block_width)
+        dct_cb = _crop_pad_component(
+            dct_cb, self.block_ymin // 2, self.block_xmin // 2, self.block_height // 2, self.block_width // 2)
+        dct_cr = _crop_pad_component(
+            dct_cr, self.block_ymin // 2, self.block_xmin // 2, self.block_height // 2, self.block_width // 2)
+        image = (dct_y, dct_cb, dct_cr)
+
+        if labels is None:
+            return image
+
+        xmin = self.labels_format['xmin']
+        ymin = self.labels_format['ymin']
+        xmax = self.labels_format['xmax']
+        ymax = self.labels_format['ymax']
+
+        patch_height = self.block_height * BLOCK_SIZE
+        patch_width = self.block_width * BLOCK_SIZE
+
+        labels = np.copy(labels)
+        labels[:, [ymin, ymax]] -= self.block_ymin * BLOCK_SIZE
+        labels[:, [xmin, xmax]] -= self.block_xmin * BLOCK_SIZE
+
+        if not (self.box_filter is None):
+            self.box_filter.labels_format = self.labels_format
+            labels = self.box_filter(labels=labels,
+                                     image_height=patch_height,
+                                     image_width=patch_width)
+
+        if self.clip_boxes:
+            labels[:, [ymin, ymax]] = np.clip(
+                labels[:, [ymin, ymax]], a_min=0, a_max=patch_height - 1)
+            labels[:, [xmin, xmax]] = np.clip(
+                labels[:, [xmin, xmax]], a_min=0, a_max=patch_width - 1)
+
+        return image, labels
+
+
+class DCTCenterCrop(DeterministicTransform):
+    dct_domain = True
+
+    def __init__(self,
+                 block_height: int,
+                 block_width: int,
+                 clip_boxes: bool=True,
+                 box_filter: object=None,
+                 labels_format: Dict={'class_id': 0, 'xmin': 1, 'ymin': 2, 'xmax': 3, 'ymax': 4}):
+        '''
+        Crops (or pads if the image is too small) the center of DCT images to a fixed size. The
+        patch is aligned on the macro-blocks, hence it is only approximately centered.
+
+        # Arguments:
+            - block_height: The height of the patch, in blocks. Must be even.
+            - block_width: The width of the patch, in blocks. Must be even.
+            - clip_boxes: If `True`, the bounding boxes will be clipped to lie entirely within the patch.
+            - box_filter: A `BoxFilter` object to filter out bounding boxes after the transformation.
+            - labels_format: A dictionary that defines which index in the last axis of the labels
+                of an image contains which bounding box coordinate. The dictionary maps at least the keywords
+                'xmin', 'ymin', 'xmax', and 'ymax' to their respective indices within last axis of the labels array.
+        '''
+        self.block_height = block_height
+        self.block_width = block_width
+        self.clip_boxes = clip_boxes
+        self.box_filter = box_filter
+        self.labels_format = labels_format
+        self.crop = DCTCropPad(block_ymin=0,
+                               block_xmin=0,
+                               block_height=self.block_height,
+                               block_width=self.block_width,
+                               clip_boxes=self.clip_boxes,
+                               box_filter=self.box_filter,
+                               labels_format=self.labels_format)
+
+    def __call__(self, image, labels=None):
+        img_height, img_width = image_blocks_size(image)
+
+        # Offsets rounded to the macro-blocks
+        self.crop.block_ymin = ((img_height - self.block_height) // 4) * 2
+        self.crop.block_xmin = ((img_width - self.block_width) // 4) * 2
+        self.crop.labels_format = self.labels_format
+
+        return self.crop(image, labels)
+
+
+class DCTRandomCrop:
+    dct_domain = True
+
+    def __init__(self,
+                 block_height: int,
+                 block_width: int,
+                 clip_boxes: bool=True,
+                 box_filter: object=None,
+                 labels_format: Dict={'class_id': 0, 'xmin': 1, 'ymin': 2, 'xmax': 3, 'ymax': 4}):
+        '''
+        Randomly crops a fixed size patch aligned on the macro-blocks of DCT images. If the image is
+        smaller than the patch along one dimension, the image is randomly placed inside of the patch
+        and the remaining blocks are padded.
+
+        # Arguments:
+            - block_height: The height of the patch, in blocks. Must be even.
+            - block_width: The width of the patch, in blocks. Must be even.
+            - clip_boxes: If `True`, the bounding boxes will be clipped to lie entirely within the patch.
+            - box_filter: A `BoxFilter` object to filter out bounding boxes after the transformation.
+            - labels_format: A dictionary that defines which index in the last axis of the labels
+                of an image contains which bounding box coordinate. The dictionary maps at least the keywords
+                'xmin', 'ymin', 'xmax', and 'ymax' to their respective indices within last axis of the labels array.
+        '''
+        self.block_height = block_height
+        self.block_width = block_width
+        self.clip_boxes = clip_boxes
+        self.box_filter = box_filter
+        self.labels_format = labels_format
+        self.crop = DCTCropPad(block_ymin=0,
+                               block_xmin=0,
+                               block_height=self.block_height,
+                               block_width=self.block_width,
+                               clip_boxes=self.clip_boxes,
+                               box_filter=self.box_filter,
+                               labels_format=self.labels_format)
+
+    def __call__(self, image, labels=None):
+        img_height, img_width = image_blocks_size(image)
+
+        # Number of possible macro-block offsets along each axis, negative offsets pad the image.
+        y_range = (img_height - self.block_height) // 2
+        x_range = (img_width - self.block_width) // 2
+        self.crop.block_ymin = 2 * np.random.randint(min(y_range, 0), max(y_range, 0) + 1)
+        self.crop.block_xmin = 2 * np.random.randint(min(x_range, 0), max(x_range, 0) + 1)
+        self.crop.labels_format = self.labels_format
+
+        return self.crop(image, labels)
+
+
+class DCTRandomExpand:
+    dct_domain = True
+
+    def __init__(self,
+                 min_scale: float=1.0,
+                 max_scale: float=4.0,
+                 prob: float=0.5,
+                 labels_format: Dict={'class_id': 0, 'xmin': 1, 'ymin': 2, 'xmax': 3, 'ymax': 4}):
+        '''
+        Randomly places DCT images on a larger zero-filled (gray) canvas, equivalent to the "expand"
+        operation of the SSD data augmentation. The canvas and the placement are aligned on the macro-blocks.
+
+        # Arguments:
+            - min_scale: The minimum scaling factor of the canvas with respect to the image.
+            - max_scale: The maximum scaling factor of the canvas with respect to the image.
+            - prob: `(1 - prob)` determines the probability with which the original,
+                unaltered image is returned.
+            - labels_format: A dictionary that defines which index in the last axis of the labels
+                of an image contains which bounding box coordinate. The dictionary maps at least the keywords
+                'xmin', 'ymin', 'xmax', and 'ymax' to their respective indices within last axis of the labels array.
+        '''
+        if min_scale < 1.0 or max_scale < min_scale:
+            raise ValueError("It must be `1 <= min_scale <= max_scale`.")
+        self.min_scale = min_scale
+        self.max_scale = max_scale
+        self.prob = prob
+        self.labels_format = labels_format
+        self.pad = DCTCropPad(block_ymin=0,
+                              block_xmin=0,
+                              block_height=None,
+                              block_width=None,
+                              clip_boxes=False,
+                              box_filter=None,
+                              labels_format=self.labels_format)
+
+    def __call__(self, image, labels=None):
+        p = np.random.uniform(0, 1)
+        if p < (1.0 - self.prob):
+            if labels is None:
+                return image
+            return image, labels
+
+        img_height, img_width = image_blocks_size(image)
+        scale = np.random.uniform(self.min_scale, self.max_scale)
+
+        canvas_height = 2 * int(round(img_height * scale / 2))
+        canvas_width = 2 * int(round(img_width * scale / 2))
+        canvas_height = max(canvas_height, img_height)
+        canvas_width = max(canvas_width, img_width)
+
+        self.pad.block_height = canvas_height
+        self.pad.block_width = canvas_width
+        self.pad.block_ymin = -2 * np.random.randint(0, (canvas_height - img_height) // 2 + 1)
+        self.pad.block_xmin = -2 * np.random.randint(0, (canvas_width - img_width) // 2 + 1)
+        self.pad.labels_format = self.labels_format
+
+        return self.pad(image, labels)
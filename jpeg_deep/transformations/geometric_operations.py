@@ -25,9 +25,9 @@ import numpy as np
 import cv2
 import random
 
-from jpeg_deep.generators import BoxFilter, ImageValidator
+from jpeg_deep.generators import BoxFilter, ImageValidator, DeterministicTransform
 
-class Resize:
+class Resize(DeterministicTransform):
     def __init__(self,
                  height: int,
                  width: int,
@@ -146,7 +146,7 @@ class ResizeRandomInterp:
         self.resize.labels_format = self.labels_format
         return self.resize(image, labels, return_inverter)
 
-class Flip:
+class Flip(DeterministicTransform):
     def __init__(self,
                  dim: str='horizontal',
                  labels_format: Dict={'class_id': 0, 'xmin': 1, 'ymin': 2, 'xmax': 3, 'ymax': 4}):
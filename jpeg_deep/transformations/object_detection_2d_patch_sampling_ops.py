@@ -21,7 +21,7 @@ from __future__ import division
 from typing import Tuple, Dict
 import numpy as np
 
-from jpeg_deep.generators import BoundGenerator, BoxFilter, ImageValidator
+from jpeg_deep.generators import BoundGenerator, BoxFilter, ImageValidator, DeterministicTransform
 
 class PatchCoordinateGenerator:
     def __init__(self,
@@ -196,7 +196,7 @@ class PatchCoordinateGenerator:
 
         return (patch_ymin, patch_xmin, patch_height, patch_width)
 
-class CropPad:
+class CropPad(DeterministicTransform):
     def __init__(self,
                  patch_ymin: int,
                  patch_xmin: int ,
@@ -345,7 +345,7 @@ class CropPad:
             else:
                 return image
 
-class Crop:
+class Crop(DeterministicTransform):
     
 
     def __init__(self,
@@ -406,7 +406,7 @@ class Crop:
 
         return self.crop(image, labels, return_inverter)
 
-class Pad:
+class Pad(DeterministicTransform):
     
 
     def __init__(self,
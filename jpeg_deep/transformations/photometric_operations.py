@@ -22,8 +22,10 @@ from typing import Tuple
 import numpy as np
 import cv2
 
+from jpeg_deep.generators import DeterministicTransform
 
-class ConvertColor:
+
+class ConvertColor(DeterministicTransform):
     def __init__(self, current:str='RGB', to:str='HSV', keep_3ch:bool=True):
         '''Converts images between RGB, HSV and grayscale color spaces. This is just a wrapper
     around `cv2.cvtColor()`.
@@ -61,7 +63,7 @@ class ConvertColor:
             return image, labels
 
 
-class ConvertDataType:
+class ConvertDataType(DeterministicTransform):
     def __init__(self, to:str='uint8'):
         '''Converts images represented as Numpy arrays between `uint8` and `float32`.
         Serves as a helper for certain photometric distortions. This is just a wrapper
@@ -86,7 +88,7 @@ class ConvertDataType:
             return image, labels
 
 
-class ConvertTo3Channels:
+class ConvertTo3Channels(DeterministicTransform):
 
     def __init__(self):
         '''
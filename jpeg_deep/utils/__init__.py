@@ -1 +1,2 @@
-from .ssd_utils import convert_coordinates, iou
+from .ssd_utils import convert_coordinates, iou, iou_batch
+from .ssd_utils import SPARSE_TARGET_WIDTH, NEUTRAL_WORD_BITS, sparse_neutral_rows
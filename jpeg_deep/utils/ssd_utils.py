@@ -2,6 +2,7 @@
 Includes:
 * Function to compute the IoU similarity for axis-aligned, rectangular, 2D bounding boxes
 * Function for coordinate conversion for axis-aligned, rectangular, 2D bounding boxes
+* The layout of the sparse SSD targets
 
 Copyright (C) 2018 Pierluigi Ferrari
 
@@ -20,6 +21,26 @@ limitations under the License.
 from __future__ import division
 import numpy as np
 
+# The sparse targets (see `SSDInputEncoder(sparse_targets=True)`) are made of rows of `SPARSE_TARGET_WIDTH` values:
+# first the bitset of the neutral anchor boxes, in words of `NEUTRAL_WORD_BITS` bits (exactly represented in float32),
+# then one row `(anchor index, class id, 4 offsets)` per positive anchor box, padded with rows of anchor index -1.
+SPARSE_TARGET_WIDTH = 6
+NEUTRAL_WORD_BITS = 16
+
+
+def sparse_neutral_rows(n_boxes: int):
+    '''
+    Returns the number of rows of the sparse targets holding the bitset of the neutral anchor boxes.
+
+    # Arguments:
+        - n_boxes: The total number of anchor boxes per image.
+
+    # Returns:
+        The number of rows before the positive anchor boxes.
+    '''
+    n_words = -(-n_boxes // NEUTRAL_WORD_BITS)
+    return -(-n_words // SPARSE_TARGET_WIDTH)
+
 
 def convert_coordinates(tensor: object, start_index: int, conversion:str, border_pixels:str='half'):
     '''
@@ -425,3 +446,71 @@ def iou(boxes1: object, boxes2: object, coords:str='centroids', mode:str='outer_
     union_areas = boxes1_areas + boxes2_areas - intersection_areas
 
     return intersection_areas / union_areas
+
+
+def iou_batch(boxes1: object, boxes2: object, coords: str='centroids', border_pixels: str='half', dtype: object=np.float64):
+    '''
+    Computes the IoU of several sets of boxes (e.g: the ground truth boxes of a batch) with a common set of boxes (e.g:
+    the anchor boxes), with broadcasting. Follows the same computations as `iou` in 'outer_product' mode, the results
+    are identical with `dtype=np.float64`.
+
+    # Arguments:
+        - boxes1: A Numpy array of shape `(..., 4)`, e.g: `(m, 4)` or `(batch_size, m, 4)`, containing the coordinates
+            of the boxes in the format specified by `coords`.
+        - boxes2: A 2D Numpy array of shape `(n, 4)` containing the coordinates of `n` boxes in the format
+            specified by `coords`.
+        - coords: The coordinate format in the input arrays, 'centroids', 'minmax' or 'corners' (see `iou`).
+        - border_pixels: How to treat the border pixels of the bounding boxes, 'include', 'exclude' or 'half' (see `iou`).
+        - dtype: The type of the computations, float32 halves the memory of the `(..., n)` arrays.
+
+    # Returns:
+        A Numpy array of shape `(..., n)` and type `dtype`, the IoU of each of the boxes of `boxes1` with each of the
+        boxes of `boxes2`.
+    '''
+    if coords == 'centroids':
+        boxes1 = convert_coordinates(
+            boxes1, start_index=0, conversion='centroids2corners')
+        boxes2 = convert_coordinates(
+            boxes2, start_index=0, conversion='centroids2corners')
+        coords = 'corners'
+    elif not (coords in {'minmax', 'corners'}):
+        raise ValueError(
+            "Unexpected value for `coords`. Supported values are 'minmax', 'corners' and 'centroids'.")
+
+    if coords == 'corners':
+        xmin, ymin, xmax, ymax = 0, 1, 2, 3
+    else:
+        xmin, xmax, ymin, ymax = 0, 1, 2, 3
+
+    if border_pixels == 'half':
+        d = 0
+    elif border_pixels == 'include':
+        d = 1
+    elif border_pixels == 'exclude':
+        d = -1
+
+    # Shapes (..., 1, 4) and (n, 4)
+    boxes1 = np.asarray(boxes1, dtype=dtype)[..., np.newaxis, :]
+    boxes2 = np.asarray(boxes2, dtype=dtype)
+
+    # As in `iou`, the intersection areas are computed without the border pixels adjustment. The operations are done
+    # in place, in the same order as in `iou`.
+    intersection_areas = np.minimum(boxes1[..., xmax], boxes2[:, xmax])
+    intersection_areas -= np.maximum(boxes1[..., xmin], boxes2[:, xmin])
+    np.maximum(intersection_areas, 0, out=intersection_areas)
+    heights = np.minimum(boxes1[..., ymax], boxes2[:, ymax])
+    heights -= np.maximum(boxes1[..., ymin], boxes2[:, ymin])
+    np.maximum(heights, 0, out=heights)
+    intersection_areas *= heights
+
+    boxes1_areas = (boxes1[..., xmax] - boxes1[..., xmin] + d) * \
+        (boxes1[..., ymax] - boxes1[..., ymin] + d)
+    boxes2_areas = (boxes2[:, xmax] - boxes2[:, xmin] + d) * \
+        (boxes2[:, ymax] - boxes2[:, ymin] + d)
+
+    # The union areas, then the IoU
+    union_areas = np.add(boxes1_areas, boxes2_areas, out=heights)
+    union_areas -= intersection_areas
+    np.divide(intersection_areas, union_areas, out=intersection_areas)
+
+    return intersection_areas
@@ -0,0 +1,74 @@
+import argparse
+import sys
+import time
+
+from os import getcwd
+
+import numpy as np
+
+sys.path.append(getcwd())
+from jpeg_deep.generators import SSDInputEncoder
+
+parser = argparse.ArgumentParser(
+    "Compare the time required to encode a batch of labels with the per image and the batched matching of the SSDInputEncoder.")
+parser.add_argument("-d", "--dataset", choices=["voc", "coco"], default="coco",
+                    help="The dataset whose number of objects per image is simulated.")
+parser.add_argument("-b", "--batch_size", type=int, default=32, help="The size of the batches.")
+parser.add_argument("-nr", "--numberOfRun", type=int, default=20,
+                    help="The number of batches encoded, the results are averaged on this number.")
+parser.add_argument("-s", "--seed", type=int, default=0, help="The seed of the random labels.")
+args = parser.parse_args()
+
+# Average and maximum number of objects per image
+number_of_objects = {"voc": (2.4, 42), "coco": (7.3, 93)}
+number_of_classes = {"voc": 20, "coco": 80}
+mean_objects, max_objects = number_of_objects[args.dataset]
+n_classes = number_of_classes[args.dataset]
+
+random_state = np.random.RandomState(args.seed)
+
+
+def random_labels(batch_size: int):
+    """ Draws the labels of a batch, with a long tailed number of objects per image and boxes of various sizes. """
+    labels = []
+    for _ in range(batch_size):
+        k = min(random_state.geometric(1 / mean_objects), max_objects)
+        sizes = np.clip(np.exp(random_state.normal(np.log(60), 0.9, size=(k, 2))), 2, 300)
+        xmin = random_state.uniform(0, 300 - sizes[:, 0])
+        ymin = random_state.uniform(0, 300 - sizes[:, 1])
+        # Integer coordinates, as given by the annotations
+        boxes = np.round(np.stack([xmin, ymin, xmin + sizes[:, 0], ymin + sizes[:, 1]], axis=1))
+        boxes[:, 2:] = np.maximum(boxes[:, 2:], boxes[:, :2] + 1)
+        classes = random_state.randint(1, n_classes + 1, size=(k, 1))
+        labels.append(np.concatenate([classes, boxes], axis=1))
+    return labels
+
+
+encoders = {"per image": SSDInputEncoder(n_classes=n_classes, batched_matching=False),
+            "batched (float64)": SSDInputEncoder(n_classes=n_classes, iou_dtype=np.float64),
+            "batched (float32)": SSDInputEncoder(n_classes=n_classes, iou_dtype=np.float32)}
+
+batches = [random_labels(args.batch_size) for _ in range(args.numberOfRun)]
+print("{} batches of {} images, {:.1f} objects per image on average, {} at most.".format(
+    args.numberOfRun, args.batch_size, np.mean([len(labels) for batch in batches for labels in batch]),
+    max(len(labels) for batch in batches for labels in batch)))
+
+times = {name: [] for name in encoders}
+mismatches = {name: 0 for name in encoders}
+for batch in batches:
+    reference = None
+    for name, encoder in encoders.items():
+        start = time.perf_counter()
+        y_encoded = encoder(batch)
+        times[name].append(time.perf_counter() - start)
+
+        if reference is None:
+            reference = y_encoded
+        else:
+            # The anchor boxes whose encoding differs from the per image matching
+            different = ~np.isclose(y_encoded, reference, rtol=0, atol=0, equal_nan=True)
+            mismatches[name] += int(np.count_nonzero(np.any(different, axis=-1)))
+
+for name in encoders:
+    print("{:>20}: {:8.2f} ms per batch, {} anchor boxes encoded differently from the per image matching.".format(
+        name, 1000 * np.mean(times[name]), mismatches[name]))
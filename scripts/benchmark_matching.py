@@ -0,0 +1,86 @@
+import argparse
+import sys
+import time
+
+from os import getcwd
+
+import numpy as np
+
+sys.path.append(getcwd())
+from jpeg_deep.generators import SSDInputEncoder
+from jpeg_deep.generators.helper_ssd import match_bipartite_greedy
+from jpeg_deep.utils import iou
+
+parser = argparse.ArgumentParser(
+    "Compare the time required by the greedy bipartite matching of the ground truth boxes of an image to the anchor boxes, with the quadratic algorithm.")
+parser.add_argument("-d", "--dataset", choices=["voc", "coco"], default="coco",
+                    help="The dataset whose number of objects per image is simulated.")
+parser.add_argument("-n", "--number_of_images", type=int, default=500,
+                    help="The number of images matched, the results are averaged on this number.")
+parser.add_argument("-s", "--seed", type=int, default=0, help="The seed of the random labels.")
+args = parser.parse_args()
+
+# Average and maximum number of objects per image
+number_of_objects = {"voc": (2.4, 42), "coco": (7.3, 93)}
+mean_objects, max_objects = number_of_objects[args.dataset]
+
+random_state = np.random.RandomState(args.seed)
+
+
+def random_boxes(k: int):
+    """ Draws k boxes of various sizes, with integer coordinates as given by the annotations. """
+    sizes = np.clip(np.exp(random_state.normal(np.log(60), 0.9, size=(k, 2))), 2, 300)
+    xmin = random_state.uniform(0, 300 - sizes[:, 0])
+    ymin = random_state.uniform(0, 300 - sizes[:, 1])
+    boxes = np.round(np.stack([xmin, ymin, xmin + sizes[:, 0], ymin + sizes[:, 1]], axis=1))
+    boxes[:, 2:] = np.maximum(boxes[:, 2:], boxes[:, :2] + 1)
+    return boxes / 300
+
+
+def match_bipartite_greedy_quadratic(weight_matrix):
+    """ The greedy bipartite matching reducing the whole weight matrix at each step, in O(m^2 * n). """
+    weight_matrix = np.copy(weight_matrix)
+    all_gt_indices = list(range(weight_matrix.shape[0]))
+    matches = np.zeros(weight_matrix.shape[0], dtype=np.int64)
+    for _ in range(weight_matrix.shape[0]):
+        anchor_indices = np.argmax(weight_matrix, axis=1)
+        overlaps = weight_matrix[all_gt_indices, anchor_indices]
+        ground_truth_index = np.argmax(overlaps)
+        anchor_index = anchor_indices[ground_truth_index]
+        matches[ground_truth_index] = anchor_index
+        weight_matrix[ground_truth_index] = 0
+        weight_matrix[:, anchor_index] = 0
+    return matches
+
+
+# The IoUs of the ground truth boxes with the anchor boxes of SSD300, in the 'corners' format
+anchors = SSDInputEncoder(coords="corners").anchors
+counts = np.minimum(random_state.geometric(1 / mean_objects, size=args.number_of_images), max_objects)
+# A few crowded images, as in the tail of the distribution
+counts[:len(counts) // 50] = random_state.randint(min(50, max_objects), max_objects + 1, size=len(counts) // 50)
+similarities = [iou(random_boxes(k), anchors, coords="corners", mode="outer_product", border_pixels="half")
+                for k in counts]
+print("{} images, {:.1f} objects per image on average, {} at most.".format(
+    len(counts), np.mean(counts), np.max(counts)))
+
+functions = {"quadratic": match_bipartite_greedy_quadratic, "lazy": match_bipartite_greedy}
+# Ranges of number of objects per image
+ranges = [(1, 1), (2, 9), (10, 49), (50, max_objects)]
+times = {name: np.zeros(len(counts)) for name in functions}
+mismatches = 0
+for i, weight_matrix in enumerate(similarities):
+    matches = {}
+    for name, function in functions.items():
+        start = time.perf_counter()
+        matches[name] = function(weight_matrix)
+        times[name][i] = time.perf_counter() - start
+    mismatches += not np.array_equal(matches["quadratic"], matches["lazy"])
+
+for low, high in ranges:
+    images = (counts >= low) & (counts <= high)
+    if not np.any(images):
+        continue
+    print("{:>2} to {:>2} objects ({:4d} images): ".format(low, high, np.count_nonzero(images)) + ", ".join(
+        "{} {:7.3f} ms".format(name, 1000 * np.mean(times[name][images])) for name in functions))
+print("Total: " + ", ".join("{} {:.1f} ms".format(name, 1000 * np.sum(times[name])) for name in functions) +
+      ", {} images matched differently.".format(mismatches))
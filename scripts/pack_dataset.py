@@ -0,0 +1,43 @@
+import argparse
+import sys
+
+from os import listdir, getcwd
+from os.path import join, isdir
+
+sys.path.append(getcwd())
+from jpeg_deep.generators import prepare_imagenet
+from jpeg_deep.generators.records import pack_records
+
+parser = argparse.ArgumentParser(
+    "Pack the images of a dataset into large shards with an index, to be read by the generators using the `records` argument.")
+parser.add_argument("output", help="The directory where to write the shards and the index.")
+parser.add_argument("-d", "--directories", nargs="+", required=True,
+                    help="The directories containing the images. For ImageNet, the directory containing one folder per class.")
+parser.add_argument("-i", "--index_file", default=None,
+                    help="ImageNet only, the json file with the mapping of the index to classes. If specified, the labels of the images are stored in the index.")
+parser.add_argument("-s", "--shard_size", type=int, default=1024,
+                    help="The approximate size of each shard, in megabytes.")
+args = parser.parse_args()
+
+if args.index_file is not None:
+    # ImageNet, one directory per class
+    samples = []
+    for data_directory in args.directories:
+        association, _, images_path, labels = prepare_imagenet(
+            args.index_file, data_directory)
+        samples.extend(zip(images_path, labels.tolist()))
+    # The class names, sorted by index
+    classes = sorted(association.keys(), key=lambda name: int(association[name]))
+else:
+    # Pascal VOC or MS-COCO, the annotations are matched on the file names
+    samples = []
+    classes = None
+    for data_directory in args.directories:
+        for filename in sorted(listdir(data_directory)):
+            path = join(data_directory, filename)
+            if not isdir(path) and filename.lower().endswith((".jpg", ".jpeg")):
+                samples.append((path, -1))
+
+print("Packing {} images.".format(len(samples)))
+pack_records(args.output, samples, classes=classes,
+             shard_size=args.shard_size * 2**20)
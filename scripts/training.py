@@ -9,10 +9,15 @@ import csv
 
 from operator import itemgetter
 
+import numpy as np
+
 import keras.backend as K
 from keras.models import load_model
 sys.path.append(getcwd())
 from jpeg_deep.layers.ssd_layers import AnchorBoxes, DecodeDetections, L2Normalization
+from jpeg_deep.layers.dct_layers import CastToFloat, MaskedGlobalAveragePooling2D
+from jpeg_deep.generators import SharedMemoryLoader, TFDataAdapter
+from jpeg_deep.generators import ResumeCheckpoint, SkipBatches, load_resume_state
 
 import tensorflow as tf
 try:
@@ -53,7 +58,14 @@ if args.restart:
 
     # In case of restart save in the experiment directory.
     output_dir = basename(normpath(args.restart))
+
+    # If the training was interrupted in the middle of an epoch, it restarts from the last saved batch
+    resume_state = load_resume_state(join(args.restart, "resume"))
+    if resume_state is not None:
+        restart_epoch = resume_state.get("keras_epoch", resume_state["epoch"])
 else:
+    resume_state = None
+
     # Load configuration file
     sys.path.append(args.configuration)
     from config_file import TrainingConfiguration
@@ -82,7 +94,29 @@ if (args.horovod and hvd.rank() == 0) or (not args.horovod):
                         "config_dir": config_output_dir, "log_dir": logs_output_dir}
 
 # Prepare the generators
-config.prepare_training_generators()
+if args.horovod:
+    # The first rank indexes the dataset and builds the caches (manifest, annotations, DCT cache) if the configuration uses them, the other ranks then reuse them
+    if hvd.rank() == 0:
+        config.prepare_training_generators()
+
+    # All the ranks shuffle the images with the seed of the first one, the broadcast also waits for the first rank to be ready
+    seed = int(hvd.broadcast(np.array(np.random.randint(0, 2**31 - 1), dtype=np.int64), 0, name="sampler_seed"))
+    if hvd.rank() != 0:
+        config.prepare_training_generators()
+
+    # Each rank only reads its own shard of the images
+    for generator in [config.train_generator, config.validation_generator]:
+        if hasattr(generator, "set_shard"):
+            generator.set_shard(hvd.rank(), hvd.size(), seed)
+else:
+    config.prepare_training_generators()
+
+# The saved state gives the seed, the epoch and the batch of the sampler (the same for all the ranks)
+if resume_state is not None:
+    config.train_generator.set_state(resume_state)
+sampler_epoch = resume_state["epoch"] if resume_state is not None else 0
+sampler_batch = resume_state["cursor"] if resume_state is not None else 0
+restart_batch = resume_state.get("keras_batch", sampler_batch) if resume_state is not None else 0
 
 # Loading the model
 model = config.network
@@ -110,45 +144,97 @@ if (config.weights is not None and args.horovod and hvd.rank() == 0) or config.w
     # Loading the weights
     if args.restart:
         # In case of restart, get the weights
-        model_file = [f for f in listdir(
-            join(args.restart, "checkpoints")) if isfile(join(args.restart, "checkpoints", f))][0]
-        model_path = join(args.restart, "checkpoints", model_file)
-        restart_epoch = int(model_file.split("_")[0].split('-')[-1])
+        if resume_state is not None:
+            model_path = join(args.restart, "resume", resume_state["model"])
+        else:
+            model_file = [f for f in listdir(
+                join(args.restart, "checkpoints")) if isfile(join(args.restart, "checkpoints", f))][0]
+            model_path = join(args.restart, "checkpoints", model_file)
+            restart_epoch = int(model_file.split("_")[0].split('-')[-1])
         print("Loading weights (by name): {}".format(model_path))
         K.clear_session()
 
         # TODO: Move the custom objects to the conf file.
         model = load_model(model_path, custom_objects={
-                           "L2Normalization": L2Normalization, "DecodeDetections": DecodeDetections, "AnchorBoxes": AnchorBoxes, "compute_loss": config.loss})
+                           "L2Normalization": L2Normalization, "DecodeDetections": DecodeDetections, "AnchorBoxes": AnchorBoxes, "CastToFloat": CastToFloat, "MaskedGlobalAveragePooling2D": MaskedGlobalAveragePooling2D, "compute_loss": config.loss})
     else:
         print("Loading weights (by name): {}".format(config.weights))
         model.load_weights(config.weights, by_name=True)
 
-if args.restart:
-    # Fit the model on the batches generated.
-    model.fit_generator(config.train_generator,
-                        validation_data=config.validation_generator,
-                        epochs=config.epochs,
-                        steps_per_epoch=config.steps_per_epoch,
-                        callbacks=config.callbacks,
-                        workers=config.workers,
-                        verbose=verbose,
-                        initial_epoch=restart_epoch,
-                        validation_steps=config.validation_steps,
-                        use_multiprocessing=config.multiprocessing)
-else:
+# Loading the training batches through shared memory or tf.data if required by the configuration
+train_generator = config.train_generator
+workers = config.workers
+use_multiprocessing = config.multiprocessing
+steps_per_epoch = config.steps_per_epoch
+loader_workers = getattr(config, "loader_workers", None)
+tf_data = getattr(config, "tf_data", None)
+initial_epoch = restart_epoch if args.restart else 0
+if loader_workers:
+    train_generator = SharedMemoryLoader(config.train_generator, workers=loader_workers,
+                                         initial_epoch=sampler_epoch, initial_batch=sampler_batch)
+elif tf_data:
+    # tf_data is a dictionary of arguments of the adapter, e.g: {"parallel_calls": 8, "prefetch": 4}
+    train_generator = TFDataAdapter(config.train_generator,
+                                    initial_epoch=sampler_epoch, initial_batch=sampler_batch, **tf_data)
+if loader_workers or tf_data:
+    if steps_per_epoch is None:
+        steps_per_epoch = len(train_generator)
+    # The validation data is loaded in the main process
+    workers = 0
+    use_multiprocessing = False
+
+# The first rank regularly saves the model and the state of the sampler, to resume the training in the middle of an epoch
+callbacks = list(config.callbacks)
+if hasattr(config.train_generator, "get_state") and ((args.horovod and hvd.rank() == 0) or (not args.horovod)):
+    callbacks.append(ResumeCheckpoint(join(output_dir, "resume"), config.train_generator,
+                                      period=getattr(config, "resume_period", 1000),
+                                      initial_epoch=initial_epoch, initial_batch=restart_batch))
+
+if not args.restart:
     # Compiling the model
     model.compile(loss=config.loss,
                   optimizer=config.optimizer,
                   metrics=config.metrics)
 
-    # Fit the model on the batches generated.
-    model.fit_generator(config.train_generator,
+# The batches are used in the order of the generator, so that the saved state gives the batches already used
+if restart_batch > 0 or sampler_batch > 0:
+    # The interrupted epoch of Keras is finished, continuing the stream of batches from the saved batch of the sampler
+    remaining_steps = (steps_per_epoch or len(config.train_generator)) - restart_batch
+    if loader_workers or tf_data:
+        restart_generator = train_generator
+    else:
+        # The batches already used are skipped without being loaded, the following epochs of the sampler are continued
+        restart_generator = SkipBatches(config.train_generator, sampler_batch, steps=remaining_steps)
+    model.fit_generator(restart_generator,
                         validation_data=config.validation_generator,
-                        epochs=config.epochs,
-                        steps_per_epoch=config.steps_per_epoch,
-                        callbacks=config.callbacks,
-                        workers=config.workers,
+                        epochs=initial_epoch + 1,
+                        steps_per_epoch=remaining_steps,
+                        callbacks=callbacks,
+                        workers=workers,
                         verbose=verbose,
+                        initial_epoch=initial_epoch,
                         validation_steps=config.validation_steps,
-                        use_multiprocessing=config.multiprocessing)
+                        use_multiprocessing=use_multiprocessing,
+                        shuffle=False)
+    initial_epoch += 1
+    if not (loader_workers or tf_data):
+        # The next epochs of Keras start from the position of the sampler reached, the batches prefetched by the enqueuer are dropped
+        epochs, batch = divmod(sampler_batch + remaining_steps, len(config.train_generator))
+        config.train_generator.set_epoch(sampler_epoch + epochs)
+        train_generator = SkipBatches(config.train_generator, batch)
+
+# Fit the model on the batches generated.
+model.fit_generator(train_generator,
+                    validation_data=config.validation_generator,
+                    epochs=config.epochs,
+                    steps_per_epoch=steps_per_epoch,
+                    callbacks=callbacks,
+                    workers=workers,
+                    verbose=verbose,
+                    initial_epoch=initial_epoch,
+                    validation_steps=config.validation_steps,
+                    use_multiprocessing=use_multiprocessing,
+                    shuffle=False)
+
+if loader_workers:
+    train_generator.close()